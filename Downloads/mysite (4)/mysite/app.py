@@ -1,28 +1,47 @@
 # ==============================================================================
 # Imports
 # ==============================================================================
-from flask import Flask, request, abort, render_template, jsonify, redirect, url_for, send_file
+from flask import Flask, request, abort, render_template, jsonify, redirect, url_for, send_file, Response, stream_with_context
 from google.cloud.firestore_v1.base_query import FieldFilter, Or
 from linebot import LineBotApi, WebhookHandler
-from linebot.exceptions import InvalidSignatureError
+from linebot.exceptions import InvalidSignatureError, LineBotApiError
 from linebot.models import MessageEvent, TextMessage, TextSendMessage, FlexSendMessage, BubbleContainer, BoxComponent, ButtonComponent, URIAction, TextComponent, ImageMessage, VideoMessage, AudioMessage, FileMessage
 from datetime import datetime, timedelta
 import os
 import logging
 import firebase_admin
 from firebase_admin import credentials, firestore, storage
+from google.api_core.exceptions import AlreadyExists, NotFound
 import requests
 import sys
 import uuid
-import tempfile
 from functools import wraps
 import openai
 import random
 import re
 import string
+import threading
+import time
+import heapq
+import queue
+import itertools
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
 from dotenv import load_dotenv
 import google.generativeai as genai
 import json
+from rendering import PILLOW_AVAILABLE, render_icon_variants
+import io
+import csv
+import zipfile
+import hashlib
+import mimetypes
+import zlib
+import multiprocessing
+import sqlite3
+from collections import OrderedDict, deque
+from urllib.parse import quote, unquote
+import click
 # Load environment variables from .env file
 load_dotenv()
 
@@ -145,17 +164,82 @@ def token_required(f):
 # ==============================================================================
 # Helper Functions
 # ==============================================================================
+# LINEプロフィール (表示名) のキャッシュ。同じユーザーへの同時リクエストは1回のAPI呼び出しを共有し、
+# LINE の応答が遅い場合はプレースホルダー名で先に進めて、取得でき次第ユーザードキュメントに反映する。
+LINE_PROFILE_CACHE_TTL = int(os.getenv("LINE_PROFILE_CACHE_TTL", "3600"))
+LINE_PROFILE_CACHE_MAX = int(os.getenv("LINE_PROFILE_CACHE_MAX", "5000"))
+LINE_PROFILE_TIMEOUT = float(os.getenv("LINE_PROFILE_TIMEOUT", "2"))
+PLACEHOLDER_DISPLAY_NAME = "LINEユーザー"
+
+line_profile_cache = OrderedDict()  # user_id -> (有効期限, 表示名)
+line_profile_inflight = {}  # user_id -> Future
+line_profile_lock = threading.RLock()
+profile_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='line-profile')
+
+def _on_line_profile_fetched(user_id, future):
+    with line_profile_lock:
+        line_profile_inflight.pop(user_id, None)
+        if future.exception() is None:
+            line_profile_cache[user_id] = (time.monotonic() + LINE_PROFILE_CACHE_TTL, future.result())
+            line_profile_cache.move_to_end(user_id)
+            while len(line_profile_cache) > LINE_PROFILE_CACHE_MAX:
+                line_profile_cache.popitem(last=False)
+
+def get_line_display_name(user_id, timeout=LINE_PROFILE_TIMEOUT):
+    """
+    LINEの表示名をキャッシュ付きで取得します。
+    (表示名, 未完了のFuture) を返します。timeout 内に取得できなかった場合は
+    PLACEHOLDER_DISPLAY_NAME と取得中の Future を返すので、backfill_display_name に渡してください。
+    """
+    with line_profile_lock:
+        cached = line_profile_cache.get(user_id)
+        if cached and cached[0] > time.monotonic():
+            return cached[1], None
+        future = line_profile_inflight.get(user_id)
+        if future is None:
+            future = profile_executor.submit(lambda: line_bot_api.get_profile(user_id).display_name)
+            line_profile_inflight[user_id] = future
+            future.add_done_callback(lambda f: _on_line_profile_fetched(user_id, f))
+
+    try:
+        return future.result(timeout=timeout), None
+    except FuturesTimeoutError:
+        logger.warning(f"LINE profile lookup for {user_id} timed out. Using placeholder name.")
+        return PLACEHOLDER_DISPLAY_NAME, future
+    except Exception as e:
+        logger.error(f"Failed to fetch LINE profile for {user_id}: {e}")
+        return PLACEHOLDER_DISPLAY_NAME, None
+
+def backfill_display_name(future, user_ref):
+    """プロフィール取得が完了したら、名前がプレースホルダーのままのユーザードキュメントを更新します"""
+    if future is None or user_ref is None:
+        return
+
+    def apply(f):
+        if f.exception() is not None:
+            return
+        try:
+            snapshot = user_ref.get()
+            if snapshot.exists and snapshot.to_dict().get('name') == PLACEHOLDER_DISPLAY_NAME:
+                user_ref.update({'name': f.result()})
+        except Exception as e:
+            logger.error(f"Failed to backfill display name: {e}")
+
+    future.add_done_callback(apply)
+
 def create_user_if_not_exists(user_id):
     """
     指定されたuser_idのユーザーが存在しない場合、LINEプロファイルから情報を取得してFirestoreに作成します。
+    ユーザーのドキュメント参照とデータを返します (失敗した場合は (None, {}))。
     """
     try:
-        user_ref = db.collection('users').where(filter=FieldFilter('line_user_id', '==', user_id)).limit(1)
-        docs = list(user_ref.stream())
+        user_query = db.collection('users').where(filter=FieldFilter('line_user_id', '==', user_id)).limit(1)
+        docs = list(user_query.stream())
 
-        if not docs:
-            profile = line_bot_api.get_profile(user_id)
-            display_name = profile.display_name
+        if docs:
+            return docs[0].reference, docs[0].to_dict()
+        else:
+            display_name, pending_profile = get_line_display_name(user_id)
             new_user_data = {
                 'line_user_id': user_id,
                 'name': display_name,
@@ -166,436 +250,2242 @@ def create_user_if_not_exists(user_id):
                 'role': 'student',
                 'class_token_id': '',
                 'is_posting_diary': False,
+                'notify_class_ids': [],
                 'created_at': datetime.now().isoformat()
             }
-            db.collection('users').add(new_user_data)
+            _, user_ref = db.collection('users').add(new_user_data)
+            backfill_display_name(pending_profile, user_ref)
             logger.info(f"New user created: {display_name} (ID: {user_id}) with role 'student'")
+            return user_ref, new_user_data
 
     except Exception as e:
         logger.error(f"Failed to create or check user: {e}")
+        return None, {}
+
+def record_diary_stats(batch, user_id, content, created_at):
+    """
+    日記の書き込みと同じバッチで、ユーザーごとの統計ドキュメント (user_stats/{user_id}) を更新します。
+    統計ドキュメントがまだ無い場合は加算せず False を返します。加算から始めると過去の日記が
+    数えられないため、呼び出し側はコミット後に rebuild_user_stats で全件から作り直してください。
+    """
+    stats_ref = db.collection('user_stats').document(user_id)
+    if not stats_ref.get().exists:
+        return False
+    batch.set(stats_ref, {
+        'line_user_id': user_id,
+        'total_posts': firestore.Increment(1),
+        'total_word_count': firestore.Increment(len(content or '')),
+        'latest_post_date': created_at,
+        'updated_at': datetime.now().isoformat()
+    }, merge=True)
+    return True
+
+def rebuild_user_stats(user_id):
+    """
+    日記コレクションを走査して user_stats/{user_id} を作り直し、新しい統計を返します。
+    """
+    diaries_query = db.collection('diaries').where(filter=FieldFilter('user_id', '==', user_id)).select(['content', 'created_at'])
+    total_posts = 0
+    total_word_count = 0
+    latest_post_date = None
+    for doc in diaries_query.stream():
+        diary_data = doc.to_dict()
+        total_posts += 1
+        total_word_count += len(diary_data.get('content') or '')
+        created_at = diary_data.get('created_at')
+        if created_at and (latest_post_date is None or created_at > latest_post_date):
+            latest_post_date = created_at
+
+    stats = {
+        'line_user_id': user_id,
+        'total_posts': total_posts,
+        'total_word_count': total_word_count,
+        'latest_post_date': latest_post_date,
+        'updated_at': datetime.now().isoformat()
+    }
+    db.collection('user_stats').document(user_id).set(stats)
+    return stats
+
+def submission_status_id(assignment_id, student_id):
+    return f"{assignment_id}_{student_id}"
+
+@firestore.transactional
+def _write_submission(transaction, submission_ref, submission_data, status_ref, status_data):
+    """提出物と提出状況を書き込む。最初の提出日時 (first_submitted_at) は初回だけ設定する"""
+    status_snapshot = status_ref.get(transaction=transaction)
+    if not status_snapshot.exists or not (status_snapshot.to_dict() or {}).get('first_submitted_at'):
+        status_data = dict(status_data, first_submitted_at=submission_data['submitted_at'])
+    transaction.set(submission_ref, submission_data)
+    transaction.set(status_ref, status_data, merge=True)
+
+def record_submission(submission_ref, submission_data, class_id=None):
+    """
+    提出物と、提出状況のインデックス submission_status/{assignment_id}_{student_id} を1回のトランザクションで書き込みます。
+    インデックスにより「この生徒がこの課題を提出済みか」を提出履歴を読まずに1回の読み取りで判定できます。
+    期限後の再提出で遅延扱いにならないよう、最初の提出日時も保持します。
+    """
+    assignment_id = submission_data['assignment_id']
+    if class_id is None:
+        assignment_doc = db.collection('assignments').document(assignment_id).get()
+        class_id = assignment_doc.to_dict().get('class_id') if assignment_doc.exists else None
+
+    status_ref = db.collection('submission_status').document(submission_status_id(assignment_id, submission_data['student_line_user_id']))
+    _write_submission(db.transaction(), submission_ref, submission_data, status_ref, {
+        'assignment_id': assignment_id,
+        'class_id': class_id,
+        'student_line_user_id': submission_data['student_line_user_id'],
+        'status': 'submitted',
+        'last_submission_id': submission_ref.id,
+        'last_submission_type': submission_data['submission_type'],
+        'last_submitted_at': submission_data['submitted_at'],
+        'submission_count': firestore.Increment(1)
+    })
+    return submission_data
+
+def record_file_submission(assignment_id, student_id, storage_path, file_name='', content_sha256=None, class_id=None):
+    """
+    Storage に保存済みのファイルを、課題の提出物として Firestore に登録します。
+    ファイルは公開せず storage_path だけを保存し、表示時に署名付きURLを発行します。
+    content-addressed に保存したファイルは content_sha256 で file_objects の参照を持ちます。
+    """
+    submission_ref = db.collection('submissions').document()
+    submission_data = {
+        'id': submission_ref.id,
+        'assignment_id': assignment_id,
+        'student_line_user_id': student_id,
+        'submission_type': 'file',
+        'content': '', # 表示時に storage_path から署名付きURLを設定する
+        'storage_path': storage_path,
+        'content_sha256': content_sha256,
+        'file_name': file_name,
+        'submitted_at': datetime.now().isoformat()
+    }
+    return record_submission(submission_ref, submission_data, class_id)
+
+def get_user_stats(user_id):
+    """
+    user_stats/{user_id} を1回の読み取りで取得します。まだ存在しない場合は再構築します。
+    """
+    stats_doc = db.collection('user_stats').document(user_id).get()
+    if stats_doc.exists:
+        return stats_doc.to_dict()
+    return rebuild_user_stats(user_id)
+
+# ==============================================================================
+# LLM Concurrency Control
+# ==============================================================================
+# Gemini / OpenAI の同時呼び出し数とリクエストレートを制限するゲート。
+# クラス全員が同時に分析ページを開いても、プロバイダのレート制限に当たる前に
+# プロセス内でキューイングし、キューが深すぎる場合は即座に 429 を返す。
+# gunicorn 等で複数ワーカーを動かす場合は、各値をワーカー数で割って設定する。
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "4"))
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "20"))
+LLM_RATE_PER_SEC = float(os.getenv("LLM_RATE_PER_SEC", "2"))
+LLM_BURST = int(os.getenv("LLM_BURST", "4"))
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "30"))
+
+# 優先度クラス (値が小さいほど先に処理される)
+LLM_PRIORITY_INTERACTIVE = 'interactive'
+LLM_PRIORITY_BATCH = 'batch'
+LLM_PRIORITIES = {LLM_PRIORITY_INTERACTIVE: 0, LLM_PRIORITY_BATCH: 1}
+
+
+class LLMQueueFull(Exception):
+    """LLM呼び出しの待ち行列が一杯、または待ち時間が上限を超えた"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"LLM queue is full (retry after {retry_after}s)")
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """スレッドセーフなトークンバケット。rate 個/秒で補充され、最大 burst 個まで貯まる"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def try_take(self):
+        """トークンを1つ取得する。取得できなければ次のトークンまでの待ち秒数を返す (取得できた場合は0)"""
+        with self._lock:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            if self.rate <= 0:
+                return 1.0
+            return (1 - self._tokens) / self.rate
+
+    def take(self, timeout=None):
+        """トークンが取得できるまでブロックする。timeout 内に取得できなければ False"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self.try_take()
+            if wait == 0:
+                return True
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+
+class LLMGate:
+    """同時実行数・レート・優先度付き待ち行列でLLM呼び出しを制御する"""
+
+    def __init__(self, max_concurrency, max_queue, rate_per_sec, burst):
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_queue = max_queue
+        self._bucket = TokenBucket(rate_per_sec, burst)
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiting = []  # (priority, seq) のヒープ
+        self._seq = itertools.count()
+        self.stats = {
+            'admitted': 0,
+            'rejected': 0,
+            'timed_out': 0,
+            'total_queue_seconds': 0.0,
+            'max_queue_seconds': 0.0,
+            'total_service_seconds': 0.0,
+        }
+
+    def _estimate_retry_after(self):
+        """現在の待ち行列が捌けるまでのおおよその秒数"""
+        completed = max(1, self.stats['admitted'])
+        avg_service = self.stats['total_service_seconds'] / completed or 1.0
+        backlog = (len(self._waiting) + self._active) / self.max_concurrency
+        return max(1, int(backlog * avg_service + 0.999))
+
+    def acquire(self, priority=LLM_PRIORITY_INTERACTIVE, timeout=LLM_QUEUE_TIMEOUT):
+        rank = LLM_PRIORITIES.get(priority, LLM_PRIORITIES[LLM_PRIORITY_BATCH])
+        # バッチ処理は待ち行列の半分までしか使えないようにし、対話的な呼び出しの枠を残す
+        # (待ち行列が1以上あればバッチにも最低1つは枠を与える)
+        queue_limit = self.max_queue if rank == 0 else min(self.max_queue, max(1, self.max_queue // 2))
+        enqueued_at = time.monotonic()
+        deadline = enqueued_at + timeout
+
+        with self._cond:
+            # 待ち行列の長さは、空きスロットが無く実際に待つことになる場合だけ確認する
+            must_wait = bool(self._waiting) or self._active >= self.max_concurrency
+            if must_wait and len(self._waiting) >= queue_limit:
+                self.stats['rejected'] += 1
+                raise LLMQueueFull(self._estimate_retry_after())
+
+            entry = (rank, next(self._seq))
+            heapq.heappush(self._waiting, entry)
+            try:
+                while True:
+                    if self._waiting[0] == entry and self._active < self.max_concurrency:
+                        wait = self._bucket.try_take()
+                        if wait == 0:
+                            break
+                    else:
+                        wait = None
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.stats['timed_out'] += 1
+                        raise LLMQueueFull(self._estimate_retry_after())
+                    self._cond.wait(remaining if wait is None else min(wait, remaining))
+            except BaseException:
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+                raise
+
+            heapq.heappop(self._waiting)
+            self._active += 1
+            queued = time.monotonic() - enqueued_at
+            self.stats['admitted'] += 1
+            self.stats['total_queue_seconds'] += queued
+            self.stats['max_queue_seconds'] = max(self.stats['max_queue_seconds'], queued)
+            # 次の待ち行列先頭にも空きがあれば進めるよう通知する
+            self._cond.notify_all()
+
+        if queued > 1:
+            logger.info(f"LLM call ({priority}) waited {queued:.2f}s in queue")
+        return time.monotonic()
+
+    def release(self, started_at):
+        with self._cond:
+            self._active -= 1
+            self.stats['total_service_seconds'] += time.monotonic() - started_at
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, priority=LLM_PRIORITY_INTERACTIVE, timeout=LLM_QUEUE_TIMEOUT):
+        started_at = self.acquire(priority, timeout)
+        try:
+            yield
+        finally:
+            self.release(started_at)
+
+    def snapshot(self):
+        with self._cond:
+            admitted = self.stats['admitted']
+            return dict(
+                self.stats,
+                active=self._active,
+                queue_depth=len(self._waiting),
+                avg_queue_seconds=self.stats['total_queue_seconds'] / admitted if admitted else 0.0,
+            )
+
+
+llm_gate = LLMGate(LLM_MAX_CONCURRENCY, LLM_MAX_QUEUE, LLM_RATE_PER_SEC, LLM_BURST)
+
+
+def generate_gemini_content(prompt, priority=LLM_PRIORITY_INTERACTIVE):
+    """llm_gate を通して Gemini を呼び出し、生成されたテキストを返す"""
+    with llm_gate.slot(priority):
+        model = genai.GenerativeModel('gemini-pro')
+        response = model.generate_content(prompt)
+    return response.text
+
+
+def llm_busy_response(e):
+    """LLMQueueFull を Retry-After 付きの 429 レスポンスに変換する"""
+    response = jsonify({
+        "status": "error",
+        "message": "分析リクエストが混み合っています。しばらくしてから再度お試しください。",
+        "retry_after": e.retry_after
+    })
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response, 429
+
+
+# 内部メトリクス: 名前 -> スナップショットを返す関数
+METRICS_PROVIDERS = {
+    'llm_gate': llm_gate.snapshot,
+}
+
+# ==============================================================================
+# Firestore Query Fan-out
+# ==============================================================================
+# Firestore の 'in' クエリは要素数に上限があるため分割して実行する必要がある。
+# 分割したクエリを共有スレッドプールで並列に実行し、結果を結合する。
+FIRESTORE_FANOUT_WORKERS = int(os.getenv("FIRESTORE_FANOUT_WORKERS", "8"))
+fanout_executor = ThreadPoolExecutor(max_workers=FIRESTORE_FANOUT_WORKERS, thread_name_prefix='firestore-fanout')
+fanout_stats = {'calls': 0, 'chunks': 0, 'total_chunk_seconds': 0.0, 'max_chunk_seconds': 0.0}
+fanout_stats_lock = threading.Lock()
+
+def _run_chunk_query(build_query, chunk, label):
+    started_at = time.monotonic()
+    docs = list(build_query(chunk).stream())
+    elapsed = time.monotonic() - started_at
+    with fanout_stats_lock:
+        fanout_stats['chunks'] += 1
+        fanout_stats['total_chunk_seconds'] += elapsed
+        fanout_stats['max_chunk_seconds'] = max(fanout_stats['max_chunk_seconds'], elapsed)
+    logger.debug(f"{label}: chunk of {len(chunk)} returned {len(docs)} docs in {elapsed * 1000:.1f}ms")
+    return docs
+
+def fetch_in_chunks(build_query, values, chunk_size, ordered=True, label='chunked query'):
+    """
+    values を chunk_size 件ずつに分割し、build_query(chunk) で組み立てたクエリを並列に実行して
+    全チャンクのドキュメントを1つのリストにまとめて返します。
+    ordered=True の場合はチャンクの順序どおりに結合します (チャンク内の順序はクエリのまま)。
+    """
+    values = list(values)
+    if not values:
+        return []
+    chunks = [values[i:i+chunk_size] for i in range(0, len(values), chunk_size)]
+    with fanout_stats_lock:
+        fanout_stats['calls'] += 1
+
+    if len(chunks) == 1:
+        return _run_chunk_query(build_query, chunks[0], label)
+
+    futures = [fanout_executor.submit(_run_chunk_query, build_query, chunk, label) for chunk in chunks]
+    results = []
+    if ordered:
+        for future in futures:
+            results.extend(future.result())
+    else:
+        for future in as_completed(futures):
+            results.extend(future.result())
+    return results
+
+def get_fanout_stats():
+    with fanout_stats_lock:
+        chunks = fanout_stats['chunks']
+        return dict(fanout_stats, avg_chunk_seconds=fanout_stats['total_chunk_seconds'] / chunks if chunks else 0.0)
+
+METRICS_PROVIDERS['firestore_fanout'] = get_fanout_stats
+
+# ==============================================================================
+# Storage Uploads
+# ==============================================================================
+# LINE のメッセージコンテンツを一時ファイルを経由せずに Cloud Storage へ流し込む。
+# 読み込みは LINE_CONTENT_CHUNK_SIZE ずつ、アップロードは STORAGE_UPLOAD_CHUNK_SIZE ごとの
+# レジューマブルアップロードで行うため、メモリ使用量はファイルサイズによらず一定になる。
+LINE_CONTENT_CHUNK_SIZE = int(os.getenv("LINE_CONTENT_CHUNK_SIZE", str(1024 * 1024)))
+# レジューマブルアップロードのチャンクは 256KB の倍数である必要がある
+STORAGE_UPLOAD_CHUNK_SIZE = int(os.getenv("STORAGE_UPLOAD_CHUNK_SIZE", str(8 * 1024 * 1024)))
+
+# LINE がコンテンツタイプを返さなかった場合の既定値
+DEFAULT_MESSAGE_CONTENT_TYPES = {
+    'ImageMessage': 'image/jpeg',
+    'VideoMessage': 'video/mp4',
+    'AudioMessage': 'audio/mp4',
+}
+
+upload_stats = {'uploads': 0, 'bytes': 0, 'seconds': 0.0, 'last_mb_per_sec': 0.0}
+upload_stats_lock = threading.Lock()
+
+class ChunkStream:
+    """
+    iter_content() などのチャンクのイテレータを、read()/tell() を持つファイルライクなオブジェクトとして扱う。
+    read(n) は終端に達しない限り必ず n バイトを返す (レジューマブルアップロードは短い読み込みを終端とみなすため)。
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = memoryview(b'')
+        self.bytes_read = 0
+
+    def _fill(self):
+        while not self._buffer:
+            try:
+                self._buffer = memoryview(next(self._chunks))
+            except StopIteration:
+                return False
+        return True
+
+    def read(self, size=-1):
+        parts = []
+        remaining = size
+        while (size is None or size < 0 or remaining > 0) and self._fill():
+            take = len(self._buffer) if size is None or size < 0 else min(remaining, len(self._buffer))
+            parts.append(self._buffer[:take].tobytes())
+            self._buffer = self._buffer[take:]
+            remaining -= take
+        data = b''.join(parts)
+        self.bytes_read += len(data)
+        return data
+
+    def peek(self, size):
+        """ストリームを消費せずに先頭から最大 size バイトを返す"""
+        while len(self._buffer) < size:
+            try:
+                chunk = next(self._chunks)
+            except StopIteration:
+                break
+            self._buffer = memoryview(self._buffer.tobytes() + chunk)
+        return self._buffer[:size].tobytes()
+
+    def tell(self):
+        return self.bytes_read
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+# ファイル先頭のマジックバイトから判定するコンテンツタイプ
+SNIFF_HEADER_SIZE = 64
+MAGIC_SIGNATURES = [
+    (b'\xff\xd8\xff', 'image/jpeg', '.jpg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png', '.png'),
+    (b'GIF87a', 'image/gif', '.gif'),
+    (b'GIF89a', 'image/gif', '.gif'),
+    (b'II*\x00', 'image/tiff', '.tif'),
+    (b'MM\x00*', 'image/tiff', '.tif'),
+    (b'%PDF-', 'application/pdf', '.pdf'),
+    (b'OggS', 'audio/ogg', '.ogg'),
+    (b'fLaC', 'audio/flac', '.flac'),
+    (b'\x1a\x45\xdf\xa3', 'video/webm', '.webm'),
+    (b'PK\x03\x04', 'application/zip', '.zip'),
+]
+RIFF_FORMATS = {
+    b'WEBP': ('image/webp', '.webp'),
+    b'WAVE': ('audio/wav', '.wav'),
+    b'AVI ': ('video/x-msvideo', '.avi'),
+}
+# ISO BMFF (MP4/MOV/HEIC など) の major brand
+FTYP_BRANDS = {
+    b'heic': ('image/heic', '.heic'), b'heix': ('image/heic', '.heic'),
+    b'mif1': ('image/heif', '.heif'), b'msf1': ('image/heif', '.heif'),
+    b'avif': ('image/avif', '.avif'),
+    b'qt  ': ('video/quicktime', '.mov'),
+    b'M4A ': ('audio/mp4', '.m4a'),
+    b'3gp4': ('video/3gpp', '.3gp'), b'3gp5': ('video/3gpp', '.3gp'),
+}
+
+# テキストの BOM (MPEG のフレーム同期 FF Ex と衝突する UTF-16LE の FF FE より先に判定する)
+TEXT_BOMS = (b'\xef\xbb\xbf', b'\xff\xfe', b'\xfe\xff')
+BMP_DIB_HEADER_SIZES = (12, 40, 52, 56, 64, 108, 124)
+# 数バイトのパターンでしか判定できず、テキストの先頭と偶然一致しうる形式。
+# 申告されたタイプやファイル名がテキストを示す場合はそちらを優先する。
+WEAK_SNIFF_TYPES = {'text/plain', 'audio/mpeg', 'audio/aac', 'image/bmp'}
+TEXT_LIKE_TYPES = {'application/json', 'application/xml', 'application/csv'}
+
+def _is_id3_header(head):
+    return len(head) >= 10 and head[:3] == b'ID3' and head[3] in (2, 3, 4) and head[5] & 0x0F == 0 \
+        and all(b < 0x80 for b in head[6:10])
+
+def _is_mpeg_frame_header(head):
+    """MPEG オーディオのフレームヘッダ (同期ビットに加えて予約値でないこと) を検証する"""
+    if len(head) < 3 or head[0] != 0xFF or head[1] & 0xE0 != 0xE0:
+        return False
+    version = (head[1] >> 3) & 0x03
+    layer = (head[1] >> 1) & 0x03
+    bitrate_index = head[2] >> 4
+    sample_rate_index = (head[2] >> 2) & 0x03
+    return version != 1 and layer != 0 and bitrate_index not in (0, 15) and sample_rate_index != 3
+
+def _is_adts_header(head):
+    """AAC (ADTS) のフレームヘッダを検証する"""
+    if len(head) < 7 or head[0] != 0xFF or head[1] & 0xF6 != 0xF0:
+        return False
+    sample_rate_index = (head[2] >> 2) & 0x0F
+    frame_length = ((head[3] & 0x03) << 11) | (head[4] << 3) | (head[5] >> 5)
+    return sample_rate_index < 13 and frame_length >= 7
+
+def _is_bmp_header(head):
+    """BMP のファイルヘッダ (予約領域が0、DIB ヘッダのサイズが既知の値) を検証する"""
+    if len(head) < 18 or not head.startswith(b'BM'):
+        return False
+    reserved = head[6:10]
+    pixel_offset = int.from_bytes(head[10:14], 'little')
+    dib_header_size = int.from_bytes(head[14:18], 'little')
+    return reserved == b'\x00\x00\x00\x00' and dib_header_size in BMP_DIB_HEADER_SIZES and pixel_offset >= 14 + dib_header_size
+
+def sniff_content_type(head):
+    """
+    ファイル先頭のバイト列からコンテンツタイプと拡張子を判定します。
+    判定できない場合は (None, None) を返します。
+    """
+    for signature, content_type, extension in MAGIC_SIGNATURES:
+        if head.startswith(signature):
+            return content_type, extension
+    if head[:4] == b'RIFF' and head[8:12] in RIFF_FORMATS:
+        return RIFF_FORMATS[head[8:12]]
+    if head[4:8] == b'ftyp':
+        return FTYP_BRANDS.get(head[8:12], ('video/mp4', '.mp4'))
+    if head.startswith(TEXT_BOMS):
+        return 'text/plain', '.txt'
+    if _is_id3_header(head) or _is_mpeg_frame_header(head):
+        return 'audio/mpeg', '.mp3'
+    if _is_adts_header(head):
+        return 'audio/aac', '.aac'
+    if _is_bmp_header(head):
+        return 'image/bmp', '.bmp'
+    return None, None
+
+def is_text_like_type(content_type):
+    return bool(content_type) and (content_type.startswith('text/') or content_type in TEXT_LIKE_TYPES)
+
+def resolve_content_type(head, declared_type, filename=''):
+    """
+    マジックバイト・申告されたコンテンツタイプ・ファイル名からコンテンツタイプと拡張子を決めます。
+    Office 文書などの ZIP ベースの形式は、ファイル名の拡張子を優先します。
+    弱い判定 (WEAK_SNIFF_TYPES) は、申告やファイル名がテキストを示す場合には採用しません。
+    """
+    sniffed_type, sniffed_extension = sniff_content_type(head)
+    filename_extension = os.path.splitext(filename)[1].lower()
+
+    content_type = (declared_type or '').split(';')[0].strip()
+    if filename and content_type in ('', 'application/octet-stream'):
+        content_type = mimetypes.guess_type(filename)[0] or content_type
+
+    if sniffed_type == 'application/zip' and filename_extension not in ('', '.zip'):
+        sniffed_type = None
+    if sniffed_type in WEAK_SNIFF_TYPES and (is_text_like_type(content_type) or is_text_like_type(mimetypes.guess_type(filename)[0])):
+        sniffed_type = None
+    if sniffed_type:
+        return sniffed_type, sniffed_extension
+
+    content_type = content_type or 'application/octet-stream'
+    return content_type, filename_extension or mimetypes.guess_extension(content_type) or ''
+
+# 保存するオブジェクト名は一意なので、ブラウザに長期間キャッシュさせる
+# (オブジェクトは非公開で署名付きURL経由で配信するため、共有キャッシュには置かせない)
+IMMUTABLE_CACHE_CONTROL = 'private, max-age=31536000, immutable'
+
+def stream_to_blob(blob, stream, content_type):
+    """ChunkStream を blob にストリーミングでアップロードし、アップロードしたバイト数を返す"""
+    blob.chunk_size = STORAGE_UPLOAD_CHUNK_SIZE
+    blob.cache_control = IMMUTABLE_CACHE_CONTROL
+    started_at = time.monotonic()
+    blob.upload_from_file(stream, content_type=content_type)
+    elapsed = max(time.monotonic() - started_at, 1e-6)
+
+    mb_per_sec = stream.bytes_read / elapsed / (1024 * 1024)
+    with upload_stats_lock:
+        upload_stats['uploads'] += 1
+        upload_stats['bytes'] += stream.bytes_read
+        upload_stats['seconds'] += elapsed
+        upload_stats['last_mb_per_sec'] = mb_per_sec
+    logger.info(f"Uploaded {stream.bytes_read} bytes to {blob.name} in {elapsed:.2f}s ({mb_per_sec:.1f} MB/s)")
+    return stream.bytes_read
+
+def get_upload_stats():
+    with upload_stats_lock:
+        seconds = upload_stats['seconds']
+        return dict(upload_stats, avg_mb_per_sec=upload_stats['bytes'] / seconds / (1024 * 1024) if seconds else 0.0)
+
+METRICS_PROVIDERS['storage_uploads'] = get_upload_stats
+
+# ==============================================================================
+# Signed Download URLs
+# ==============================================================================
+# Storage のオブジェクトは公開せず (make_public を使わない)、表示のたびに V4 署名付きURLを発行する。
+# 署名はサービスアカウントの鍵でローカルに計算されるが、一覧の表示では件数分の RSA 署名になるため、
+# 期限切れの少し前までプロセス内にキャッシュして再利用する。
+# 旧データの公開URL (http(s)://...) はそのまま返す。
+SIGNED_READ_URL_TTL = int(os.getenv("SIGNED_READ_URL_TTL", "3600"))
+SIGNED_READ_URL_REFRESH_MARGIN = int(os.getenv("SIGNED_READ_URL_REFRESH_MARGIN", "300"))
+SIGNED_READ_URL_CACHE_SIZE = int(os.getenv("SIGNED_READ_URL_CACHE_SIZE", "10000"))
+
+signed_url_cache = OrderedDict()  # storage_path -> (url, 再発行が必要になる時刻 (monotonic))
+signed_url_lock = threading.Lock()
+signed_url_stats = {'hits': 0, 'signed': 0, 'errors': 0}
+
+def is_storage_path(value):
+    """Firestore に保存された値が (旧形式の公開URLではなく) Storage のオブジェクトパスかどうか"""
+    return bool(value) and not value.startswith(('http://', 'https://'))
+
+def _sign_read_url(path):
+    return bucket.blob(path).generate_signed_url(
+        version='v4',
+        expiration=timedelta(seconds=SIGNED_READ_URL_TTL),
+        method='GET'
+    )
+
+def get_signed_read_urls(paths):
+    """
+    Storage のパスの一覧に対して {パス: 署名付きURL} を返します。
+    キャッシュにあるものは再利用し、無いものだけをまとめて署名します。
+    """
+    now = time.monotonic()
+    urls = {}
+    missing = []
+    with signed_url_lock:
+        for path in dict.fromkeys(paths):
+            if not is_storage_path(path):
+                urls[path] = path or ''
+                continue
+            cached = signed_url_cache.get(path)
+            if cached and cached[1] > now:
+                signed_url_cache.move_to_end(path)
+                urls[path] = cached[0]
+                signed_url_stats['hits'] += 1
+            else:
+                missing.append(path)
+
+    if not missing or not bucket:
+        return urls
+
+    fresh_until = now + SIGNED_READ_URL_TTL - SIGNED_READ_URL_REFRESH_MARGIN
+    signed = {}
+    for path in missing:
+        try:
+            signed[path] = _sign_read_url(path)
+        except Exception as e:
+            logger.error(f"Failed to sign download URL for {path}: {e}")
+            urls[path] = ''
+
+    with signed_url_lock:
+        for path, url in signed.items():
+            signed_url_cache[path] = (url, fresh_until)
+            signed_url_cache.move_to_end(path)
+        while len(signed_url_cache) > SIGNED_READ_URL_CACHE_SIZE:
+            signed_url_cache.popitem(last=False)
+        signed_url_stats['signed'] += len(signed)
+        signed_url_stats['errors'] += len(missing) - len(signed)
+    urls.update(signed)
+    return urls
+
+def get_signed_read_url(path):
+    """Storage のパス (または旧形式の公開URL) から表示用のURLを返します"""
+    if not path:
+        return ''
+    return get_signed_read_urls([path]).get(path, '')
+
+def with_signed_file_urls(submissions):
+    """ファイル提出物の content に署名付きURLをまとめて設定します"""
+    urls = get_signed_read_urls([s['storage_path'] for s in submissions if s.get('storage_path')])
+    for submission in submissions:
+        if submission.get('storage_path'):
+            submission['content'] = urls.get(submission['storage_path'], '')
+    return submissions
+
+def get_signed_url_stats():
+    with signed_url_lock:
+        return dict(signed_url_stats, cached=len(signed_url_cache))
+
+METRICS_PROVIDERS['signed_urls'] = get_signed_url_stats
+
+# ==============================================================================
+# Content-Addressed Storage
+# ==============================================================================
+# 提出ファイルは内容の SHA-256 をキーに cas/{hash} へ1つだけ保存し、
+# 参照数を Firestore の file_objects/{hash} で管理する。
+# 同じ写真や PDF が再送された場合は、アップロードせずに参照数を増やすだけで済む。
+# - CAS_SPOOL_LIMIT 以下のファイルはメモリ上でハッシュを計算してから、未登録の場合だけアップロードする
+# - それより大きいファイルはハッシュを計算しながら一時オブジェクトへストリーミングし、
+#   完了後に重複なら一時オブジェクトを削除、そうでなければ cas/ へサーバー側でコピーする
+# 参照が無くなったオブジェクトは file_objects を status='deleting' にしてから Storage を削除し、
+# その後ドキュメントを消す。削除中に同じ内容が届いた場合は削除の完了を待ってから保存し直すので、
+# 解放処理が新しく保存されたオブジェクトを消すことはない。
+CAS_PREFIX = 'cas'
+CAS_TMP_PREFIX = 'cas_tmp'
+CAS_SPOOL_LIMIT = int(os.getenv("CAS_SPOOL_LIMIT", str(16 * 1024 * 1024)))
+CAS_DELETE_WAIT_SECONDS = float(os.getenv("CAS_DELETE_WAIT_SECONDS", "30"))
+# この時間を過ぎても deleting のままのドキュメントは、解放したプロセスが落ちたものとして引き継いで削除する
+CAS_DELETE_STALE_SECONDS = int(os.getenv("CAS_DELETE_STALE_SECONDS", "120"))
+
+cas_stats_lock = threading.Lock()
+cas_stats = {'uploaded': 0, 'deduplicated': 0, 'bytes_saved': 0, 'released': 0}
+
+def cas_path_for(content_sha256):
+    return f"{CAS_PREFIX}/{content_sha256[:2]}/{content_sha256}"
+
+class FileObjectDeleting(Exception):
+    """参照が無くなり削除中の file_objects に参照を追加しようとした"""
+
+@firestore.transactional
+def _add_file_reference(transaction, file_ref):
+    """登録済みなら参照数を1増やして True を返す (削除中なら FileObjectDeleting)"""
+    snapshot = file_ref.get(transaction=transaction)
+    if not snapshot.exists:
+        return False
+    if snapshot.to_dict().get('status') == 'deleting':
+        raise FileObjectDeleting(file_ref.id)
+    transaction.update(file_ref, {'ref_count': firestore.Increment(1), 'last_referenced_at': datetime.now().isoformat()})
+    return True
+
+@firestore.transactional
+def _register_file_object(transaction, file_ref, file_data):
+    """アップロード済みのオブジェクトを登録する (同時に登録された場合は参照数を増やす)"""
+    snapshot = file_ref.get(transaction=transaction)
+    if snapshot.exists:
+        if snapshot.to_dict().get('status') == 'deleting':
+            raise FileObjectDeleting(file_ref.id)
+        transaction.update(file_ref, {'ref_count': firestore.Increment(1), 'last_referenced_at': datetime.now().isoformat()})
+    else:
+        transaction.set(file_ref, dict(file_data, ref_count=1))
+
+def _decrement_file_reference(transaction, file_ref):
+    """参照数を1減らし、参照が無くなった場合は削除中にしてオブジェクトのパスを返す"""
+    snapshot = file_ref.get(transaction=transaction)
+    if not snapshot.exists:
+        return None
+    file_data = snapshot.to_dict()
+    if file_data.get('status') == 'deleting':
+        return None
+    if file_data.get('ref_count', 0) <= 1:
+        transaction.update(file_ref, {'status': 'deleting', 'ref_count': 0, 'deleting_at': datetime.now().isoformat()})
+        return file_data.get('storage_path')
+    transaction.update(file_ref, {'ref_count': firestore.Increment(-1)})
+    return None
+
+@firestore.transactional
+def _remove_file_reference(transaction, file_ref):
+    return _decrement_file_reference(transaction, file_ref)
+
+def _finish_file_object_delete(file_ref, storage_path):
+    """削除中の file_objects のオブジェクトを消してからドキュメントを消す"""
+    try:
+        bucket.blob(storage_path).delete()
+    except NotFound:
+        pass
+    file_ref.delete()
+    with cas_stats_lock:
+        cas_stats['released'] += 1
+
+def wait_for_file_object_delete(file_ref):
+    """
+    削除中の file_objects が消えるまで待ちます。解放したプロセスが落ちて deleting のまま
+    残っている場合は、代わりに削除を完了させます。
+    """
+    deadline = time.monotonic() + CAS_DELETE_WAIT_SECONDS
+    while True:
+        snapshot = file_ref.get()
+        if not snapshot.exists:
+            return
+        file_data = snapshot.to_dict()
+        if file_data.get('status') != 'deleting':
+            return
+        if file_data.get('deleting_at', '') < (datetime.now() - timedelta(seconds=CAS_DELETE_STALE_SECONDS)).isoformat():
+            logger.warning(f"Taking over stale deletion of file object {file_ref.id}")
+            _finish_file_object_delete(file_ref, file_data['storage_path'])
+            return
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"File object {file_ref.id} is still being deleted")
+        time.sleep(0.2)
+
+def _record_cas_result(deduplicated, size):
+    with cas_stats_lock:
+        if deduplicated:
+            cas_stats['deduplicated'] += 1
+            cas_stats['bytes_saved'] += size
+        else:
+            cas_stats['uploaded'] += 1
+
+def store_content_addressed(stream, content_type):
+    """
+    ChunkStream の内容を content-addressed に保存し、(storage_path, sha256, 重複だったか) を返します。
+    """
+    hasher = hashlib.sha256()
+    spooled = []
+    size = 0
+    while size <= CAS_SPOOL_LIMIT:
+        chunk = stream.read(LINE_CONTENT_CHUNK_SIZE)
+        if not chunk:
+            break
+        hasher.update(chunk)
+        spooled.append(chunk)
+        size += len(chunk)
+
+    tmp_blob = None
+    if size > CAS_SPOOL_LIMIT:
+        # 大きいファイル: 残りをハッシュしながら一時オブジェクトへストリーミングする
+        def hashed_remainder():
+            yield from spooled
+            for chunk in iter(lambda: stream.read(LINE_CONTENT_CHUNK_SIZE), b''):
+                hasher.update(chunk)
+                yield chunk
+
+        tmp_blob = bucket.blob(f"{CAS_TMP_PREFIX}/{uuid.uuid4().hex}")
+        size = stream_to_blob(tmp_blob, ChunkStream(hashed_remainder()), content_type)
+        spooled = None
+
+    content_sha256 = hasher.hexdigest()
+    storage_path = cas_path_for(content_sha256)
+    file_ref = db.collection('file_objects').document(content_sha256)
+    try:
+        while True:
+            try:
+                if _add_file_reference(db.transaction(), file_ref):
+                    _record_cas_result(True, size)
+                    return storage_path, content_sha256, True
+
+                blob = bucket.blob(storage_path)
+                if tmp_blob is None:
+                    blob.cache_control = IMMUTABLE_CACHE_CONTROL
+                    blob.upload_from_string(b''.join(spooled), content_type=content_type)
+                else:
+                    # 同じバケット内のコピーはサーバー側で行われる (大きなオブジェクトは rewrite を繰り返す)
+                    rewrite_token, _, _ = blob.rewrite(tmp_blob)
+                    while rewrite_token:
+                        rewrite_token, _, _ = blob.rewrite(tmp_blob, token=rewrite_token)
+
+                _register_file_object(db.transaction(), file_ref, {
+                    'storage_path': storage_path,
+                    'size': size,
+                    'content_type': content_type,
+                    'created_at': datetime.now().isoformat(),
+                    'last_referenced_at': datetime.now().isoformat()
+                })
+                break
+            except FileObjectDeleting:
+                # 同じ内容のオブジェクトが解放中: 削除が終わってから保存し直す
+                wait_for_file_object_delete(file_ref)
+    finally:
+        if tmp_blob is not None:
+            tmp_blob.delete()
+
+    _record_cas_result(False, size)
+    return storage_path, content_sha256, False
+
+def release_file_object(content_sha256):
+    """提出物の削除時に参照数を減らし、参照が無くなったオブジェクトを削除します"""
+    file_ref = db.collection('file_objects').document(content_sha256)
+    storage_path = _remove_file_reference(db.transaction(), file_ref)
+    if storage_path:
+        _finish_file_object_delete(file_ref, storage_path)
+    return storage_path
+
+def get_cas_stats():
+    with cas_stats_lock:
+        return dict(cas_stats)
+
+METRICS_PROVIDERS['content_store'] = get_cas_stats
+
+# ==============================================================================
+# Icon Processing
+# ==============================================================================
+# アップロードされたアイコンは向きを補正して EXIF を取り除き、一覧やフィードで使う
+# 固定サイズの正方形画像 (WebP または JPEG) に変換してから保存する。
+# 画像処理は CPU を使うため、Flask のワーカーではなくプロセスプールで行う。
+ICON_SIZES = (48, 96, 256)
+ICON_VARIANT_FORMAT = os.getenv("ICON_VARIANT_FORMAT", "webp")  # 'webp' または 'jpeg'
+ICON_MAX_BYTES = int(os.getenv("ICON_MAX_BYTES", str(10 * 1024 * 1024)))
+ICON_PROCESS_WORKERS = int(os.getenv("ICON_PROCESS_WORKERS", "2"))
+ICON_PROCESS_TIMEOUT = float(os.getenv("ICON_PROCESS_TIMEOUT", "20"))
+# アイコンとして受け付ける形式。HEIC/HEIF は Pillow (プラグイン無し) で縮小版を作れず、
+# 元画像のままではほとんどのブラウザで表示できないため受け付けない
+ICON_CONTENT_TYPES = {'image/jpeg', 'image/png', 'image/webp', 'image/gif'}
+ICON_VARIANT_TYPES = {
+    'webp': ('image/webp', '.webp'),
+    'jpeg': ('image/jpeg', '.jpg'),
+}
+
+# プロセスプールの子プロセスの起動方式。プールは最初のリクエストで遅延生成され、その時点の
+# プロセスには webhook/outbox/リマインダーのスレッドや gRPC のチャネルがあるため、fork すると
+# 子プロセスが他スレッドの保持していたロックを引き継いでデッドロックしうる。
+# forkserver (使えない環境では spawn) でスレッドを持たないプロセスから子を起動する。
+PROCESS_POOL_START_METHOD = os.getenv("PROCESS_POOL_START_METHOD", "forkserver")
+
+def get_process_pool_context():
+    if PROCESS_POOL_START_METHOD not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('spawn')
+    return multiprocessing.get_context(PROCESS_POOL_START_METHOD)
+
+icon_process_pool = None
+icon_process_pool_lock = threading.Lock()
+
+def get_icon_process_pool():
+    global icon_process_pool
+    with icon_process_pool_lock:
+        if icon_process_pool is None:
+            icon_process_pool = ProcessPoolExecutor(max_workers=ICON_PROCESS_WORKERS, mp_context=get_process_pool_context())
+        return icon_process_pool
+
+def process_icon(data):
+    """
+    アイコン画像から ICON_SIZES の縮小版を作ります。{サイズ: バイト列} を返し、
+    Pillow が無い場合や画像を処理できなかった場合は空の dict を返します。
+    """
+    if not PILLOW_AVAILABLE:
+        return {}
+    try:
+        future = get_icon_process_pool().submit(render_icon_variants, data, ICON_SIZES, ICON_VARIANT_FORMAT)
+        return future.result(timeout=ICON_PROCESS_TIMEOUT)
+    except Exception as e:
+        logger.error(f"Failed to process icon image: {e}")
+        return {}
+
+def store_icon(base_filename, data, content_type, file_extension):
+    """
+    アイコンの縮小版を保存し、(代表のパス, {サイズ: パス}) を返します。
+    縮小版を作れなかった場合は元の画像をそのまま保存します。
+    """
+    icon_paths = {}
+    variant_content_type, variant_extension = ICON_VARIANT_TYPES[ICON_VARIANT_FORMAT]
+    for size, body in process_icon(data).items():
+        blob = bucket.blob(f"{base_filename}_{size}{variant_extension}")
+        blob.cache_control = IMMUTABLE_CACHE_CONTROL
+        blob.upload_from_string(body, content_type=variant_content_type)
+        icon_paths[str(size)] = blob.name
+
+    if icon_paths:
+        return icon_paths[str(max(ICON_SIZES))], icon_paths
+
+    blob = bucket.blob(f"{base_filename}{file_extension}")
+    blob.cache_control = IMMUTABLE_CACHE_CONTROL
+    blob.upload_from_string(data, content_type=content_type)
+    return blob.name, icon_paths
+
+def icon_upload_response(icon_path, icon_paths):
+    """
+    アイコンのアップロード結果を返します。
+    icon_path / icon_paths はプロフィール保存時にそのまま送り返してもらう値で、
+    プレビュー用の署名付きURLは icon_url / icon_urls に入れます。
+    """
+    urls = get_signed_read_urls([icon_path, *icon_paths.values()])
+    return {
+        "status": "success",
+        "icon_path": icon_path,
+        "icon_paths": icon_paths,
+        "icon_url": urls.get(icon_path, ''),
+        "icon_urls": {size: urls.get(path, '') for size, path in icon_paths.items()}
+    }
+
+def icon_path_for(user_data, size=ICON_SIZES[0]):
+    """表示サイズに合ったアイコンのパス (旧データは公開URL) を返します"""
+    return (user_data.get('icon_paths', {}).get(str(size))
+            or user_data.get('icon_urls', {}).get(str(size))
+            or user_data.get('icon_path', ''))
+
+def icon_url_for(user_data, size=ICON_SIZES[0]):
+    """表示サイズに合ったアイコンのURLを返します (縮小版が無い場合は元のアイコン)"""
+    return get_signed_read_url(icon_path_for(user_data, size))
+
+def stored_icon_path(user_data):
+    """
+    API で返す icon_path。旧データの公開URLは Storage のパスに直すので、icon_path は常にパス (または空) になる。
+    表示には icon_url を使う。
+    """
+    value = user_data.get('icon_path', '')
+    if is_storage_path(value):
+        return value
+    return storage_path_from_url(value) or ''
+
+def icon_fields(user_data, size=ICON_SIZES[0]):
+    """一覧などで返すアイコンのフィールド (icon_path はパス、icon_url は表示用の署名付きURL)"""
+    return {'icon_path': stored_icon_path(user_data), 'icon_url': icon_url_for(user_data, size)}
+
+def icon_urls_for(user_data):
+    """すべての縮小版について {サイズ: URL} を返します"""
+    paths = {str(size): icon_path_for(user_data, size) for size in ICON_SIZES}
+    urls = get_signed_read_urls(paths.values())
+    return {size: urls.get(path, '') for size, path in paths.items()}
+
+def is_own_icon_value(line_user_id, value):
+    """プロフィールに保存するアイコンが空か、本人のアップロードしたオブジェクトのパスかどうか"""
+    return value == '' or (is_storage_path(value) and value.startswith(f"{line_user_id}/"))
+
+# ==============================================================================
+# LINE Notification Dispatch
+# ==============================================================================
+# multicast は1回の呼び出しで最大500人までしか送れないため、宛先をチャンクに分けて並列に送信する。
+# - 送信はトークンバケットでレート制限する (LINE の multicast は 200回/秒まで)
+# - 429 / 5xx / 通信エラーは指数バックオフで再試行する。チャンクごとに X-Line-Retry-Key を固定し、
+#   再試行で二重に届かないようにする (409 は「既に受け付け済み」として成功扱い)
+# - チャンクごとの結果を notification_dispatches に記録する
+LINE_MULTICAST_MAX_RECIPIENTS = 500
+LINE_NOTIFY_WORKERS = int(os.getenv("LINE_NOTIFY_WORKERS", "4"))
+LINE_NOTIFY_RATE_PER_SEC = float(os.getenv("LINE_NOTIFY_RATE_PER_SEC", "100"))
+LINE_NOTIFY_BURST = int(os.getenv("LINE_NOTIFY_BURST", "20"))
+LINE_NOTIFY_MAX_ATTEMPTS = int(os.getenv("LINE_NOTIFY_MAX_ATTEMPTS", "5"))
+LINE_NOTIFY_BACKOFF_BASE = float(os.getenv("LINE_NOTIFY_BACKOFF_BASE", "1.0"))
+LINE_NOTIFY_BACKOFF_MAX = float(os.getenv("LINE_NOTIFY_BACKOFF_MAX", "30"))
+LINE_NOTIFY_HTTP_TIMEOUT = float(os.getenv("LINE_NOTIFY_HTTP_TIMEOUT", "10"))
+
+line_notify_bucket = TokenBucket(LINE_NOTIFY_RATE_PER_SEC, LINE_NOTIFY_BURST)
+line_notify_executor = ThreadPoolExecutor(max_workers=LINE_NOTIFY_WORKERS, thread_name_prefix='line-notify')
+line_notify_stats_lock = threading.Lock()
+line_notify_stats = {'dispatches': 0, 'chunks_sent': 0, 'chunks_failed': 0, 'retries': 0, 'recipients_sent': 0, 'recipients_failed': 0}
+
+def _line_retry_after(e, attempt):
+    """再試行すべきエラーなら待ち秒数を、そうでなければ None を返す"""
+    if isinstance(e, LineBotApiError):
+        if e.status_code != 429 and e.status_code < 500:
+            return None
+        retry_after = (getattr(e, 'headers', None) or {}).get('Retry-After')
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), LINE_NOTIFY_BACKOFF_MAX)
+    elif not isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return None
+    backoff = min(LINE_NOTIFY_BACKOFF_BASE * (2 ** attempt), LINE_NOTIFY_BACKOFF_MAX)
+    return backoff * random.uniform(0.5, 1.0)
+
+def send_multicast_chunk(recipients, messages, retry_key):
+    """1チャンク (最大500人) を送信し、結果を dict で返す"""
+    # retry_key はクライアントのヘッダーに設定されるため、並列送信ではチャンクごとにクライアントを作る
+    api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN, timeout=LINE_NOTIFY_HTTP_TIMEOUT)
+    result = {'size': len(recipients), 'retry_key': retry_key, 'status': 'failed', 'attempts': 0}
+    for attempt in range(LINE_NOTIFY_MAX_ATTEMPTS):
+        line_notify_bucket.take()
+        result['attempts'] = attempt + 1
+        try:
+            api.multicast(recipients, messages, retry_key=retry_key)
+            result['status'] = 'sent'
+            break
+        except LineBotApiError as e:
+            if e.status_code == 409:
+                # 同じ retry_key のリクエストが既に受け付けられている
+                result['status'] = 'sent'
+                break
+            result['status_code'] = e.status_code
+            result['error'] = str(e.error.message if getattr(e, 'error', None) else e)
+            wait = _line_retry_after(e, attempt)
+        except Exception as e:
+            result['error'] = str(e)
+            wait = _line_retry_after(e, attempt)
+
+        if wait is None or attempt + 1 >= LINE_NOTIFY_MAX_ATTEMPTS:
+            break
+        with line_notify_stats_lock:
+            line_notify_stats['retries'] += 1
+        time.sleep(wait)
+
+    if result['status'] == 'sent':
+        result.pop('error', None)
+        result.pop('status_code', None)
+    return result
+
+def multicast_chunks(recipients):
+    """重複と空の宛先を除き、multicast の1回分 (最大500人) ずつに分ける"""
+    recipients = list(dict.fromkeys(r for r in recipients if r))
+    return [recipients[i:i + LINE_MULTICAST_MAX_RECIPIENTS] for i in range(0, len(recipients), LINE_MULTICAST_MAX_RECIPIENTS)]
+
+def multicast_worst_case_seconds(chunk_count):
+    """全チャンクが再試行を使い切った場合の送信時間の上限 (チャンクは LINE_NOTIFY_WORKERS 並列で送る)"""
+    per_chunk = LINE_NOTIFY_MAX_ATTEMPTS * LINE_NOTIFY_HTTP_TIMEOUT + (LINE_NOTIFY_MAX_ATTEMPTS - 1) * LINE_NOTIFY_BACKOFF_MAX
+    rounds = -(-chunk_count // LINE_NOTIFY_WORKERS)
+    return rounds * per_chunk
+
+def dispatch_multicast(recipients, messages, label, context=None, retry_keys=None):
+    """
+    宛先リストをチャンクに分けて並列に multicast し、結果を notification_dispatches に記録します。
+    retry_keys にチャンクごとの X-Line-Retry-Key を渡すと、同じ送信を繰り返しても LINE 側で二重送信が抑止されます。
+    戻り値は {'dispatch_id', 'sent', 'failed', 'chunks'}。
+    """
+    chunks = multicast_chunks(recipients)
+    recipients = [r for chunk in chunks for r in chunk]
+    if not isinstance(messages, list):
+        messages = [messages]
+    if retry_keys is None:
+        retry_keys = [str(uuid.uuid4()) for _ in chunks]
+    elif len(retry_keys) != len(chunks):
+        raise ValueError(f"Expected {len(chunks)} retry keys, got {len(retry_keys)}")
+    dispatch_ref = db.collection('notification_dispatches').document()
+
+    futures = [line_notify_executor.submit(send_multicast_chunk, chunk, messages, retry_key) for chunk, retry_key in zip(chunks, retry_keys)]
+    results = []
+    for index, (chunk, future) in enumerate(zip(chunks, futures)):
+        result = future.result()
+        result['index'] = index
+        if result['status'] != 'sent':
+            # 失敗したチャンクは宛先を残しておき、後から再送できるようにする
+            result['recipients'] = chunk
+        results.append(result)
+
+    sent = sum(r['size'] for r in results if r['status'] == 'sent')
+    failed = len(recipients) - sent
+    with line_notify_stats_lock:
+        line_notify_stats['dispatches'] += 1
+        line_notify_stats['chunks_sent'] += sum(1 for r in results if r['status'] == 'sent')
+        line_notify_stats['chunks_failed'] += sum(1 for r in results if r['status'] != 'sent')
+        line_notify_stats['recipients_sent'] += sent
+        line_notify_stats['recipients_failed'] += failed
+
+    try:
+        dispatch_ref.set({
+            'label': label,
+            'context': context or {},
+            'total_recipients': len(recipients),
+            'sent': sent,
+            'failed': failed,
+            'chunks': results,
+            'created_at': datetime.now().isoformat()
+        })
+    except Exception as e:
+        logger.error(f"Failed to record notification dispatch {label}: {e}")
+
+    if failed:
+        logger.error(f"Notification {label}: {failed}/{len(recipients)} recipients failed (dispatch {dispatch_ref.id})")
+    else:
+        logger.info(f"Notification {label}: sent to {sent} recipients in {len(chunks)} chunks")
+    return {'dispatch_id': dispatch_ref.id, 'sent': sent, 'failed': failed, 'chunks': results}
+
+def get_line_notify_stats():
+    with line_notify_stats_lock:
+        return dict(line_notify_stats)
+
+METRICS_PROVIDERS['line_notifications'] = get_line_notify_stats
+
+# ==============================================================================
+# Notification Outbox
+# ==============================================================================
+# 通知は状態の変更と同じバッチで outbox コレクションに書き込み、バックグラウンドの送信スレッドが配信する。
+# API は1回の書き込みで応答でき、送信に失敗しても outbox に残るので少なくとも1回は配信される。
+# - 送信スレッドは next_attempt_at をリース期限として使い、トランザクションで取得 (claim) する。
+#   送信中にプロセスが落ちても、リースが切れれば再び取得される
+# - クラス全体への通知は、最初の送信時に宛先を解決する
+# - 送信前に宛先とチャンクごとの retry key をエントリに固定し、リースを送信の最悪時間より長く延長する。
+#   再取得や再送では同じチャンクを同じ retry key で送るので、LINE 側で二重送信が抑止される (409)
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "30"))
+OUTBOX_LEASE_SECONDS = int(os.getenv("OUTBOX_LEASE_SECONDS", "120"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "20"))
+
+outbox_wakeup = threading.Event()
+outbox_sender_started = False
+outbox_sender_lock = threading.Lock()
+outbox_worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+outbox_stats_lock = threading.Lock()
+outbox_stats = {'sent': 0, 'retried': 0, 'failed': 0, 'polls': 0}
+
+def enqueue_notification(batch, text, to=None, class_id=None, kind='push', context=None):
+    """
+    batch に outbox への書き込みを追加します (batch のコミット後に wake_outbox_sender() を呼ぶ)。
+    to: 宛先の LINE User ID のリスト / class_id: クラスの生徒全員 (送信時に解決する)
+    """
+    outbox_ref = db.collection('outbox').document()
+    now = datetime.now().isoformat()
+    batch.set(outbox_ref, {
+        'kind': kind,
+        'text': text,
+        'to': list(to or []),
+        'class_id': class_id,
+        'context': context or {},
+        'status': 'pending',
+        'attempts': 0,
+        'next_attempt_at': now,
+        'created_at': now
+    })
+    return outbox_ref
+
+def wake_outbox_sender():
+    start_outbox_sender()
+    outbox_wakeup.set()
+
+def notifications_enabled(user_data):
+    """通知設定 (未設定の場合は有効)"""
+    return (user_data.get('settings') or {}).get('notifications_enabled', True) is not False
+
+def notify_class_ids_for(user_data):
+    """
+    users.notify_class_ids の値。通知を有効にしている生徒の承認済みクラスだけを持たせ、
+    クラスへの通知の宛先を array_contains の1クエリで取得できるようにする。
+    """
+    return list(user_data.get('approved_class_ids', [])) if notifications_enabled(user_data) else []
+
+# backfill-notify-class-ids (デプロイ時に1回だけ実行する移行) が完了すると、
+# app_config/migrations.notify_class_ids_backfilled が True になる。
+# それまでの間だけ、notify_class_ids を持たないユーザーを名簿から補う。
+NOTIFY_INDEX_FLAG_RECHECK_SECONDS = 300
+notify_index_flag = {'ready': False, 'checked_at': None}
+
+def notify_class_index_ready():
+    """notify_class_ids のバックフィルが完了しているか (完了後はプロセス内で覚えておく)"""
+    if notify_index_flag['ready']:
+        return True
+    checked_at = notify_index_flag['checked_at']
+    if checked_at is not None and time.monotonic() - checked_at < NOTIFY_INDEX_FLAG_RECHECK_SECONDS:
+        return False
+    flag_doc = db.collection('app_config').document('migrations').get()
+    notify_index_flag['ready'] = flag_doc.exists and flag_doc.to_dict().get('notify_class_ids_backfilled') is True
+    notify_index_flag['checked_at'] = time.monotonic()
+    return notify_index_flag['ready']
+
+def class_notification_members(class_id):
+    """
+    クラスへの通知を受け取る生徒の LINE User ID のリスト (notify_class_ids の1クエリ)。
+    バックフィルの完了前は、notify_class_ids を持たないユーザーを承認済みクラスと通知設定から補う。
+    """
+    users_ref = db.collection('users')
+    member_ids = [doc.to_dict().get('line_user_id') for doc in users_ref.where(
+        filter=FieldFilter('notify_class_ids', 'array_contains', class_id)
+    ).select(['line_user_id']).stream()]
+    if not notify_class_index_ready():
+        logger.warning("notify_class_ids has not been backfilled yet; scanning the class roster (run 'flask backfill-notify-class-ids')")
+        legacy_docs = users_ref.where(
+            filter=FieldFilter('approved_class_ids', 'array_contains', class_id)
+        ).select(['line_user_id', 'settings', 'notify_class_ids']).stream()
+        for doc in legacy_docs:
+            user_data = doc.to_dict()
+            if 'notify_class_ids' not in user_data and notifications_enabled(user_data):
+                member_ids.append(user_data.get('line_user_id'))
+    return list(dict.fromkeys(uid for uid in member_ids if uid))
+
+def notify_class_ids_update(user_data, add=None, remove=None):
+    """
+    クラスの承認・退会時の notify_class_ids の更新値。フィールドをまだ持たないユーザーに
+    ArrayUnion / ArrayRemove を使うと他のクラスが抜け落ちるため、全体を計算して書き込む。
+    """
+    if 'notify_class_ids' not in user_data:
+        approved = [c for c in user_data.get('approved_class_ids', []) if c != remove]
+        if add and add not in approved:
+            approved.append(add)
+        return notify_class_ids_for(dict(user_data, approved_class_ids=approved))
+    if add:
+        return firestore.ArrayUnion([add])
+    return firestore.ArrayRemove([remove])
+
+def resolve_notification_recipients(outbox_data):
+    """outbox の宛先を LINE User ID のリストにする (クラス宛ては通知を有効にしている生徒だけ)"""
+    if outbox_data.get('to'):
+        return outbox_data['to']
+    if outbox_data.get('class_id'):
+        return class_notification_members(outbox_data['class_id'])
+    return []
+
+@firestore.transactional
+def _claim_outbox_entry(transaction, outbox_ref, now):
+    """送信待ちでリースの切れたエントリを取得し、リースを延長する。取得できなければ None"""
+    snapshot = outbox_ref.get(transaction=transaction)
+    if not snapshot.exists:
+        return None
+    outbox_data = snapshot.to_dict()
+    if outbox_data.get('status') != 'pending' or outbox_data.get('next_attempt_at', '') > now.isoformat():
+        return None
+    transaction.update(outbox_ref, {
+        'next_attempt_at': (now + timedelta(seconds=OUTBOX_LEASE_SECONDS)).isoformat(),
+        'attempts': firestore.Increment(1),
+        'claimed_by': outbox_worker_id
+    })
+    outbox_data['attempts'] = outbox_data.get('attempts', 0) + 1
+    return outbox_data
+
+def prepare_outbox_dispatch(outbox_ref, outbox_data):
+    """
+    宛先とチャンクごとの retry key を outbox に固定し、(宛先, retry_keys) を返します。
+    同時にリースを、全チャンクが再試行を使い切った場合の送信時間より長く延長します。
+    """
+    if outbox_data.get('retry_keys') is not None:
+        recipients = outbox_data.get('to') or []
+        retry_keys = outbox_data['retry_keys']
+    else:
+        chunks = multicast_chunks(resolve_notification_recipients(outbox_data))
+        recipients = [r for chunk in chunks for r in chunk]
+        retry_keys = [str(uuid.uuid4()) for _ in chunks]
+    lease = multicast_worst_case_seconds(len(retry_keys)) + OUTBOX_LEASE_SECONDS
+    outbox_ref.update({
+        'to': recipients,
+        'retry_keys': retry_keys,
+        'next_attempt_at': (datetime.now() + timedelta(seconds=lease)).isoformat()
+    })
+    return recipients, retry_keys
+
+def deliver_outbox_entry(outbox_ref, outbox_data):
+    """1件の通知を配信し、結果を outbox に書き戻す"""
+    try:
+        recipients, retry_keys = prepare_outbox_dispatch(outbox_ref, outbox_data)
+        result = dispatch_multicast(
+            recipients, TextSendMessage(text=outbox_data['text']),
+            label=outbox_data.get('kind', 'push'), context=dict(outbox_data.get('context', {}), outbox_id=outbox_ref.id),
+            retry_keys=retry_keys
+        ) if recipients else {'sent': 0, 'failed': 0, 'chunks': [], 'dispatch_id': None}
+    except Exception as e:
+        logger.error(f"Outbox entry {outbox_ref.id} failed: {e}", exc_info=True)
+        result = None
+
+    if result is not None and not result['failed']:
+        outbox_ref.update({'status': 'sent', 'sent_at': datetime.now().isoformat(), 'dispatch_id': result['dispatch_id'], 'recipient_count': result['sent']})
+        with outbox_stats_lock:
+            outbox_stats['sent'] += 1
+        return
+
+    update = {}
+    if result is not None:
+        # 一部の宛先だけ失敗した場合は、失敗したチャンクだけを同じ retry key で再送する
+        # (満杯でないチャンクは最後の1つだけなので、つなげて分け直しても同じチャンクになる)
+        failed_chunks = [chunk for chunk in result['chunks'] if chunk['status'] != 'sent']
+        update['to'] = [r for chunk in failed_chunks for r in chunk['recipients']]
+        update['retry_keys'] = [chunk['retry_key'] for chunk in failed_chunks]
+        update['last_dispatch_id'] = result['dispatch_id']
+
+    if outbox_data['attempts'] >= OUTBOX_MAX_ATTEMPTS:
+        update['status'] = 'failed'
+        with outbox_stats_lock:
+            outbox_stats['failed'] += 1
+        logger.error(f"Outbox entry {outbox_ref.id} gave up after {outbox_data['attempts']} attempts")
+    else:
+        backoff = min(OUTBOX_POLL_INTERVAL * (2 ** (outbox_data['attempts'] - 1)), 3600)
+        update['next_attempt_at'] = (datetime.now() + timedelta(seconds=backoff)).isoformat()
+        with outbox_stats_lock:
+            outbox_stats['retried'] += 1
+    outbox_ref.update(update)
+
+def drain_outbox():
+    """送信期限の来た outbox のエントリを配信し、処理した件数を返す"""
+    processed = 0
+    while True:
+        now = datetime.now()
+        due_docs = list(db.collection('outbox')
+                        .where(filter=FieldFilter('status', '==', 'pending'))
+                        .where(filter=FieldFilter('next_attempt_at', '<=', now.isoformat()))
+                        .order_by('next_attempt_at')
+                        .limit(OUTBOX_BATCH_SIZE)
+                        .stream())
+        claimed = 0
+        for doc in due_docs:
+            outbox_data = _claim_outbox_entry(db.transaction(), doc.reference, now)
+            if outbox_data:
+                deliver_outbox_entry(doc.reference, outbox_data)
+                claimed += 1
+        processed += claimed
+        if len(due_docs) < OUTBOX_BATCH_SIZE or not claimed:
+            return processed
+
+def outbox_sender_loop():
+    while True:
+        outbox_wakeup.wait(OUTBOX_POLL_INTERVAL)
+        outbox_wakeup.clear()
+        with outbox_stats_lock:
+            outbox_stats['polls'] += 1
+        try:
+            drain_outbox()
+        except Exception as e:
+            logger.error(f"Outbox sender error: {e}", exc_info=True)
+
+def start_outbox_sender():
+    """送信スレッドを (プロセスごとに1回だけ) 起動する"""
+    global outbox_sender_started
+    if outbox_sender_started or not db:
+        return
+    with outbox_sender_lock:
+        if outbox_sender_started:
+            return
+        threading.Thread(target=outbox_sender_loop, name='outbox-sender', daemon=True).start()
+        outbox_sender_started = True
+        # 前回のプロセスで送信されずに残ったエントリをすぐに処理する
+        outbox_wakeup.set()
+        logger.info("Started outbox sender.")
+
+def get_outbox_stats():
+    with outbox_stats_lock:
+        return dict(outbox_stats, worker_id=outbox_worker_id, started=outbox_sender_started)
+
+METRICS_PROVIDERS['outbox'] = get_outbox_stats
+
+# ==============================================================================
+# Assignment Reminders
+# ==============================================================================
+# 課題の期限の REMINDER_HOURS_BEFORE 時間前に、未提出の生徒へリマインドを送る。
+# - リマインドは reminders/{assignment_id}_{hours}h に保存し、プロセス内では発火時刻順のヒープで待つ
+#   (再起動時や他のプロセスが作成した分は Firestore から読み直す)
+# - 発火時に「通知を有効にしている生徒」から submission_status の提出済み生徒を除いた宛先を計算する
+# - 状態の更新と outbox への書き込みを同じトランザクションで行うので、複数プロセスでも二重送信しない
+REMINDER_HOURS_BEFORE = [int(h) for h in os.getenv("REMINDER_HOURS_BEFORE", "24").split(',') if h.strip()]
+REMINDER_RELOAD_INTERVAL = float(os.getenv("REMINDER_RELOAD_INTERVAL", "600"))
+
+def reminder_id_for(assignment_id, hours_before):
+    return f"{assignment_id}_{hours_before}h"
+
+def schedule_assignment_reminders(batch, assignment_id, assignment_data):
+    """課題のリマインドを batch に追加し、[(発火時刻, reminder_id)] を返す"""
+    try:
+        due_date = datetime.fromisoformat(assignment_data['due_date'])
+    except (KeyError, ValueError):
+        return []
+    if due_date.tzinfo:
+        due_date = due_date.astimezone().replace(tzinfo=None)
+
+    scheduled = []
+    for hours_before in REMINDER_HOURS_BEFORE:
+        fire_at = due_date - timedelta(hours=hours_before)
+        if fire_at <= datetime.now():
+            continue
+        reminder_id = reminder_id_for(assignment_id, hours_before)
+        batch.set(db.collection('reminders').document(reminder_id), {
+            'assignment_id': assignment_id,
+            'class_id': assignment_data.get('class_id'),
+            'hours_before': hours_before,
+            'fire_at': fire_at.isoformat(),
+            'status': 'scheduled',
+            'created_at': datetime.now().isoformat()
+        })
+        scheduled.append((fire_at, reminder_id))
+    return scheduled
+
+def reminder_recipients(assignment_id, class_id):
+    """通知を有効にしているクラスの生徒のうち、課題を未提出の生徒"""
+    member_ids = class_notification_members(class_id)
+    submitted_docs = db.collection('submission_status').where(
+        filter=FieldFilter('assignment_id', '==', assignment_id)
+    ).select(['student_line_user_id']).stream()
+    submitted = {doc.to_dict().get('student_line_user_id') for doc in submitted_docs}
+    return [uid for uid in member_ids if uid not in submitted]
+
+@firestore.transactional
+def _commit_reminder(transaction, reminder_ref, update, text=None, recipients=None, context=None):
+    """まだ送信されていなければ、リマインドの状態と outbox への通知を1回で書き込む"""
+    snapshot = reminder_ref.get(transaction=transaction)
+    if not snapshot.exists or snapshot.to_dict().get('status') != 'scheduled':
+        return False
+    if recipients:
+        enqueue_notification(transaction, text, to=recipients, kind='assignment_reminder', context=context)
+    transaction.update(reminder_ref, update)
+    return True
+
+def fire_reminder(reminder_id):
+    """リマインドを送信する。送信済み・取り消し済みの場合は何もしない"""
+    reminder_ref = db.collection('reminders').document(reminder_id)
+    reminder_doc = reminder_ref.get()
+    if not reminder_doc.exists or reminder_doc.to_dict().get('status') != 'scheduled':
+        return False
+    reminder = reminder_doc.to_dict()
+
+    assignment_doc = db.collection('assignments').document(reminder['assignment_id']).get()
+    assignment = assignment_doc.to_dict() if assignment_doc.exists else {}
+    due_date = assignment.get('due_date', '')
+    if not due_date or due_date <= datetime.now().isoformat():
+        return _commit_reminder(db.transaction(), reminder_ref, {'status': 'cancelled', 'updated_at': datetime.now().isoformat()})
+
+    recipients = reminder_recipients(reminder['assignment_id'], reminder['class_id'])
+    try:
+        due_date_formatted = datetime.fromisoformat(due_date).strftime('%m月%d日 %H:%M')
+    except ValueError:
+        due_date_formatted = due_date
+    text = f"【課題のリマインド】\n課題「{assignment.get('title', '')}」の提出期限が近づいています。\n期限: {due_date_formatted}\n\n提出するには「課題提出 {reminder['assignment_id']}」と送ってください。"
+
+    committed = _commit_reminder(db.transaction(), reminder_ref, {
+        'status': 'sent',
+        'recipient_count': len(recipients),
+        'sent_at': datetime.now().isoformat()
+    }, text, recipients, {'assignment_id': reminder['assignment_id'], 'class_id': reminder['class_id']})
+    if committed:
+        wake_outbox_sender()
+        logger.info(f"Reminder {reminder_id} queued for {len(recipients)} students")
+    return committed
+
+
+class ReminderScheduler:
+    """発火時刻順のヒープでリマインドを待ち、時刻になったら fire_reminder を呼ぶ"""
+
+    def __init__(self):
+        self._heap = []
+        self._scheduled = set()
+        self._cond = threading.Condition()
+        self._started = False
+        self._last_reload = 0.0
+        self.stats = {'scheduled': 0, 'fired': 0, 'skipped': 0, 'errors': 0, 'reloads': 0}
+
+    def schedule(self, fire_at, reminder_id):
+        with self._cond:
+            if reminder_id in self._scheduled:
+                return
+            heapq.heappush(self._heap, (fire_at, reminder_id))
+            self._scheduled.add(reminder_id)
+            self.stats['scheduled'] += 1
+            self._cond.notify()
+
+    def reload(self):
+        """Firestore から未送信のリマインドを読み直す (再起動時や他プロセスで作成された分)"""
+        horizon = (datetime.now() + timedelta(seconds=REMINDER_RELOAD_INTERVAL * 2)).isoformat()
+        reminder_docs = db.collection('reminders').where(
+            filter=FieldFilter('status', '==', 'scheduled')
+        ).where(
+            filter=FieldFilter('fire_at', '<=', horizon)
+        ).select(['fire_at']).stream()
+        for doc in reminder_docs:
+            self.schedule(datetime.fromisoformat(doc.to_dict()['fire_at']), doc.id)
+        self._last_reload = time.monotonic()
+        self.stats['reloads'] += 1
+
+    def _next_due(self):
+        """発火時刻の来たリマインドを返す。無ければ次の発火またはリロードまで待つ"""
+        with self._cond:
+            while True:
+                now = datetime.now()
+                if self._heap and self._heap[0][0] <= now:
+                    _, reminder_id = heapq.heappop(self._heap)
+                    self._scheduled.discard(reminder_id)
+                    return reminder_id
+                wait = REMINDER_RELOAD_INTERVAL - (time.monotonic() - self._last_reload)
+                if wait <= 0:
+                    return None
+                if self._heap:
+                    wait = min(wait, (self._heap[0][0] - now).total_seconds())
+                self._cond.wait(wait)
+
+    def run(self):
+        while True:
+            try:
+                if time.monotonic() - self._last_reload >= REMINDER_RELOAD_INTERVAL:
+                    self.reload()
+                reminder_id = self._next_due()
+                if reminder_id is None:
+                    continue
+                if fire_reminder(reminder_id):
+                    self.stats['fired'] += 1
+                else:
+                    self.stats['skipped'] += 1
+            except Exception as e:
+                self.stats['errors'] += 1
+                logger.error(f"Reminder scheduler error: {e}", exc_info=True)
+                time.sleep(5)
+
+    def start(self):
+        """スケジューラのスレッドを (プロセスごとに1回だけ) 起動する"""
+        if self._started or not db:
+            return
+        with self._cond:
+            if self._started:
+                return
+            self._last_reload = time.monotonic() - REMINDER_RELOAD_INTERVAL
+            threading.Thread(target=self.run, name='reminder-scheduler', daemon=True).start()
+            self._started = True
+        logger.info("Started reminder scheduler.")
+
+    def snapshot(self):
+        with self._cond:
+            return dict(self.stats, pending=len(self._heap), next_fire_at=self._heap[0][0].isoformat() if self._heap else None)
+
+
+reminder_scheduler = ReminderScheduler()
+METRICS_PROVIDERS['reminders'] = reminder_scheduler.snapshot
+
+@app.before_request
+def ensure_background_workers():
+    start_outbox_sender()
+    reminder_scheduler.start()
+    start_upload_janitor()
 
 # ==============================================================================
 # LINE Webhook
 # ==============================================================================
+# Webhook は署名検証とイベントのキュー投入だけを行って即座に 200 を返し、
+# Firestore や LINE API を使う実際の処理はワーカースレッドで行う。
+# イベントは送信元ユーザーIDのハッシュでシャード (キュー + ワーカー1つ) に振り分けるため、
+# 同じユーザーのイベントは順番どおりに処理され、異なるユーザーのイベントは並列に処理される。
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+WEBHOOK_WORKERS = max(1, int(os.getenv("WEBHOOK_WORKERS", "4")))
+WEBHOOK_ENQUEUE_TIMEOUT = float(os.getenv("WEBHOOK_ENQUEUE_TIMEOUT", "2"))
+
+webhook_queues = [queue.Queue(maxsize=max(1, WEBHOOK_QUEUE_SIZE // WEBHOOK_WORKERS)) for _ in range(WEBHOOK_WORKERS)]
+webhook_stats = {
+    'enqueued': 0,
+    'processed': 0,
+    'failed': 0,
+    'rejected': 0,
+    'duplicates': 0,
+    'total_queue_seconds': 0.0,
+    'max_queue_seconds': 0.0,
+    'max_event_age_seconds': 0.0,
+}
+webhook_stats_lock = threading.Lock()
+webhook_workers_started = False
+webhook_workers_lock = threading.Lock()
+
+def find_line_event_handler(event):
+    """WebhookHandler.handle と同じ規則で、イベントに対応する @handler.add 関数を探す"""
+    if isinstance(event, MessageEvent):
+        func = handler._handlers.get(f"{event.__class__.__name__}_{event.message.__class__.__name__}")
+        if func:
+            return func
+    return handler._handlers.get(event.__class__.__name__) or handler._default
+
+def process_line_event(event, enqueued_at):
+    """キューから取り出したイベントを1件処理する"""
+    queue_seconds = time.monotonic() - enqueued_at
+    dedup_key = webhook_dedup_key(event)
+    if webhook_dedup_store and dedup_key:
+        try:
+            if not webhook_dedup_store.claim(dedup_key):
+                logger.info(f"Dropping duplicate webhook event {dedup_key} (persistent store).")
+                with webhook_stats_lock:
+                    webhook_stats['duplicates'] += 1
+                return
+        except Exception as e:
+            # 記録に失敗しても、インメモリの判定は済んでいるので処理は続ける
+            logger.error(f"Failed to record webhook event {dedup_key}: {e}")
+
+    # event.timestamp は LINE 側でイベントが発生した時刻 (ミリ秒)
+    event_age = time.time() - event.timestamp / 1000 if getattr(event, 'timestamp', None) else queue_seconds
+    if event_age > 30:
+        logger.warning(f"Processing webhook event {getattr(event, 'webhook_event_id', None)} {event_age:.1f}s after it occurred.")
+
+    func = find_line_event_handler(event)
+    failed = False
+    if func is None:
+        logger.info(f"No handler for webhook event {event.__class__.__name__}")
+    else:
+        try:
+            func(event)
+        except Exception as e:
+            failed = True
+            logger.error(f"Error processing webhook event {getattr(event, 'webhook_event_id', None)}: {e}", exc_info=True)
+
+    with webhook_stats_lock:
+        webhook_stats['failed' if failed else 'processed'] += 1
+        webhook_stats['total_queue_seconds'] += queue_seconds
+        webhook_stats['max_queue_seconds'] = max(webhook_stats['max_queue_seconds'], queue_seconds)
+        webhook_stats['max_event_age_seconds'] = max(webhook_stats['max_event_age_seconds'], event_age)
+
+# LINE はタイムアウト時に同じイベントを再送するため、webhookEventId (なければメッセージID) で重複を除外する。
+# まずプロセス内の TTL 付きキャッシュで O(1) 判定し、必要に応じて SQLite / Firestore にも記録する。
+WEBHOOK_DEDUP_TTL = int(os.getenv("WEBHOOK_DEDUP_TTL", "86400"))
+WEBHOOK_DEDUP_MAX_ENTRIES = int(os.getenv("WEBHOOK_DEDUP_MAX_ENTRIES", "100000"))
+WEBHOOK_DEDUP_PERSIST = os.getenv("WEBHOOK_DEDUP_PERSIST", "")  # '', 'sqlite', 'firestore'
+WEBHOOK_DEDUP_SQLITE_PATH = os.getenv("WEBHOOK_DEDUP_SQLITE_PATH", os.path.join(BASE_DIR, 'webhook_dedup.sqlite3'))
+
+class IdempotencyCache:
+    """TTLと最大件数で制限された、処理済みキーのインメモリ集合"""
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> 有効期限 (挿入順 = 期限順)
+        self._lock = threading.Lock()
+
+    def claim(self, key):
+        """初めて見るキーなら記録して True、処理済みなら False を返す"""
+        now = time.monotonic()
+        with self._lock:
+            while self._entries:
+                oldest_key, expires_at = next(iter(self._entries.items()))
+                if expires_at > now:
+                    break
+                self._entries.popitem(last=False)
+            if key in self._entries:
+                return False
+            self._entries[key] = now + self.ttl
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            return True
+
+    def release(self, key):
+        """処理できなかったキーを取り消し、再送時に処理されるようにする"""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+class SQLiteIdempotencyStore:
+    """プロセス再起動後も重複を検出できるよう、処理済みキーをローカルの SQLite に記録する"""
+
+    def __init__(self, path, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS processed_events (key TEXT PRIMARY KEY, expires_at REAL)")
+
+    def claim(self, key):
+        now = time.time()
+        with self._lock:
+            self._conn.execute("DELETE FROM processed_events WHERE expires_at < ?", (now,))
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO processed_events (key, expires_at) VALUES (?, ?)", (key, now + self.ttl)
+            )
+            return cursor.rowcount == 1
+
+class FirestoreIdempotencyStore:
+    """複数ワーカー・複数サーバー間で重複を検出するため、処理済みキーを Firestore に記録する"""
+
+    def claim(self, key):
+        try:
+            db.collection('processed_webhook_events').document(key).create({
+                'processed_at': datetime.now().isoformat(),
+                'expires_at': datetime.now() + timedelta(seconds=WEBHOOK_DEDUP_TTL)
+            })
+            return True
+        except AlreadyExists:
+            return False
+
+webhook_dedup_cache = IdempotencyCache(WEBHOOK_DEDUP_TTL, WEBHOOK_DEDUP_MAX_ENTRIES)
+webhook_dedup_store = None
+if WEBHOOK_DEDUP_PERSIST == 'sqlite':
+    webhook_dedup_store = SQLiteIdempotencyStore(WEBHOOK_DEDUP_SQLITE_PATH, WEBHOOK_DEDUP_TTL)
+elif WEBHOOK_DEDUP_PERSIST == 'firestore' and db:
+    webhook_dedup_store = FirestoreIdempotencyStore()
+
+def webhook_dedup_key(event):
+    """重複判定に使うキー。webhookEventId がなければメッセージIDを使う"""
+    webhook_event_id = getattr(event, 'webhook_event_id', None)
+    if webhook_event_id:
+        return f"event_{webhook_event_id}"
+    message = getattr(event, 'message', None)
+    if message is not None and getattr(message, 'id', None):
+        return f"message_{message.id}"
+    return None
+
+def webhook_shard_for(event):
+    """イベントの送信元 (ユーザー / グループ / トークルーム) から担当シャードを決める"""
+    source = getattr(event, 'source', None)
+    key = (getattr(source, 'user_id', None) or getattr(source, 'group_id', None)
+           or getattr(source, 'room_id', None) or getattr(event, 'webhook_event_id', None) or '')
+    # hash() はプロセスごとに値が変わるため、安定した crc32 を使う
+    return zlib.crc32(key.encode('utf-8')) % WEBHOOK_WORKERS
+
+def webhook_worker(shard_queue):
+    while True:
+        event, enqueued_at = shard_queue.get()
+        try:
+            process_line_event(event, enqueued_at)
+        finally:
+            shard_queue.task_done()
+
+def start_webhook_workers():
+    """ワーカースレッドを (プロセスごとに1回だけ) 起動する"""
+    global webhook_workers_started
+    if webhook_workers_started:
+        return
+    with webhook_workers_lock:
+        if webhook_workers_started:
+            return
+        for i, shard_queue in enumerate(webhook_queues):
+            threading.Thread(target=webhook_worker, args=(shard_queue,), name=f"webhook-worker-{i}", daemon=True).start()
+        webhook_workers_started = True
+        logger.info(f"Started {WEBHOOK_WORKERS} webhook workers.")
+
+def get_webhook_stats():
+    with webhook_stats_lock:
+        handled = webhook_stats['processed'] + webhook_stats['failed']
+        return dict(
+            webhook_stats,
+            queue_depth=sum(q.qsize() for q in webhook_queues),
+            dedup_cache_size=len(webhook_dedup_cache),
+            shard_depths=[q.qsize() for q in webhook_queues],
+            avg_queue_seconds=webhook_stats['total_queue_seconds'] / handled if handled else 0.0,
+        )
+
+METRICS_PROVIDERS['webhook'] = get_webhook_stats
+
 @app.route("/callback", methods=['POST'])
 def callback():
     signature = request.headers.get('X-Line-Signature')
     body = request.get_data(as_text=True)
 
     try:
-        handler.handle(body, signature)
+        payload = handler.parser.parse(body, signature, as_payload=True)
     except InvalidSignatureError:
         abort(400)
     except Exception as e:
+        logger.error(f"Failed to parse webhook body: {e}")
         abort(500)
 
+    start_webhook_workers()
+    for event in payload.events:
+        dedup_key = webhook_dedup_key(event)
+        if dedup_key and not webhook_dedup_cache.claim(dedup_key):
+            logger.info(f"Dropping duplicate webhook event {dedup_key}.")
+            with webhook_stats_lock:
+                webhook_stats['duplicates'] += 1
+            continue
+        try:
+            webhook_queues[webhook_shard_for(event)].put((event, time.monotonic()), timeout=WEBHOOK_ENQUEUE_TIMEOUT)
+        except queue.Full:
+            # キューが一杯の場合は 503 を返し、LINE の再送に任せる
+            if dedup_key:
+                webhook_dedup_cache.release(dedup_key)
+            with webhook_stats_lock:
+                webhook_stats['rejected'] += 1
+            logger.error("Webhook shard queue is full. Rejecting delivery.")
+            abort(503)
+        with webhook_stats_lock:
+            webhook_stats['enqueued'] += 1
+
     return 'OK', 200
 
+# ------------------------------------------------------------------------------
+# LINE Command Router
+# ------------------------------------------------------------------------------
+# handle_message は受信テキストから I/O なしでルートを決定してから、必要なDBアクセスを行う。
+# - 完全一致コマンドは dict で O(1) 参照する
+# - 前方一致・正規表現のコマンドはコンパイル済みパターンで照合する
+# - 「課題提出中」などのユーザー状態ごとの処理は user_state.action で参照する
+LINE_EXACT_ROUTES = {}
+LINE_PATTERN_ROUTES = []
+LINE_STATE_HANDLERS = {}
+
+def line_command(text=None, pattern=None, requires_user=True, role=None, before_state=True):
+    """
+    LINEのテキストコマンドを登録するデコレータ。
+    text: 完全一致するメッセージ / pattern: 先頭から照合するコンパイル済み正規表現
+    requires_user: False の場合、ユーザー登録チェックより前に実行する (クラス参加など)
+    role: 指定した場合、そのロールのユーザーにだけ適用する
+    before_state: False の場合、進行中のユーザー状態 (課題提出など) の処理を優先する
+    """
+    def decorator(func):
+        route = {'func': func, 'requires_user': requires_user, 'role': role, 'before_state': before_state}
+        if text is not None:
+            LINE_EXACT_ROUTES[text] = route
+        else:
+            LINE_PATTERN_ROUTES.append(dict(route, pattern=pattern))
+        return func
+    return decorator
+
+def line_state_handler(action):
+    """user_state.action が action のときに、通常のメッセージを処理するハンドラを登録する"""
+    def decorator(func):
+        LINE_STATE_HANDLERS[action] = func
+        return func
+    return decorator
+
+def resolve_line_command(text):
+    """メッセージに対応するルートと正規表現のマッチ結果を返す (該当なしは (None, None))"""
+    route = LINE_EXACT_ROUTES.get(text)
+    if route:
+        return route, None
+    for route in LINE_PATTERN_ROUTES:
+        match = route['pattern'].match(text)
+        if match:
+            return route, match
+    return None, None
+
+def reply_text_message(event, text):
+    line_bot_api.reply_message(event.reply_token, TextSendMessage(text=text))
+
 @handler.add(MessageEvent, message=TextMessage)
 def handle_message(event):
     user_id = event.source.user_id
     user_message = event.message.text
-    logger.info(f"Received message from user {user_id}: '{user_message}'")
-
-    user_message_upper = user_message.upper()
-    class_code_to_join = None
-
-    # "join" または "参加" で始まるか、6桁の英数字コードそのものであるかをチェック
-    logger.info(f"Checking message '{user_message_upper}' for join commands.")
-    is_join = user_message_upper.startswith("JOIN ")
-    is_sanka = user_message_upper.startswith("参加 ")
-    is_code_only = bool(re.fullmatch(r'[A-Z0-9]{6}', user_message_upper))
-    logger.info(f"startswith('JOIN '): {is_join}, startswith('参加 '): {is_sanka}, fullmatch(code): {is_code_only}")
-
-    if is_join:
-        class_code_to_join = user_message_upper[5:].strip()
-        logger.info(f"Join command detected. Extracted code: '{class_code_to_join}'")
-    elif is_sanka:
-        class_code_to_join = user_message_upper[3:].strip()
-        logger.info(f"Sanka command detected. Extracted code: '{class_code_to_join}'")
-    elif is_code_only:
-        class_code_to_join = user_message_upper
-        logger.info(f"Code-only message detected: '{class_code_to_join}'")
-
-    if class_code_to_join:
-        logger.info(f"Attempting to join class with code: '{class_code_to_join}' from LINE message.")
-        try:
-            classes_ref = db.collection('classes').where(filter=FieldFilter('class_code', '==', class_code_to_join)).limit(1)
-            class_docs = list(classes_ref.stream())
-            if not class_docs:
-                reply_text = f"無効なクラスコードです: {class_code_to_join}"
-                line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
-                return
-
-            class_doc = class_docs[0]
-            class_data = class_doc.to_dict()
-            class_id = class_doc.id
-            class_name = class_data.get('class_name')
-
-            users_ref = db.collection('users')
-            user_query = users_ref.where(filter=FieldFilter('line_user_id', '==', user_id)).limit(1)
-            user_docs_list = list(user_query.stream())
-
-            user_doc = None
-            user_data = {}
-            if user_docs_list:
-                user_doc = user_docs_list[0]
-                user_data = user_doc.to_dict()
-
-            # 既に参加済み、または申請中かチェック
-            if 'class_memberships' in user_data:
-                for membership in user_data['class_memberships']:
-                    if membership.get('class_id') == class_id:
-                        if membership.get('status') == 'approved':
-                            reply_text = f"既に「{class_name}」に参加しています。"
-                            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
-                            return
-                        elif membership.get('status') == 'pending':
-                            reply_text = "このクラスには既に申請済みです。先生の承認をお待ちください。"
-                            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
-                            return
-
-            new_membership = {
-                'class_id': class_id,
-                'class_name': class_name,
-                'status': 'pending',
-                'requested_at': datetime.now().isoformat()
-            }
-
-            if user_doc:
-                user_doc.reference.update({
-                    'class_memberships': firestore.ArrayUnion([new_membership]),
-                    'pending_class_ids': firestore.ArrayUnion([class_id])
-                })
-            else:
-                profile = line_bot_api.get_profile(user_id)
-                display_name = profile.display_name
-                new_user_data = {
-                    'line_user_id': user_id, 'name': display_name, 'role': 'student',
-                    'is_registered': True, 'created_at': datetime.now().isoformat(),
-                    'class_memberships': [new_membership], 'pending_class_ids': [class_id]
-                }
-                users_ref.add(new_user_data)
-
-            reply_text = f"クラス「{class_name}」への参加を申請しました。先生の承認をお待ちください。"
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
-            return
-
-        except Exception as e:
-            logger.error(f"join_class from LINE message error for user {user_id} with code {class_code_to_join}: {e}", exc_info=True)
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="クラス参加中にエラーが発生しました。"))
-            return
-    else:
-        logger.info("Message is not a join command. Proceeding to other handlers.")
+    route, match = resolve_line_command(user_message)
+    logger.info(f"Received message from user {user_id} (route: {route['func'].__name__ if route else 'text'})")
 
     if not db:
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text="エラー：サーバーがデータベースに接続できませんでした。"))
+        reply_text_message(event, "エラー：サーバーがデータベースに接続できませんでした。")
         return
 
-    create_user_if_not_exists(user_id)
-
-    user_doc_ref = db.collection('users').where(filter=FieldFilter('line_user_id', '==', user_id)).limit(1)
-    user_docs = list(user_doc_ref.get())
-    user_data = {}
-    if user_docs:
-        user_data = user_docs[0].to_dict()
+    ctx = {'user_id': user_id, 'text': user_message, 'match': match}
+    if route and not route['requires_user']:
+        route['func'](event, ctx)
+        return
 
+    user_ref, user_data = create_user_if_not_exists(user_id)
     if not user_data.get('is_registered', False):
-        reply_text = "アカウントを作成するには、先生から配布されるQRコードをスキャンしてクラスに参加してください。"
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
+        reply_text_message(event, "アカウントを作成するには、先生から配布されるQRコードをスキャンしてクラスに参加してください。")
         return
+    ctx['user_ref'] = user_ref
+    ctx['user_data'] = user_data
+
+    # ロールが一致しないコマンドは通常のメッセージとして扱う
+    if route and route['role'] and user_data.get('role') != route['role']:
+        route = None
 
-    if user_message == "クラスのページ":
-        reply_text = f"""あなたのクラスページはこちらです。
-line://app/{LIFF_ID_PRIMARY}/class_home"""
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
+    if route and route['before_state']:
+        route['func'](event, ctx)
         return
 
-    elif user_message == "マイページ":
-        reply_text = f"""あなたのマイページはこちらです。
-line://app/{LIFF_ID_PRIMARY}/mypage"""
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
+    # Check user state for ongoing actions
+    user_state = user_data.get('user_state') or {}
+    state_handler = LINE_STATE_HANDLERS.get(user_state.get('action'))
+    if state_handler:
+        state_handler(event, ctx)
         return
 
-    elif user_message == "先生ダッシュボード" and user_data.get('role') == 'teacher':
-        reply_text = f"""先生用ダッシュボードはこちらです。
-line://app/{LIFF_ID_PRIMARY}/teacher_dashboard"""
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
+    if route:
+        route['func'](event, ctx)
         return
 
-    elif user_message == "課題一覧":
-        try:
-            # Get user's approved classes
-            approved_class_ids = [
-                m['class_id'] for m in user_data.get('class_memberships', []) if m.get('status') == 'approved'
-            ]
+    handle_free_text(event, ctx)
 
-            if not approved_class_ids:
-                line_bot_api.reply_message(event.reply_token, TextSendMessage(text="参加中のクラスがありません。"))
-                return
+# "join" または "参加" で始まるか、6桁の英数字コードそのものであるかをチェック
+@line_command(pattern=re.compile(r'(?:JOIN|参加) (?=.*\S)(.*)', re.IGNORECASE | re.DOTALL), requires_user=False)
+@line_command(pattern=re.compile(r'[A-Z0-9]{6}\Z', re.IGNORECASE), requires_user=False)
+def join_class_command(event, ctx):
+    user_id = ctx['user_id']
+    match = ctx['match']
+    class_code_to_join = (match.group(1) if match.groups() else match.group(0)).strip().upper()
+    logger.info(f"Attempting to join class with code: '{class_code_to_join}' from LINE message.")
+    try:
+        classes_ref = db.collection('classes').where(filter=FieldFilter('class_code', '==', class_code_to_join)).limit(1)
+        class_docs = list(classes_ref.stream())
+        if not class_docs:
+            reply_text_message(event, f"無効なクラスコードです: {class_code_to_join}")
+            return
 
-            # For simplicity, let's just use the first approved class for now.
-            # A more advanced implementation would let the user choose or show all.
-            target_class_id = approved_class_ids[0]
+        class_doc = class_docs[0]
+        class_data = class_doc.to_dict()
+        class_id = class_doc.id
+        class_name = class_data.get('class_name')
 
-            # Fetch assignments for the class
-            assignments_ref = db.collection('assignments').where(
-                filter=FieldFilter('class_id', '==', target_class_id)
-            ).order_by('due_date', direction=firestore.Query.ASCENDING)
-            assignments_docs = list(assignments_ref.stream())
+        users_ref = db.collection('users')
+        user_query = users_ref.where(filter=FieldFilter('line_user_id', '==', user_id)).limit(1)
+        user_docs_list = list(user_query.stream())
 
-            if not assignments_docs:
-                line_bot_api.reply_message(event.reply_token, TextSendMessage(text="現在、提出する課題はありません。"))
-                return
+        user_doc = None
+        user_data = {}
+        if user_docs_list:
+            user_doc = user_docs_list[0]
+            user_data = user_doc.to_dict()
 
-            # Fetch user's submissions to filter out completed assignments
-            submissions_ref = db.collection('submissions').where(
-                filter=FieldFilter('student_line_user_id', '==', user_id)
-            )
-            submissions_docs = list(submissions_ref.stream())
-            submitted_assignment_ids = {doc.to_dict().get('assignment_id') for doc in submissions_docs}
+        # 既に参加済み、または申請中かチェック
+        if 'class_memberships' in user_data:
+            for membership in user_data['class_memberships']:
+                if membership.get('class_id') == class_id:
+                    if membership.get('status') == 'approved':
+                        reply_text_message(event, f"既に「{class_name}」に参加しています。")
+                        return
+                    elif membership.get('status') == 'pending':
+                        reply_text_message(event, "このクラスには既に申請済みです。先生の承認をお待ちください。")
+                        return
 
-            pending_assignments = [
-                doc.to_dict() for doc in assignments_docs if doc.id not in submitted_assignment_ids
-            ]
-            
-            now = datetime.now().isoformat()
-            pending_assignments = [a for a in pending_assignments if a.get('due_date', '') > now]
+        new_membership = {
+            'class_id': class_id,
+            'class_name': class_name,
+            'status': 'pending',
+            'requested_at': datetime.now().isoformat()
+        }
+
+        if user_doc:
+            user_doc.reference.update({
+                'class_memberships': firestore.ArrayUnion([new_membership]),
+                'pending_class_ids': firestore.ArrayUnion([class_id])
+            })
+        else:
+            display_name, pending_profile = get_line_display_name(user_id)
+            new_user_data = {
+                'line_user_id': user_id, 'name': display_name, 'role': 'student',
+                'is_registered': True, 'created_at': datetime.now().isoformat(),
+                'class_memberships': [new_membership], 'pending_class_ids': [class_id]
+            }
+            _, new_user_ref = users_ref.add(new_user_data)
+            backfill_display_name(pending_profile, new_user_ref)
 
+        reply_text_message(event, f"クラス「{class_name}」への参加を申請しました。先生の承認をお待ちください。")
 
-            if not pending_assignments:
-                line_bot_api.reply_message(event.reply_token, TextSendMessage(text="提出期限内の未提出課題はありません。"))
-                return
+    except Exception as e:
+        logger.error(f"join_class from LINE message error for user {user_id} with code {class_code_to_join}: {e}", exc_info=True)
+        reply_text_message(event, "クラス参加中にエラーが発生しました。")
+
+@line_command(text="クラスのページ")
+def class_page_command(event, ctx):
+    reply_text_message(event, f"""あなたのクラスページはこちらです。
+line://app/{LIFF_ID_PRIMARY}/class_home""")
+
+@line_command(text="マイページ")
+def mypage_command(event, ctx):
+    reply_text_message(event, f"""あなたのマイページはこちらです。
+line://app/{LIFF_ID_PRIMARY}/mypage""")
+
+@line_command(text="先生ダッシュボード", role='teacher')
+def teacher_dashboard_command(event, ctx):
+    reply_text_message(event, f"""先生用ダッシュボードはこちらです。
+line://app/{LIFF_ID_PRIMARY}/teacher_dashboard""")
+
+@line_command(text="課題一覧")
+def assignment_list_command(event, ctx):
+    user_id = ctx['user_id']
+    user_data = ctx['user_data']
+    try:
+        # Get user's approved classes
+        approved_class_ids = [
+            m['class_id'] for m in user_data.get('class_memberships', []) if m.get('status') == 'approved'
+        ]
 
-            reply_text = "未提出の課題一覧です。\n提出するには「課題提出 [課題ID]」と送ってください。\n\n"
-            for assign in pending_assignments:
-                due_date = datetime.fromisoformat(assign['due_date']).strftime('%Y年%m月%d日 %H:%M')
-                reply_text += f"■ {assign['title']}\n"
-                reply_text += f"ID: {assign['id']}\n"
-                reply_text += f"期限: {due_date}\n\n"
+        if not approved_class_ids:
+            reply_text_message(event, "参加中のクラスがありません。")
+            return
 
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text.strip()))
+        # For simplicity, let's just use the first approved class for now.
+        # A more advanced implementation would let the user choose or show all.
+        target_class_id = approved_class_ids[0]
+
+        # Fetch open assignments for the class (期限切れの課題はクエリで除外する)
+        now = datetime.now().isoformat()
+        assignments_ref = db.collection('assignments').where(
+            filter=FieldFilter('class_id', '==', target_class_id)
+        ).where(
+            filter=FieldFilter('due_date', '>', now)
+        ).order_by('due_date', direction=firestore.Query.ASCENDING)
+        assignments_docs = list(assignments_ref.stream())
+
+        if not assignments_docs:
+            reply_text_message(event, "現在、提出する課題はありません。")
+            return
 
-        except Exception as e:
-            logger.error(f"Error fetching assignments for user {user_id}: {e}", exc_info=True)
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="課題一覧の取得中にエラーが発生しました。"))
-        return
+        # 受付中の課題の提出状況だけを submission_status からまとめて読む
+        status_refs = [
+            db.collection('submission_status').document(submission_status_id(doc.id, user_id)) for doc in assignments_docs
+        ]
+        submitted_assignment_ids = {
+            snapshot.get('assignment_id') for snapshot in db.get_all(status_refs, field_paths=['assignment_id']) if snapshot.exists
+        }
+
+        pending_assignments = [
+            doc.to_dict() for doc in assignments_docs if doc.id not in submitted_assignment_ids
+        ]
+
+        if not pending_assignments:
+            reply_text_message(event, "提出期限内の未提出課題はありません。")
+            return
+
+        reply_text = "未提出の課題一覧です。\n提出するには「課題提出 [課題ID]」と送ってください。\n\n"
+        for assign in pending_assignments:
+            due_date = datetime.fromisoformat(assign['due_date']).strftime('%Y年%m月%d日 %H:%M')
+            reply_text += f"■ {assign['title']}\n"
+            reply_text += f"ID: {assign['id']}\n"
+            reply_text += f"期限: {due_date}\n\n"
 
-    elif user_message == "その他":
-        reply_text = "どの項目を見ますか？"
-        flex_menu = FlexSendMessage(
-            alt_text="メニュー",
-            contents=BubbleContainer(
-                body=BoxComponent(
-                    layout="vertical",
-                    contents=[
-                        BoxComponent(
-                            layout="vertical",
-                            contents=[
-                                BoxComponent(
-                                    layout="horizontal",
-                                    spacing="md",
-                                    contents=[
-                                        ButtonComponent(
-                                            style="primary",
-                                            flex=1,
-                                            action=URIAction(
-                                                label="提出物",
-                                                uri=f"line://app/{LIFF_ID_PRIMARY}/homework"
-                                            )
-                                        ),
-                                        ButtonComponent(
-                                            style="primary",
-                                            flex=1,
-                                            action=URIAction(
-                                                label="自己理解・評価",
-                                                uri=f"line://app/{LIFF_ID_PRIMARY}/score"
-                                            )
+        reply_text_message(event, reply_text.strip())
+
+    except Exception as e:
+        logger.error(f"Error fetching assignments for user {user_id}: {e}", exc_info=True)
+        reply_text_message(event, "課題一覧の取得中にエラーが発生しました。")
+
+@line_command(text="その他")
+def other_menu_command(event, ctx):
+    flex_menu = FlexSendMessage(
+        alt_text="メニュー",
+        contents=BubbleContainer(
+            body=BoxComponent(
+                layout="vertical",
+                contents=[
+                    BoxComponent(
+                        layout="vertical",
+                        contents=[
+                            BoxComponent(
+                                layout="horizontal",
+                                spacing="md",
+                                contents=[
+                                    ButtonComponent(
+                                        style="primary",
+                                        flex=1,
+                                        action=URIAction(
+                                            label="提出物",
+                                            uri=f"line://app/{LIFF_ID_PRIMARY}/homework"
                                         )
-                                    ]
-                                ),
-                                BoxComponent(
-                                    layout="horizontal",
-                                    spacing="md",
-                                    margin="md",
-                                    contents=[
-                                        ButtonComponent(
-                                            style="secondary",
-                                            flex=1,
-                                            action=URIAction(
-                                                label="規約・ルール",
-                                                uri=f"line://app/{LIFF_ID_PRIMARY}/rules"
-                                            )
-                                        ),
-                                        ButtonComponent(
-                                            style="secondary",
-                                            flex=1,
-                                            action=URIAction(
-                                                label="お問い合わせ",
-                                                uri=f"line://app/{LIFF_ID_PRIMARY}/contact"
-                                            )
+                                    ),
+                                    ButtonComponent(
+                                        style="primary",
+                                        flex=1,
+                                        action=URIAction(
+                                            label="自己理解・評価",
+                                            uri=f"line://app/{LIFF_ID_PRIMARY}/score"
                                         )
-                                    ]
-                                )
-                            ]
-                        )
-                    ]
-                )
+                                    )
+                                ]
+                            ),
+                            BoxComponent(
+                                layout="horizontal",
+                                spacing="md",
+                                margin="md",
+                                contents=[
+                                    ButtonComponent(
+                                        style="secondary",
+                                        flex=1,
+                                        action=URIAction(
+                                            label="規約・ルール",
+                                            uri=f"line://app/{LIFF_ID_PRIMARY}/rules"
+                                        )
+                                    ),
+                                    ButtonComponent(
+                                        style="secondary",
+                                        flex=1,
+                                        action=URIAction(
+                                            label="お問い合わせ",
+                                            uri=f"line://app/{LIFF_ID_PRIMARY}/contact"
+                                        )
+                                    )
+                                ]
+                            )
+                        ]
+                    )
+                ]
             )
         )
-        line_bot_api.reply_message(event.reply_token, flex_menu)
-        return
-
-    else:
-        # Check user state for ongoing actions
-        user_state = user_data.get('user_state')
-        if user_state and user_state.get('action') == 'submitting_assignment':
-            assignment_id = user_state.get('assignment_id')
-            assignment_title = user_state.get('assignment_title')
-            
-            try:
-                # Save the submission (text only for now)
-                submission_ref = db.collection('submissions').document()
-                submission_data = {
-                    'id': submission_ref.id,
-                    'assignment_id': assignment_id,
-                    'student_line_user_id': user_id,
-                    'submission_type': 'text',
-                    'content': user_message,
-                    'submitted_at': datetime.now().isoformat()
-                }
-                submission_ref.set(submission_data)
-
-                # Clear user state
-                user_ref = db.collection('users').where(filter=FieldFilter('line_user_id', '==', user_id)).limit(1).get()[0].reference
-                user_ref.update({'user_state': firestore.DELETE_FIELD})
-
-                reply_text = f"課題「{assignment_title}」を提出しました。"
-                line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
+    )
+    line_bot_api.reply_message(event.reply_token, flex_menu)
 
-            except Exception as e:
-                logger.error(f"Error saving submission for user {user_id}: {e}", exc_info=True)
-                line_bot_api.reply_message(event.reply_token, TextSendMessage(text="提出物の保存中にエラーが発生しました。"))
-            return
+@line_state_handler('submitting_assignment')
+def submit_assignment_text(event, ctx):
+    user_id = ctx['user_id']
+    user_state = ctx['user_data'].get('user_state')
+    assignment_id = user_state.get('assignment_id')
+    assignment_title = user_state.get('assignment_title')
 
-        # Check for submission start command
-        submission_match = re.match(r'課題提出\s+([a-zA-Z0-9\-_]+)', user_message)
-        if submission_match:
-            assignment_id = submission_match.group(1)
-            try:
-                # Verify assignment exists and is not past due
-                assignment_ref = db.collection('assignments').document(assignment_id)
-                assignment_doc = assignment_ref.get()
-                if not assignment_doc.exists:
-                    line_bot_api.reply_message(event.reply_token, TextSendMessage(text="指定された課題IDが見つかりません。"))
-                    return
+    try:
+        # Save the submission (text only for now)
+        submission_ref = db.collection('submissions').document()
+        submission_data = {
+            'id': submission_ref.id,
+            'assignment_id': assignment_id,
+            'student_line_user_id': user_id,
+            'submission_type': 'text',
+            'content': ctx['text'],
+            'submitted_at': datetime.now().isoformat()
+        }
+        record_submission(submission_ref, submission_data, user_state.get('class_id'))
 
-                assignment_data = assignment_doc.to_dict()
-                now = datetime.now().isoformat()
-                if assignment_data.get('due_date', '') < now:
-                    line_bot_api.reply_message(event.reply_token, TextSendMessage(text="この課題は提出期限を過ぎています。"))
-                    return
+        # Clear user state
+        ctx['user_ref'].update({'user_state': firestore.DELETE_FIELD})
 
-                # Set user state
-                user_ref = db.collection('users').where(filter=FieldFilter('line_user_id', '==', user_id)).limit(1).get()[0].reference
-                user_ref.update({
-                    'user_state': {
-                        'action': 'submitting_assignment',
-                        'assignment_id': assignment_id,
-                        'assignment_title': assignment_data.get('title')
-                    }
-                })
+        reply_text_message(event, f"課題「{assignment_title}」を提出しました。")
 
-                reply_text = f"課題「{assignment_data.get('title')}」の提出内容を送信してください。テキストまたはファイルを送信できます。"
-                line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
+    except Exception as e:
+        logger.error(f"Error saving submission for user {user_id}: {e}", exc_info=True)
+        reply_text_message(event, "提出物の保存中にエラーが発生しました。")
 
-            except Exception as e:
-                logger.error(f"Error starting assignment submission for user {user_id}: {e}", exc_info=True)
-                line_bot_api.reply_message(event.reply_token, TextSendMessage(text="課題提出の準備中にエラーが発生しました。"))
+@line_command(pattern=re.compile(r'課題提出\s+([a-zA-Z0-9\-_]+)'), before_state=False)
+def start_submission_command(event, ctx):
+    user_id = ctx['user_id']
+    assignment_id = ctx['match'].group(1)
+    try:
+        # Verify assignment exists and is not past due
+        assignment_ref = db.collection('assignments').document(assignment_id)
+        assignment_doc = assignment_ref.get()
+        if not assignment_doc.exists:
+            reply_text_message(event, "指定された課題IDが見つかりません。")
             return
 
-        # 不適切ワードチェック
-        for ng_word in NG_WORDS:
-            if ng_word in user_message:
-                reply_text = f"""不適切な言葉が含まれています。日記は保存されませんでした。
-「{ng_word}」のような言葉は使用しないでください。"""
-                line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
-                return
-        
-        # ユーザードキュメント取得
-        user_docs = db.collection('users').where(filter=FieldFilter('line_user_id', '==', user_id)).limit(1).get()
-        if not user_docs:
-            reply_text = "ユーザー情報が見つかりません。"
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
+        assignment_data = assignment_doc.to_dict()
+        now = datetime.now().isoformat()
+        if assignment_data.get('due_date', '') < now:
+            reply_text_message(event, "この課題は提出期限を過ぎています。")
             return
 
-        user_ref = user_docs[0].reference
-        user_data = user_docs[0].to_dict()
-        
-        # 🟢 「日記を投稿します」モード開始
-        if user_message == "日記を投稿します":
-            user_ref.update({'is_posting_diary': True})
-            user_data['is_posting_diary'] = True  # ←これを追加！
-            reply_text = "📝 次に送るメッセージを日記として保存します。"
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
+        # Set user state
+        ctx['user_ref'].update({
+            'user_state': {
+                'action': 'submitting_assignment',
+                'assignment_id': assignment_id,
+                'assignment_title': assignment_data.get('title'),
+                'class_id': assignment_data.get('class_id')
+            }
+        })
+
+        reply_text_message(event, f"課題「{assignment_data.get('title')}」の提出内容を送信してください。テキストまたはファイルを送信できます。")
+
+    except Exception as e:
+        logger.error(f"Error starting assignment submission for user {user_id}: {e}", exc_info=True)
+        reply_text_message(event, "課題提出の準備中にエラーが発生しました。")
+
+# 🟢 「日記を投稿します」モード開始
+@line_command(text="日記を投稿します", before_state=False)
+def start_diary_command(event, ctx):
+    ctx['user_ref'].update({'is_posting_diary': True})
+    reply_text_message(event, "📝 次に送るメッセージを日記として保存します。")
+
+def handle_free_text(event, ctx):
+    """どのコマンドにも該当しないメッセージ (日記本文など) を処理する"""
+    user_id = ctx['user_id']
+    user_message = ctx['text']
+    user_data = ctx['user_data']
+    user_ref = ctx['user_ref']
+
+    # 不適切ワードチェック
+    for ng_word in NG_WORDS:
+        if ng_word in user_message:
+            reply_text_message(event, f"""不適切な言葉が含まれています。日記は保存されませんでした。
+「{ng_word}」のような言葉は使用しないでください。""")
             return
 
-        # 🟢 投稿モード中なら、次のメッセージを日記として保存
-        if user_data.get('is_posting_diary', False):
-            try:
-                approved_memberships = [m for m in user_data.get('class_memberships', []) if m.get('status') == 'approved']
-
-                target_class_id = None
-                if len(approved_memberships) == 1:
-                    target_class_id = approved_memberships[0].get('class_id')
-                elif len(approved_memberships) > 1:
-                    # 先生の場合、直近で作成したクラスをデフォルトとして使用する
-                    if user_data.get('role') == 'teacher':
-                        classes_ref = db.collection('classes') \
-                            .where(filter=FieldFilter('teacher_line_user_id', '==', user_id)) \
-                            .order_by('created_at', direction=firestore.Query.DESCENDING) \
-                            .limit(1)
-                        class_docs = list(classes_ref.stream())
-                        if class_docs:
-                            target_class_id = class_docs[0].id
-                    else:
-                        reply_text = "複数のクラスに参加しています。日記を投稿するクラスをWebアプリのクラスホーム画面で選択してから投稿してください。"
-                        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
-                        return
+    # 🟢 投稿モード中なら、次のメッセージを日記として保存
+    if user_data.get('is_posting_diary', False):
+        try:
+            approved_memberships = [m for m in user_data.get('class_memberships', []) if m.get('status') == 'approved']
 
-                if not target_class_id:
-                    reply_text = "参加が承認されたクラスがありません。日記を投稿できません。"
-                    line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
+            target_class_id = None
+            if len(approved_memberships) == 1:
+                target_class_id = approved_memberships[0].get('class_id')
+            elif len(approved_memberships) > 1:
+                # 先生の場合、直近で作成したクラスをデフォルトとして使用する
+                if user_data.get('role') == 'teacher':
+                    classes_ref = db.collection('classes') \
+                        .where(filter=FieldFilter('teacher_line_user_id', '==', user_id)) \
+                        .order_by('created_at', direction=firestore.Query.DESCENDING) \
+                        .limit(1)
+                    class_docs = list(classes_ref.stream())
+                    if class_docs:
+                        target_class_id = class_docs[0].id
+                else:
+                    reply_text = "複数のクラスに参加しています。日記を投稿するクラスをWebアプリのクラスホーム画面で選択してから投稿してください。"
+                    reply_text_message(event, reply_text)
                     return
 
-                # Firestoreに日記を保存
-                diary_data = {
-                    'user_id': user_id,
-                    'content': user_message,
-                    'class_id': target_class_id, # class_join_tokenからclass_idに変更
-                    'created_at': datetime.now().isoformat()
-                }
-                db.collection('diaries').add(diary_data)
-
-                # 投稿モードを終了
-                user_ref.update({'is_posting_diary': False})
+            if not target_class_id:
+                reply_text = "参加が承認されたクラスがありません。日記を投稿できません。"
+                reply_text_message(event, reply_text)
+                return
 
-                reply_text = """✅ 日記を保存しました！
+            # Firestoreに日記を保存 (統計の更新と投稿モードの終了も同じバッチで行う)
+            diary_data = {
+                'user_id': user_id,
+                'content': user_message,
+                'class_id': target_class_id, # class_join_tokenからclass_idに変更
+                'created_at': datetime.now().isoformat()
+            }
+            batch = db.batch()
+            batch.set(db.collection('diaries').document(), diary_data)
+            stats_recorded = record_diary_stats(batch, user_id, user_message, diary_data['created_at'])
+            batch.update(user_ref, {'is_posting_diary': False})
+            batch.commit()
+            if not stats_recorded:
+                # デプロイ後初めての投稿: 過去の日記も含めて統計を作り直す
+                try:
+                    rebuild_user_stats(user_id)
+                except Exception as e:
+                    logger.warning(f"Failed to seed user_stats for {user_id}; it will be rebuilt on next read: {e}")
+
+            reply_text = """✅ 日記を保存しました！
 また投稿するときは「日記を投稿します」と送ってください。"""
-                logger.info(f"Diary saved for user {user_id} in class {target_class_id}.")
-            except Exception as e:
-                logger.error(f"Failed to save diary for user {user_id}: {e}")
-                reply_text = "日記の保存に失敗しました。もう一度お試しください。"
+            logger.info(f"Diary saved for user {user_id} in class {target_class_id}.")
+        except Exception as e:
+            logger.error(f"Failed to save diary for user {user_id}: {e}")
+            reply_text = "日記の保存に失敗しました。もう一度お試しください。"
 
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
-            return
+        reply_text_message(event, reply_text)
 
-        # ⚪️ それ以外の通常メッセージ
-        else:
-            reply_text = """📘 コマンドが認識されませんでした。
-「日記を投稿します」と送ってみてください。"""
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
-            return
+    # ⚪️ それ以外の通常メッセージ
+    else:
+        reply_text_message(event, """📘 コマンドが認識されませんでした。
+「日記を投稿します」と送ってみてください。""")
 
 @handler.add(MessageEvent, message=[ImageMessage, VideoMessage, AudioMessage, FileMessage])
 def handle_content_message(event):
@@ -607,72 +2497,423 @@ def handle_content_message(event):
         # Or handle as an error
         return
 
-    user_ref = user_docs[0].reference
-    user_data = user_docs[0].to_dict()
-    user_state = user_data.get('user_state')
+    user_ref = user_docs[0].reference
+    user_data = user_docs[0].to_dict()
+    user_state = user_data.get('user_state')
+
+    if user_state and user_state.get('action') == 'submitting_assignment':
+        assignment_id = user_state.get('assignment_id')
+        assignment_title = user_state.get('assignment_title')
+
+        try:
+            message_content = line_bot_api.get_message_content(event.message.id)
+
+            filename = ''
+            if isinstance(event.message, FileMessage):
+                filename = event.message.file_name
+
+            # 先頭のバイト列 (マジックバイト) を覗いてコンテンツタイプと拡張子を決める
+            stream = ChunkStream(message_content.iter_content(chunk_size=LINE_CONTENT_CHUNK_SIZE))
+            declared_type = message_content.content_type or DEFAULT_MESSAGE_CONTENT_TYPES.get(event.message.__class__.__name__)
+            content_type, file_extension = resolve_content_type(stream.peek(SNIFF_HEADER_SIZE), declared_type, filename)
+
+            # Stream straight to Firebase Storage (一時ファイルを使わない)
+            # 同じ内容のファイルが保存済みならアップロードせずに参照だけを追加する
+            storage_path, content_sha256, deduplicated = store_content_addressed(stream, content_type)
+            if deduplicated:
+                logger.info(f"Submission from {user_id} for {assignment_id} deduplicated ({content_sha256})")
+
+            # Save submission record to Firestore
+            try:
+                record_file_submission(
+                    assignment_id, user_id, storage_path, filename or f"{content_sha256[:12]}{file_extension}",
+                    content_sha256, user_state.get('class_id')
+                )
+            except Exception:
+                # 提出を登録できなかったので、store_content_addressed で追加した参照を戻す
+                try:
+                    release_file_object(content_sha256)
+                except Exception as release_error:
+                    logger.error(f"Failed to release file object {content_sha256} after a failed submission: {release_error}")
+                raise
+
+            # Clear user state
+            user_ref.update({'user_state': firestore.DELETE_FIELD})
+
+            reply_text = f"課題「{assignment_title}」としてファイルを提出しました。"
+            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
+
+        except Exception as e:
+            logger.error(f"Error saving file submission for user {user_id}: {e}", exc_info=True)
+            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="ファイル提出の処理中にエラーが発生しました。"))
+        return
+
+# ==============================================================================
+# Account Deletion
+# ==============================================================================
+# アカウント削除はバックグラウンドのジョブで行い、進捗を deletion_jobs/{line_user_id} に記録する。
+# - 関連コレクションはページ単位で取得し、500件以下のバッチに分けて並列にコミットする
+# - Storage のオブジェクトはスレッドプールで並列に削除する
+# - 削除済みのドキュメントは次のクエリに現れないため、途中で落ちても最初からやり直せば続きから再開できる
+# - 提出物のファイル参照と Storage のパスは、ドキュメントを削除するのと同じバッチで
+#   deletion_jobs/{line_user_id}/pending_files/ に記録し、記録ごとに解放・削除してから記録を消す。
+#   参照の解放は記録の削除と同じトランザクションで行うので、再開しても二重に減らすことはない
+# - 解放や削除に失敗した記録が残っている場合、ジョブは failed になり resume-deletions で再開される
+FIRESTORE_BATCH_LIMIT = 500
+DELETION_PAGE_SIZE = int(os.getenv("DELETION_PAGE_SIZE", "2000"))
+DELETION_STALE_SECONDS = int(os.getenv("DELETION_STALE_SECONDS", "300"))
+
+# (コレクション, ユーザーを示すフィールド) の順に削除する。ユーザードキュメント自体は最後に削除する。
+DELETION_STEPS = [
+    ('diaries', 'user_id'),
+    ('comments', 'user_id'),
+    ('likes', 'user_id'),
+    ('submissions', 'student_line_user_id'),
+    ('submission_status', 'student_line_user_id'),
+    ('pending_uploads', 'owner_line_user_id'),
+]
+
+deletion_executor = ThreadPoolExecutor(max_workers=int(os.getenv("DELETION_JOB_WORKERS", "2")), thread_name_prefix='deletion-job')
+deletion_io_executor = ThreadPoolExecutor(max_workers=int(os.getenv("DELETION_IO_WORKERS", "8")), thread_name_prefix='deletion-io')
+active_deletion_jobs = set()
+active_deletion_jobs_lock = threading.Lock()
+
+def storage_path_from_url(url):
+    """旧形式の公開URLから、このバケット内のオブジェクトパスを取り出します (該当しない場合は None)"""
+    prefix = f"https://storage.googleapis.com/{bucket.name}/"
+    if url and url.startswith(prefix):
+        return unquote(url[len(prefix):])
+    return None
+
+def commit_deletes_in_batches(refs, records=None):
+    """
+    ドキュメントを500件以下のバッチに分けて並列に削除し、削除件数を返します。
+    records に {削除するref: (記録先のref, data)} を渡すと、削除と同じバッチで記録を書き込みます。
+    """
+    records = records or {}
+
+    def commit(chunk):
+        batch = db.batch()
+        for ref in chunk:
+            batch.delete(ref)
+            if ref in records:
+                batch.set(*records[ref])
+        batch.commit()
+        return len(chunk)
+
+    chunks = []
+    chunk, writes = [], 0
+    for ref in refs:
+        ref_writes = 2 if ref in records else 1
+        if writes + ref_writes > FIRESTORE_BATCH_LIMIT:
+            chunks.append(chunk)
+            chunk, writes = [], 0
+        chunk.append(ref)
+        writes += ref_writes
+    if chunk:
+        chunks.append(chunk)
+    return sum(deletion_io_executor.map(commit, chunks))
+
+def delete_blobs_in_parallel(paths):
+    """
+    Storage のオブジェクトを並列に削除し、(削除できた件数, 失敗した件数) を返します。
+    既に存在しないオブジェクトは削除済みとして数えません (失敗にもしません)。
+    """
+    def delete(path):
+        try:
+            bucket.blob(path).delete()
+            return 1, 0
+        except NotFound:
+            return 0, 0
+        except Exception as e:
+            logger.warning(f"Failed to delete blob {path}: {e}")
+            return 0, 1
+
+    results = list(deletion_io_executor.map(delete, paths))
+    return sum(r[0] for r in results), sum(r[1] for r in results)
+
+@firestore.transactional
+def _release_pending_file(transaction, record_ref, file_ref):
+    """記録されたファイル参照を解放して記録を消す (記録が無ければ解放済みとして None)"""
+    if not record_ref.get(transaction=transaction).exists:
+        return None
+    storage_path = _decrement_file_reference(transaction, file_ref)
+    transaction.delete(record_ref)
+    return storage_path
+
+def flush_pending_files(job_ref):
+    """
+    ジョブに記録されたファイル参照の解放と Storage の削除を行い、(削除したオブジェクト数, 失敗した件数) を返します。
+    失敗した記録は残るので、ジョブの再開時にもう一度処理されます。
+    """
+    def process(record_doc):
+        record = record_doc.to_dict()
+        try:
+            if record.get('content_sha256'):
+                file_ref = db.collection('file_objects').document(record['content_sha256'])
+                storage_path = _release_pending_file(db.transaction(), record_doc.reference, file_ref)
+                if storage_path:
+                    _finish_file_object_delete(file_ref, storage_path)
+                return (1 if storage_path else 0), 0
+            deleted = 0
+            try:
+                bucket.blob(record['storage_path']).delete()
+                deleted = 1
+            except NotFound:
+                pass
+            record_doc.reference.delete()
+            return deleted, 0
+        except Exception as e:
+            logger.warning(f"Failed to release pending file {record_doc.id} of deletion job {job_ref.id}: {e}")
+            return 0, 1
+
+    deleted = failures = 0
+    query = job_ref.collection('pending_files').limit(DELETION_PAGE_SIZE)
+    while True:
+        records = list(query.stream())
+        if not records:
+            break
+        for record_deleted, record_failed in deletion_io_executor.map(process, records):
+            deleted += record_deleted
+            failures += record_failed
+        if failures:
+            break
+    return deleted, failures
+
+def _update_deletion_job(job_ref, **fields):
+    fields['updated_at'] = datetime.now().isoformat()
+    job_ref.set(fields, merge=True)
+
+def run_deletion_job(line_user_id):
+    """アカウント削除ジョブを実行する (途中で中断されたジョブの再開にも使う)"""
+    with active_deletion_jobs_lock:
+        if line_user_id in active_deletion_jobs:
+            return
+        active_deletion_jobs.add(line_user_id)
+
+    job_ref = db.collection('deletion_jobs').document(line_user_id)
+    try:
+        _update_deletion_job(job_ref, status='running', error=firestore.DELETE_FIELD)
+
+        def flush_pending():
+            blobs_deleted, failures = flush_pending_files(job_ref)
+            _update_deletion_job(job_ref, deleted={'blobs': firestore.Increment(blobs_deleted)})
+            if failures:
+                raise RuntimeError(f"{failures} file releases or storage deletions failed")
+
+        # 前回の実行で記録したまま処理できなかったファイルを先に片付ける
+        flush_pending()
+
+        for collection_name, field in DELETION_STEPS:
+            _update_deletion_job(job_ref, phase=collection_name)
+            query = db.collection(collection_name).where(filter=FieldFilter(field, '==', line_user_id))
+            if collection_name == 'submissions':
+                query = query.select(['storage_path', 'content', 'content_sha256'])
+            elif collection_name == 'pending_uploads':
+                query = query.select(['storage_path', 'status'])
+            else:
+                query = query.select([])
+
+            while True:
+                docs = list(query.limit(DELETION_PAGE_SIZE).stream())
+                if not docs:
+                    break
+
+                # ドキュメントを消すと参照先が分からなくなるので、同じバッチでジョブに記録する
+                records = {}
+                for doc in docs:
+                    data = doc.to_dict() or {}
+                    record = None
+                    if data.get('content_sha256'):
+                        record = {'content_sha256': data['content_sha256']}
+                    elif collection_name == 'submissions':
+                        path = data.get('storage_path') or storage_path_from_url(data.get('content', ''))
+                        if path:
+                            record = {'storage_path': path}
+                    elif collection_name == 'pending_uploads' and data.get('status') != 'finalized' and data.get('storage_path'):
+                        record = {'storage_path': data['storage_path']}
+                    if record:
+                        records[doc.reference] = (job_ref.collection('pending_files').document(f"{collection_name}_{doc.id}"), record)
+
+                deleted = commit_deletes_in_batches([doc.reference for doc in docs], records)
+                _update_deletion_job(job_ref, deleted={collection_name: firestore.Increment(deleted)})
+                flush_pending()
+
+        # アイコンなど、ユーザーのプレフィックス以下のオブジェクト
+        _update_deletion_job(job_ref, phase='storage')
+        while True:
+            paths = [blob.name for blob in bucket.list_blobs(prefix=f"{line_user_id}/", max_results=DELETION_PAGE_SIZE)] if bucket else []
+            if not paths:
+                break
+            blobs_deleted, failures = delete_blobs_in_parallel(paths)
+            _update_deletion_job(job_ref, deleted={'blobs': firestore.Increment(blobs_deleted)})
+            if failures:
+                raise RuntimeError(f"Could not delete {failures} storage objects under {line_user_id}/")
+
+        _update_deletion_job(job_ref, phase='user')
+        user_refs = [doc.reference for doc in db.collection('users').where(filter=FieldFilter('line_user_id', '==', line_user_id)).select([]).stream()]
+        commit_deletes_in_batches(user_refs + [db.collection('user_stats').document(line_user_id)])
+
+        _update_deletion_job(job_ref, status='completed', phase=firestore.DELETE_FIELD, completed_at=datetime.now().isoformat())
+        logger.info(f"Successfully deleted account and all data for user {line_user_id}")
+
+    except Exception as e:
+        logger.error(f"Account deletion job for user {line_user_id} failed: {e}", exc_info=True)
+        _update_deletion_job(job_ref, status='failed', error=str(e))
+    finally:
+        with active_deletion_jobs_lock:
+            active_deletion_jobs.discard(line_user_id)
+
+def start_deletion_job(line_user_id):
+    deletion_executor.submit(run_deletion_job, line_user_id)
 
-    if user_state and user_state.get('action') == 'submitting_assignment':
-        assignment_id = user_state.get('assignment_id')
-        assignment_title = user_state.get('assignment_title')
+def is_deletion_job_stale(job_data):
+    """実行中のまま一定時間更新されていない (プロセスが落ちた) ジョブかどうか"""
+    if job_data.get('status') not in ('pending', 'running'):
+        return False
+    updated_at = job_data.get('updated_at', '')
+    return updated_at < (datetime.now() - timedelta(seconds=DELETION_STALE_SECONDS)).isoformat()
 
-        try:
-            message_content = line_bot_api.get_message_content(event.message.id)
-            
-            with tempfile.NamedTemporaryFile(delete=False) as tf:
-                for chunk in message_content.iter_content():
-                    tf.write(chunk)
-                temp_path = tf.name
-
-            # Upload to Firebase Storage
-            file_extension = ''
-            filename = ''
-            if isinstance(event.message, FileMessage):
-                filename = event.message.file_name
-                file_extension = os.path.splitext(filename)[1]
-
-            unique_filename = f"submissions/{assignment_id}/{user_id}_{datetime.now().strftime('%Y%m%d%H%M%S')}{file_extension}"
-            blob = bucket.blob(unique_filename)
-            
-            content_type = None
-            if isinstance(event.message, ImageMessage):
-                content_type = 'image/jpeg' # Assuming jpeg, but could be other types
-            elif isinstance(event.message, VideoMessage):
-                content_type = 'video/mp4'
-            elif isinstance(event.message, AudioMessage):
-                content_type = 'audio/mp3'
-            elif hasattr(event.message, 'file_name'):
-                 # For FileMessage, try to guess from extension
-                 pass # No easy way to get content type from sdk
-
-            blob.upload_from_filename(temp_path) # Let Firebase guess content type
-            os.unlink(temp_path)
-
-            blob.make_public()
-            public_url = blob.public_url
+# ==============================================================================
+# Submission Export
+# ==============================================================================
+# 提出ファイルを ZIP にまとめてストリーミングで返す。
+# - zipfile はシーク不可能な出力にも書ける (データディスクリプタを使う) ので、書かれたバイト列をそのまま送信する
+# - 次の ZIP_PREFETCH_BLOBS 件のファイルは別スレッドで先読みする。先読みはチャンク数の上限付きキューに
+#   入れるため、メモリ使用量はファイルサイズによらず一定になる
+# - 提出ファイルの多くは圧縮済み (JPEG / MP4 など) なので無圧縮で格納し、manifest.csv だけを圧縮する
+# - manifest.csv の生徒が入力した値は、Excel で数式として実行されないようにエスケープする
+CSV_FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+ZIP_CHUNK_SIZE = 1024 * 1024
+ZIP_PREFETCH_BLOBS = int(os.getenv("ZIP_PREFETCH_BLOBS", "2"))
+ZIP_PREFETCH_CHUNKS = int(os.getenv("ZIP_PREFETCH_CHUNKS", "4"))
+ZIP_PREFETCH_PUT_TIMEOUT = 1.0
+
+zip_prefetch_executor = ThreadPoolExecutor(max_workers=max(4, ZIP_PREFETCH_BLOBS * 4), thread_name_prefix='zip-prefetch')
+
+class ZipStreamWriter:
+    """zipfile の出力先。書き込まれたバイト列を溜めておき、drain() で取り出す"""
+
+    def __init__(self):
+        self._parts = []
+        self._position = 0
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
 
-            # Save submission record to Firestore
-            submission_ref = db.collection('submissions').document()
-            submission_data = {
-                'id': submission_ref.id,
-                'assignment_id': assignment_id,
-                'student_line_user_id': user_id,
-                'submission_type': 'file',
-                'content': public_url, # URL to the file
-                'file_name': filename,
-                'submitted_at': datetime.now().isoformat()
-            }
-            submission_ref.set(submission_data)
+    def drain(self):
+        data = b''.join(self._parts)
+        self._parts = []
+        return data
 
-            # Clear user state
-            user_ref.update({'user_state': firestore.DELETE_FIELD})
+def _prefetch_blob(storage_path, chunk_queue, cancelled):
+    """Storage のオブジェクトをチャンクに分けてキューに入れる。終端は None、失敗時は例外を入れる"""
+    def put(item):
+        while not cancelled.is_set():
+            try:
+                chunk_queue.put(item, timeout=ZIP_PREFETCH_PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                continue
+        return False
 
-            reply_text = f"課題「{assignment_title}」としてファイルを提出しました。"
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
+    try:
+        with bucket.blob(storage_path).open('rb', chunk_size=ZIP_CHUNK_SIZE) as source:
+            for chunk in iter(lambda: source.read(ZIP_CHUNK_SIZE), b''):
+                if not put(chunk):
+                    return
+        put(None)
+    except Exception as e:
+        put(e)
+
+def zip_entry_name(used_names, *parts):
+    """ZIP 内で重複しない安全なファイル名を作る"""
+    name = '_'.join(re.sub(r'[\\/:*?"<>|\s]+', '_', str(part)).strip('_') for part in parts if part)
+    base, extension = os.path.splitext(name)
+    candidate = name
+    counter = 2
+    while candidate in used_names:
+        candidate = f"{base}_{counter}{extension}"
+        counter += 1
+    used_names.add(candidate)
+    return candidate
+
+def csv_safe_cell(value):
+    """表計算ソフトで数式として解釈される値の先頭に ' を付ける"""
+    if isinstance(value, str) and value.startswith(CSV_FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+def generate_submissions_zip(file_entries, manifest_rows):
+    """
+    file_entries: [(ZIP内のファイル名, storage_path)] / manifest_rows: manifest.csv の行
+    ZIP のバイト列を順に yield するジェネレータ。
+    読み込めなかったファイルは <ファイル名>.error.txt として別に格納し、manifest の error 列に記録する。
+    """
+    writer = ZipStreamWriter()
+    cancelled = threading.Event()
+    prefetching = deque()
+    remaining = iter(file_entries)
+    failures = {}
+    missing = set()
+
+    def start_next():
+        entry = next(remaining, None)
+        if entry is not None:
+            chunk_queue = queue.Queue(maxsize=ZIP_PREFETCH_CHUNKS)
+            zip_prefetch_executor.submit(_prefetch_blob, entry[1], chunk_queue, cancelled)
+            prefetching.append((entry, chunk_queue))
 
-        except Exception as e:
-            logger.error(f"Error saving file submission for user {user_id}: {e}", exc_info=True)
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="ファイル提出の処理中にエラーが発生しました。"))
-        return
+    try:
+        for _ in range(ZIP_PREFETCH_BLOBS + 1):
+            start_next()
+
+        with zipfile.ZipFile(writer, mode='w', compression=zipfile.ZIP_STORED) as archive:
+            while prefetching:
+                (arcname, storage_path), chunk_queue = prefetching.popleft()
+                start_next()
+                # 最初から読めないファイルは空のエントリを作らず、エラーファイルだけを格納する
+                chunk = chunk_queue.get()
+                if isinstance(chunk, Exception):
+                    missing.add(arcname)
+                else:
+                    with archive.open(arcname, mode='w', force_zip64=True) as destination:
+                        while chunk is not None and not isinstance(chunk, Exception):
+                            destination.write(chunk)
+                            yield writer.drain()
+                            chunk = chunk_queue.get()
+                if isinstance(chunk, Exception):
+                    logger.error(f"Failed to read {storage_path} for ZIP export: {chunk}")
+                    error_name = f"{arcname}.error.txt"
+                    archive.writestr(error_name, f"ファイルを取得できませんでした: {storage_path}\n{chunk}\n")
+                    failures[arcname] = error_name
+                yield writer.drain()
+
+            manifest = io.StringIO()
+            csv_writer = csv.writer(manifest)
+            csv_writer.writerow(['student_name', 'student_line_user_id', 'submission_type', 'submitted_at', 'file_in_zip', 'content', 'error'])
+            for row in manifest_rows:
+                arcname, error = row[4], ''
+                if arcname in failures:
+                    error = f"ファイルを取得できませんでした ({failures[arcname]})"
+                    if arcname in missing:
+                        row = [*row[:4], failures[arcname], *row[5:]]
+                    else:
+                        error += " ※ZIP内のファイルは途中までです"
+                csv_writer.writerow([csv_safe_cell(value) for value in [*row, error]])
+            # Excel で文字化けしないよう BOM 付き UTF-8 にする
+            archive.writestr('manifest.csv', '\ufeff' + manifest.getvalue(), compress_type=zipfile.ZIP_DEFLATED)
+        yield writer.drain()
+    finally:
+        cancelled.set()
 
 # ==============================================================================
 # API Endpoints
@@ -691,23 +2932,285 @@ def upload_icon(uploader_user_id):
     if icon_file.filename == '':
         return jsonify({"status": "error", "message": "No selected file"}), 400
 
-    try:
-        original_filename = icon_file.filename
-        file_extension = os.path.splitext(original_filename)[1]
-        unique_filename = f"{uploader_user_id}/{datetime.now().strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex}{file_extension}"
+    data = icon_file.stream.read(ICON_MAX_BYTES + 1)
+    if len(data) > ICON_MAX_BYTES:
+        return jsonify({"status": "error", "message": "Icon file is too large"}), 413
 
-        blob = bucket.blob(unique_filename)
-        blob.upload_from_file(icon_file, content_type=icon_file.content_type)
+    # クライアントが申告した content_type ではなく、ファイル先頭のバイト列で形式を判定する
+    content_type, file_extension = sniff_content_type(data[:SNIFF_HEADER_SIZE])
+    if content_type not in ICON_CONTENT_TYPES:
+        return jsonify({"status": "error", "message": "Unsupported image format"}), 400
+
+    try:
+        base_filename = f"{uploader_user_id}/{datetime.now().strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex}"
 
-        blob.make_public()
-        public_url = blob.public_url
+        # 縮小版 (48/96/256px) を作成してそれぞれ保存する
+        icon_path, icon_paths = store_icon(base_filename, data, content_type, file_extension)
 
-        return jsonify({"status": "success", "icon_path": public_url}), 200
+        return jsonify(icon_upload_response(icon_path, icon_paths)), 200
 
     except Exception as e:
         print(f"Error uploading icon: {e}", file=sys.stderr)
         return jsonify({"status": "error", "message": "Failed to upload icon"}), 500
 
+# ------------------------------------------------------------------------------
+# Direct-to-storage uploads
+# ------------------------------------------------------------------------------
+# クライアントは署名付きURL (V4) で Cloud Storage に直接 PUT し、完了後に finalize を呼ぶ。
+# ファイル本体はアプリサーバーを経由しない。
+# ※ ブラウザから PUT するには、バケットに CORS 設定 (PUT / Content-Type, x-goog-content-length-range) が必要。
+SIGNED_UPLOAD_TTL = int(os.getenv("SIGNED_UPLOAD_TTL", "600"))
+SUBMISSION_MAX_BYTES = int(os.getenv("SUBMISSION_MAX_BYTES", str(200 * 1024 * 1024)))
+
+@app.route('/api/uploads/sign', methods=['POST'])
+@token_required
+def sign_upload(line_user_id):
+    """Cloud Storage へ直接アップロードするための署名付きURLを発行する"""
+    if not db or not bucket:
+        return jsonify({"status": "error", "message": "Database or Storage connection failed"}), 500
+
+    data = request.get_json() or {}
+    purpose = data.get('purpose')
+    content_type = (data.get('content_type') or '').split(';')[0].strip().lower()
+    file_name = data.get('file_name', '')
+    try:
+        size = int(data.get('size', 0))
+    except (TypeError, ValueError):
+        return jsonify({"status": "error", "message": "Invalid size"}), 400
+
+    if purpose not in ('icon', 'submission'):
+        return jsonify({"status": "error", "message": "purpose must be 'icon' or 'submission'"}), 400
+    if not content_type:
+        return jsonify({"status": "error", "message": "content_type is required"}), 400
+
+    max_size = ICON_MAX_BYTES if purpose == 'icon' else SUBMISSION_MAX_BYTES
+    if size <= 0 or size > max_size:
+        return jsonify({"status": "error", "message": f"size must be between 1 and {max_size} bytes"}), 400
+
+    upload_id = uuid.uuid4().hex
+    timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+    file_extension = os.path.splitext(file_name)[1] or mimetypes.guess_extension(content_type) or ''
+    assignment_id = None
+    class_id = None
+
+    try:
+        if purpose == 'icon':
+            if content_type not in ICON_CONTENT_TYPES:
+                return jsonify({"status": "error", "message": "Unsupported image format"}), 400
+            storage_path = f"{line_user_id}/{timestamp}_{upload_id}{file_extension}"
+        else:
+            assignment_id = data.get('assignment_id')
+            if not assignment_id:
+                return jsonify({"status": "error", "message": "assignment_id is required"}), 400
+
+            assignment_doc = db.collection('assignments').document(assignment_id).get()
+            if not assignment_doc.exists:
+                return jsonify({"status": "error", "message": "Assignment not found"}), 404
+            assignment_data = assignment_doc.to_dict()
+            if assignment_data.get('due_date', '') < datetime.now().isoformat():
+                return jsonify({"status": "error", "message": "この課題は提出期限を過ぎています。"}), 400
+
+            user_docs = db.collection('users').where(filter=FieldFilter('line_user_id', '==', line_user_id)).limit(1).get()
+            if not user_docs or assignment_data.get('class_id') not in user_docs[0].to_dict().get('approved_class_ids', []):
+                return jsonify({"status": "error", "message": "Unauthorized"}), 403
+
+            storage_path = f"submissions/{assignment_id}/{line_user_id}_{timestamp}_{upload_id}{file_extension}"
+            class_id = assignment_data.get('class_id')
+
+        content_length_range = f"0,{size}"
+        expires_at = datetime.now() + timedelta(seconds=SIGNED_UPLOAD_TTL)
+        upload_url = bucket.blob(storage_path).generate_signed_url(
+            version='v4',
+            expiration=timedelta(seconds=SIGNED_UPLOAD_TTL),
+            method='PUT',
+            content_type=content_type,
+            headers={'x-goog-content-length-range': content_length_range}
+        )
+
+        db.collection('pending_uploads').document(upload_id).set({
+            'owner_line_user_id': line_user_id,
+            'purpose': purpose,
+            'storage_path': storage_path,
+            'content_type': content_type,
+            'max_size': size,
+            'assignment_id': assignment_id,
+            'class_id': class_id,
+            'file_name': file_name,
+            'status': 'pending',
+            'created_at': datetime.now().isoformat(),
+            'expires_at': expires_at.isoformat()
+        })
+
+        return jsonify({
+            "status": "success",
+            "data": {
+                "upload_id": upload_id,
+                "upload_url": upload_url,
+                "method": "PUT",
+                "headers": {
+                    "Content-Type": content_type,
+                    "x-goog-content-length-range": content_length_range
+                },
+                "expires_at": expires_at.isoformat()
+            }
+        }), 200
+
+    except Exception as e:
+        logger.error(f"Error signing upload for user {line_user_id}: {e}", exc_info=True)
+        return jsonify({"status": "error", "message": "Failed to create upload URL"}), 500
+
+@firestore.transactional
+def _claim_pending_upload(transaction, upload_ref, line_user_id):
+    """
+    アップロードが pending なら finalizing に移します。存在しない (または他人の) 場合は None を返し、
+    それ以外は移す前のデータを返すので、呼び出し側は status が 'pending' だったかで取得できたかを判定します。
+    """
+    snapshot = upload_ref.get(transaction=transaction)
+    if not snapshot.exists or snapshot.to_dict().get('owner_line_user_id') != line_user_id:
+        return None
+    upload_data = snapshot.to_dict()
+    if upload_data.get('status') == 'pending':
+        transaction.update(upload_ref, {'status': 'finalizing', 'finalizing_at': datetime.now().isoformat()})
+    return upload_data
+
+@app.route('/api/uploads/<upload_id>/finalize', methods=['POST'])
+@token_required
+def finalize_upload(line_user_id, upload_id):
+    """署名付きURLでアップロードされたファイルを検証し、アイコンまたは提出物として登録する"""
+    if not db or not bucket:
+        return jsonify({"status": "error", "message": "Database or Storage connection failed"}), 500
+
+    upload_ref = db.collection('pending_uploads').document(upload_id)
+    claimed = False
+    try:
+        # 二重クリックやクライアントの再送で同時に呼ばれても、pending -> finalizing に
+        # 移せた1回だけが検証と登録を行う
+        upload_data = _claim_pending_upload(db.transaction(), upload_ref, line_user_id)
+        if upload_data is None:
+            return jsonify({"status": "error", "message": "Upload not found"}), 404
+        if upload_data.get('status') != 'pending':
+            return jsonify({"status": "error", "message": "Upload is already finalized"}), 409
+        claimed = True
+
+        blob = bucket.get_blob(upload_data['storage_path'])
+        if blob is None:
+            upload_ref.update({'status': 'pending'})
+            claimed = False
+            return jsonify({"status": "error", "message": "Uploaded file not found"}), 400
+
+        # 署名は期限前でも、登録の時点で提出期限を過ぎていれば受け付けない
+        if upload_data['purpose'] == 'submission':
+            assignment_doc = db.collection('assignments').document(upload_data['assignment_id']).get()
+            due_date = assignment_doc.to_dict().get('due_date', '') if assignment_doc.exists else ''
+            if not assignment_doc.exists or due_date < datetime.now().isoformat():
+                blob.delete()
+                claimed = False
+                upload_ref.update({'status': 'rejected'})
+                return jsonify({"status": "error", "message": "この課題は提出期限を過ぎています。"}), 400
+
+        # サイズとマジックバイトを検証する (先頭の数十バイトだけを取得)
+        head = blob.download_as_bytes(start=0, end=SNIFF_HEADER_SIZE - 1)
+        content_type, _ = resolve_content_type(head, blob.content_type, upload_data.get('file_name', ''))
+        is_valid = blob.size <= upload_data['max_size']
+        if upload_data['purpose'] == 'icon':
+            is_valid = is_valid and sniff_content_type(head)[0] in ICON_CONTENT_TYPES
+        if not is_valid:
+            blob.delete()
+            claimed = False
+            upload_ref.update({'status': 'rejected'})
+            return jsonify({"status": "error", "message": "Uploaded file failed validation"}), 400
+
+        blob.content_type = content_type
+        blob.cache_control = IMMUTABLE_CACHE_CONTROL
+        blob.patch()
+
+        if upload_data['purpose'] == 'icon':
+            base_filename = os.path.splitext(upload_data['storage_path'])[0]
+            icon_path, icon_paths = store_icon(base_filename, blob.download_as_bytes(), blob.content_type, os.path.splitext(blob.name)[1])
+            claimed = False
+            upload_ref.update({'status': 'finalized', 'finalized_at': datetime.now().isoformat()})
+            return jsonify(icon_upload_response(icon_path, icon_paths)), 200
+
+        submission_data = record_file_submission(
+            upload_data['assignment_id'], line_user_id, blob.name, upload_data.get('file_name', ''),
+            class_id=upload_data.get('class_id')
+        )
+        claimed = False  # 提出は登録済みなので、以降で失敗しても pending には戻さない
+        upload_ref.update({'status': 'finalized', 'finalized_at': datetime.now().isoformat(), 'submission_id': submission_data['id']})
+        return jsonify({"status": "success", "data": with_signed_file_urls([submission_data])[0]}), 201
+
+    except Exception as e:
+        logger.error(f"Error finalizing upload {upload_id} for user {line_user_id}: {e}", exc_info=True)
+        if claimed:
+            # 登録前に失敗した場合は再試行できるように pending に戻す
+            try:
+                upload_ref.update({'status': 'pending'})
+            except Exception as revert_error:
+                logger.error(f"Failed to release upload {upload_id} back to pending: {revert_error}")
+        return jsonify({"status": "error", "message": "Failed to finalize upload"}), 500
+
+# 署名付きURLの期限が切れても finalize されなかったアップロードは、Storage のオブジェクトごと削除する。
+# PUT が期限の直前に始まった場合や finalize の再試行を考慮し、期限から PENDING_UPLOAD_GRACE_SECONDS 後に削除する。
+PENDING_UPLOAD_GRACE_SECONDS = int(os.getenv("PENDING_UPLOAD_GRACE_SECONDS", "3600"))
+PENDING_UPLOAD_CLEANUP_INTERVAL = float(os.getenv("PENDING_UPLOAD_CLEANUP_INTERVAL", "900"))
+
+upload_janitor_started = False
+upload_janitor_lock = threading.Lock()
+
+@firestore.transactional
+def _expire_pending_upload(transaction, upload_ref):
+    """まだ pending なら expired にして True を返す (同時に finalize されたものは削除しない)"""
+    snapshot = upload_ref.get(transaction=transaction)
+    if not snapshot.exists or snapshot.to_dict().get('status') != 'pending':
+        return False
+    transaction.update(upload_ref, {'status': 'expired', 'expired_at': datetime.now().isoformat()})
+    return True
+
+def cleanup_expired_uploads():
+    """期限切れの pending_uploads とそのオブジェクトを削除し、削除した件数を返す"""
+    cutoff = (datetime.now() - timedelta(seconds=PENDING_UPLOAD_GRACE_SECONDS)).isoformat()
+    cleaned = 0
+    while True:
+        expired_docs = list(db.collection('pending_uploads')
+                            .where(filter=FieldFilter('status', '==', 'pending'))
+                            .where(filter=FieldFilter('expires_at', '<', cutoff))
+                            .select(['storage_path'])
+                            .limit(DELETION_PAGE_SIZE)
+                            .stream())
+        if not expired_docs:
+            return cleaned
+        for doc in expired_docs:
+            if not _expire_pending_upload(db.transaction(), doc.reference):
+                continue
+            storage_path = doc.to_dict().get('storage_path')
+            if storage_path:
+                try:
+                    bucket.blob(storage_path).delete()
+                except NotFound:
+                    pass
+            cleaned += 1
+
+def upload_janitor_loop():
+    while True:
+        try:
+            cleaned = cleanup_expired_uploads()
+            if cleaned:
+                logger.info(f"Removed {cleaned} expired pending uploads")
+        except Exception as e:
+            logger.error(f"Pending upload cleanup error: {e}", exc_info=True)
+        time.sleep(PENDING_UPLOAD_CLEANUP_INTERVAL)
+
+def start_upload_janitor():
+    """期限切れアップロードの削除スレッドを (プロセスごとに1回だけ) 起動する"""
+    global upload_janitor_started
+    if upload_janitor_started or not db or not bucket:
+        return
+    with upload_janitor_lock:
+        if upload_janitor_started:
+            return
+        threading.Thread(target=upload_janitor_loop, name='upload-janitor', daemon=True).start()
+        upload_janitor_started = True
+
 @app.route('/api/teacher/classes', methods=['GET'])
 @token_required
 def get_classes(teacher_line_user_id):
@@ -841,8 +3344,7 @@ def join_class(student_line_user_id):
             logger.info(f"User {student_line_user_id} requested to join class {class_name}")
         else:
             # 新規ユーザーの場合は、ユーザー情報も一緒に作成
-            profile = line_bot_api.get_profile(student_line_user_id)
-            display_name = profile.display_name
+            display_name, pending_profile = get_line_display_name(student_line_user_id)
             new_user_data = {
                 'line_user_id': student_line_user_id,
                 'name': display_name,
@@ -852,7 +3354,8 @@ def join_class(student_line_user_id):
                 'class_memberships': [new_membership],
                 'pending_class_ids': [class_id]
             }
-            users_ref.add(new_user_data)
+            _, new_user_ref = users_ref.add(new_user_data)
+            backfill_display_name(pending_profile, new_user_ref)
             logger.info(f"New user {student_line_user_id} created and requested to join class {class_name}")
 
         return jsonify({"status": "success", "message": f"クラス「{class_name}」への参加を申請しました。先生の承認をお待ちください。"}), 200
@@ -868,10 +3371,19 @@ def update_user_profile(line_user_id):
         print("Firestore is not initialized.", file=sys.stderr)
         return jsonify({"status": "error", "message": "Database connection failed"}), 500
 
-    data = request.get_json()
+    data = request.get_json(silent=True) or {}
     name = data.get('name')
     school = data.get('school')
     class_name = data.get('class')
+    icon_path = data.get('icon_path') or ''
+    icon_paths = data.get('icon_paths') or {}
+
+    # アイコンは本人がアップロードしたオブジェクトのパスだけを受け付ける (他人のファイルの署名付きURLを発行させない)
+    if not isinstance(icon_path, str) or not isinstance(icon_paths, dict) \
+            or not all(key in {str(size) for size in ICON_SIZES} and isinstance(value, str) for key, value in icon_paths.items()):
+        return jsonify({"status": "error", "message": "icon_path must be a string and icon_paths a {size: path} object"}), 400
+    if not all(is_own_icon_value(line_user_id, value) for value in [icon_path, *icon_paths.values()]):
+        return jsonify({"status": "error", "message": "Invalid icon path"}), 400
 
     try:
         users_ref = db.collection('users')
@@ -888,7 +3400,9 @@ def update_user_profile(line_user_id):
                 'name': name,
                 'school': school,
                 'class_name': class_name,
-                'icon_path': data.get('icon_path', ''),
+                'icon_path': icon_path,
+                'icon_paths': icon_paths,
+                'icon_urls': firestore.DELETE_FIELD,
                 'is_registered': True,
                 'updated_at': datetime.now().isoformat()
             }
@@ -900,10 +3414,12 @@ def update_user_profile(line_user_id):
                 'name': name,
                 'school': school,
                 'class_name': class_name,
-                'icon_path': data.get('icon_path', ''),
+                'icon_path': icon_path,
+                'icon_paths': icon_paths,
                 'is_registered': True,
                 'role': 'student',
                 'is_posting_diary': False,
+                'notify_class_ids': [],
                 'created_at': datetime.now().isoformat(),
                 'updated_at': datetime.now().isoformat()
             }
@@ -939,7 +3455,10 @@ def get_user_profile(line_user_id):
             response_data = {
                 'name': user_data.get('name', ''),
                 'school': user_data.get('school', ''),
-                'icon_path': user_data.get('icon_path', ''),
+                'icon_path': stored_icon_path(user_data),
+                'icon_paths': user_data.get('icon_paths', {}),
+                'icon_url': get_signed_read_url(user_data.get('icon_path', '')),
+                'icon_urls': icon_urls_for(user_data),
                 'is_registered': is_registered,
                 'role': user_data.get('role', 'student'),
                 'class_memberships': user_data.get('class_memberships', []),
@@ -973,11 +3492,15 @@ def update_user_settings(line_user_id):
             return jsonify({"status": "error", "message": "User not found"}), 404
 
         user_doc_ref = docs[0].reference
+        user_data = docs[0].to_dict()
 
         # Prepare settings update
         settings_update = {}
         if 'notifications_enabled' in data:
             settings_update['settings.notifications_enabled'] = bool(data['notifications_enabled'])
+            # クラス通知の宛先インデックスも合わせて更新する
+            user_data.setdefault('settings', {})['notifications_enabled'] = bool(data['notifications_enabled'])
+            settings_update['notify_class_ids'] = notify_class_ids_for(user_data)
 
         if not settings_update:
             return jsonify({"status": "error", "message": "No valid settings provided"}), 400
@@ -1039,6 +3562,7 @@ def register_teacher(line_user_id):
                 'icon_path': '',
                 'is_registered': True,
                 'is_posting_diary': False,
+                'notify_class_ids': [],
                 'created_at': datetime.now().isoformat(),
                 'updated_at': datetime.now().isoformat()
             }
@@ -1059,54 +3583,53 @@ def delete_user_account(line_user_id):
 
     try:
         # This is a destructive operation. Proceed with caution.
-        # Use a transaction to ensure atomicity if multiple dependent operations are needed.
-
-        # 1. Find the user document
-        users_ref = db.collection('users')
-        user_query = users_ref.where(filter=FieldFilter('line_user_id', '==', line_user_id)).limit(1)
-        user_docs = list(user_query.stream())
-
-        if not user_docs:
+        # 実際の削除はバックグラウンドのジョブで行い、進捗は /api/user/delete/status で確認する
+        job_ref = db.collection('deletion_jobs').document(line_user_id)
+        job_doc = job_ref.get()
+        job_data = job_doc.to_dict() if job_doc.exists else {}
+        if job_data.get('status') in ('pending', 'running') and not is_deletion_job_stale(job_data):
+            return jsonify({"status": "success", "message": "Account deletion in progress", "job": job_data}), 202
+
+        user_query = db.collection('users').where(filter=FieldFilter('line_user_id', '==', line_user_id)).limit(1)
+        if not list(user_query.stream()) and job_data.get('status') != 'failed':
             return jsonify({"status": "error", "message": "User not found"}), 404
 
-        user_doc_ref = user_docs[0].reference
-
-        # Batch delete related data
-        batch = db.batch()
-
-        # 2. Delete user's diaries
-        diaries_query = db.collection('diaries').where(filter=FieldFilter('user_id', '==', line_user_id))
-        for doc in diaries_query.stream():
-            batch.delete(doc.reference)
-
-        # 3. Delete user's comments
-        comments_query = db.collection('comments').where(filter=FieldFilter('user_id', '==', line_user_id))
-        for doc in comments_query.stream():
-            batch.delete(doc.reference)
+        job_data = {
+            'line_user_id': line_user_id,
+            'status': 'pending',
+            'deleted': job_data.get('deleted', {}),
+            'requested_at': job_data.get('requested_at', datetime.now().isoformat()),
+            'updated_at': datetime.now().isoformat()
+        }
+        job_ref.set(job_data)
+        start_deletion_job(line_user_id)
 
-        # 4. Delete user's likes
-        likes_query = db.collection('likes').where(filter=FieldFilter('user_id', '==', line_user_id))
-        for doc in likes_query.stream():
-            batch.delete(doc.reference)
+        return jsonify({"status": "success", "message": "Account deletion started", "job": job_data}), 202
 
-        # 5. Delete the user document itself
-        batch.delete(user_doc_ref)
+    except Exception as e:
+        logger.error(f"Error deleting account for user {line_user_id}: {e}")
+        return jsonify({"status": "error", "message": "Failed to delete account"}), 500
 
-        # Commit the batch
-        batch.commit()
+@app.route('/api/user/delete/status', methods=['GET'])
+@token_required
+def get_account_deletion_status(line_user_id):
+    """アカウント削除ジョブの進捗を返す (中断されたジョブはここで再開する)"""
+    if not db:
+        return jsonify({"status": "error", "message": "Database connection failed"}), 500
 
-        # 6. Delete user's icon from Firebase Storage
-        if bucket:
-            blobs = bucket.list_blobs(prefix=f"{line_user_id}/")
-            for blob in blobs:
-                blob.delete()
+    try:
+        job_doc = db.collection('deletion_jobs').document(line_user_id).get()
+        if not job_doc.exists:
+            return jsonify({"status": "error", "message": "No deletion job found"}), 404
 
-        logger.info(f"Successfully deleted account and all data for user {line_user_id}")
-        return jsonify({"status": "success", "message": "Account deleted successfully"}), 200
+        job_data = job_doc.to_dict()
+        if is_deletion_job_stale(job_data):
+            start_deletion_job(line_user_id)
+        return jsonify({"status": "success", "data": job_data}), 200
 
     except Exception as e:
-        logger.error(f"Error deleting account for user {line_user_id}: {e}")
-        return jsonify({"status": "error", "message": "Failed to delete account"}), 500
+        logger.error(f"Error fetching deletion status for user {line_user_id}: {e}")
+        return jsonify({"status": "error", "message": "Failed to fetch deletion status"}), 500
 
 
 @app.route('/api/diaries', methods=['GET'])
@@ -1161,13 +3684,13 @@ def get_diaries(requesting_line_user_id):
         user_cache = {}
 
         # いいねを一括取得
-        if diary_ids:
-            for i in range(0, len(diary_ids), 30):
-                chunk_ids = diary_ids[i:i+30]
-                likes_query = db.collection('likes').where(filter=FieldFilter('diary_id', 'in', chunk_ids))
-                for like in likes_query.stream():
-                    diary_id = like.to_dict()['diary_id']
-                    likes_map[diary_id] = likes_map.get(diary_id, 0) + 1
+        likes_docs = fetch_in_chunks(
+            lambda chunk_ids: db.collection('likes').where(filter=FieldFilter('diary_id', 'in', chunk_ids)),
+            diary_ids, 30, ordered=False, label='get_diaries likes'
+        )
+        for like in likes_docs:
+            diary_id = like.to_dict()['diary_id']
+            likes_map[diary_id] = likes_map.get(diary_id, 0) + 1
 
         user_likes_docs = db.collection('likes').where(filter=FieldFilter('user_id', '==', requesting_line_user_id)).stream()
         user_liked_diary_ids = {doc.to_dict()['diary_id'] for doc in user_likes_docs}
@@ -1183,9 +3706,11 @@ def get_diaries(requesting_line_user_id):
 
             author_data = user_cache.get(user_id, {})
             author_name = author_data.get('name', '匿名ユーザー')
+            author_icon = icon_url_for(author_data)
 
             if requesting_user_role != 'teacher':
                 author_name = f"生徒-{user_id[-4:]}"
+                author_icon = ''  # 匿名表示のためアイコンも返さない
 
             like_count = likes_map.get(diary_doc.id, 0)
             is_liked_by_user = diary_doc.id in user_liked_diary_ids
@@ -1193,6 +3718,7 @@ def get_diaries(requesting_line_user_id):
             diary_list.append({
                 'id': diary_doc.id,
                 'author': author_name,
+                'author_icon': author_icon,
                 'content': diary_data.get('content', ''),
                 'created_at': diary_data.get('created_at', ''),
                 'like_count': like_count,
@@ -1293,21 +3819,23 @@ def get_my_students(teacher_line_user_id):
         if not teacher_class_token_ids:
             return jsonify({"status": "success", "data": [], "message": "No classes or students found for this teacher"}), 200
 
+        students_docs = fetch_in_chunks(
+            lambda batch_token_ids: db.collection('users').where(filter=FieldFilter('class_token_id', 'in', batch_token_ids)),
+            teacher_class_token_ids, 10, ordered=False, label='get_my_students'
+        )
+
         all_students = []
-        for i in range(0, len(teacher_class_token_ids), 10):
-            batch_token_ids = teacher_class_token_ids[i:i+10]
-            students_docs = db.collection('users').where(filter=FieldFilter('class_token_id', 'in', batch_token_ids)).stream()
-            for student_doc in students_docs:
-                student_data = student_doc.to_dict()
-                all_students.append({
-                    'line_user_id': student_data.get('line_user_id'),
-                    'name': student_data.get('name', '未登録'),
-                    'school': student_data.get('school', '未登録'),
-                    'class_name': student_data.get('class_name', '未登録'),
-                    'icon_path': student_data.get('icon_path', ''),
-                    'is_registered': student_data.get('is_registered', False),
-                    'role': student_data.get('role', 'student')
-                })
+        for student_doc in students_docs:
+            student_data = student_doc.to_dict()
+            all_students.append({
+                'line_user_id': student_data.get('line_user_id'),
+                'name': student_data.get('name', '未登録'),
+                'school': student_data.get('school', '未登録'),
+                'class_name': student_data.get('class_name', '未登録'),
+                **icon_fields(student_data),
+                'is_registered': student_data.get('is_registered', False),
+                'role': student_data.get('role', 'student')
+            })
 
         return jsonify({"status": "success", "data": all_students}), 200
 
@@ -1344,7 +3872,7 @@ def get_class_details(requesting_line_user_id, class_id):
             if class_id in user_data.get('approved_class_ids', []):
                 student_list.append({
                     'name': user_data.get('name', '未登録'),
-                    'icon_path': user_data.get('icon_path', ''),
+                    **icon_fields(user_data),
                     'line_user_id': user_data.get('line_user_id')
                 })
 
@@ -1352,7 +3880,7 @@ def get_class_details(requesting_line_user_id, class_id):
             'class_name': class_data.get('class_name'),
             'teacher': {
                 'name': teacher_data.get('name', '未登録'),
-                'icon_path': teacher_data.get('icon_path', '')
+                **icon_fields(teacher_data, 96)
             },
             'students': student_list
         }
@@ -1391,7 +3919,7 @@ def get_class_students(requesting_line_user_id, class_id):
                     'line_user_id': user_data.get('line_user_id'),
                     'name': user_data.get('name', '未登録'),
                     'school': user_data.get('school', '未登録'),
-                    'icon_path': user_data.get('icon_path', '')
+                    **icon_fields(user_data)
                 })
 
         return jsonify({"status": "success", "data": student_list}), 200
@@ -1427,7 +3955,7 @@ def get_pending_requests(teacher_line_user_id):
                 pending_list.append({
                     'line_user_id': user_data.get('line_user_id'),
                     'name': user_data.get('name', '不明なユーザー'),
-                    'icon_path': user_data.get('icon_path', ''),
+                    **icon_fields(user_data),
                     'requested_at': next((m.get('requested_at') for m in user_data.get('class_memberships', []) if m.get('class_id') == class_id), None)
                 })
 
@@ -1484,22 +4012,22 @@ def approve_request(teacher_line_user_id):
         if not found:
             return jsonify({"status": "error", "message": "No pending request found for this student in this class"}), 404
 
-        # Firestoreドキュメントを更新
-        student_doc_ref.update({
+        # Firestoreドキュメントの更新と LINE 通知 (outbox) を1回のバッチで書き込む
+        student_update = {
             'class_memberships': updated_memberships,
             'pending_class_ids': firestore.ArrayRemove([class_id]),
             'approved_class_ids': firestore.ArrayUnion([class_id])
-        })
-
-        # LINEで通知を送信
-        try:
-            line_bot_api.push_message(
-                student_line_user_id,
-                TextSendMessage(text=f"おめでとうございます！「{class_name}」への参加が承認されました。")
-            )
-        except Exception as e:
-            logger.error(f"Failed to send approval notification to {student_line_user_id}: {e}")
-            # 通知が失敗しても、承認処理自体は成功として返す
+        }
+        if notifications_enabled(student_data) or 'notify_class_ids' not in student_data:
+            student_update['notify_class_ids'] = notify_class_ids_update(student_data, add=class_id)
+        batch = db.batch()
+        batch.update(student_doc_ref, student_update)
+        enqueue_notification(
+            batch, f"おめでとうございます！「{class_name}」への参加が承認されました。",
+            to=[student_line_user_id], kind='class_approved', context={'class_id': class_id}
+        )
+        batch.commit()
+        wake_outbox_sender()
 
         logger.info(f"Student {student_line_user_id} approved for class {class_id} by teacher {teacher_line_user_id}")
         return jsonify({"status": "success", "message": "Student approved successfully"}), 200
@@ -1549,21 +4077,18 @@ def reject_request(teacher_line_user_id):
         if len(memberships) == len(updated_memberships):
              return jsonify({"status": "error", "message": "No pending request found for this student in this class"}), 404
 
-        # Firestoreドキュメントを更新
-        student_doc_ref.update({
+        # Firestoreドキュメントの更新と LINE 通知 (outbox) を1回のバッチで書き込む
+        batch = db.batch()
+        batch.update(student_doc_ref, {
             'class_memberships': updated_memberships,
             'pending_class_ids': firestore.ArrayRemove([class_id])
         })
-
-        # LINEで通知を送信
-        try:
-            line_bot_api.push_message(
-                student_line_user_id,
-                TextSendMessage(text=f"「{class_name}」への参加申請は、今回は見送られました。")
-            )
-        except Exception as e:
-            logger.error(f"Failed to send rejection notification to {student_line_user_id}: {e}")
-            # 通知が失敗しても、拒否処理自体は成功として返す
+        enqueue_notification(
+            batch, f"「{class_name}」への参加申請は、今回は見送られました。",
+            to=[student_line_user_id], kind='class_rejected', context={'class_id': class_id}
+        )
+        batch.commit()
+        wake_outbox_sender()
 
         logger.info(f"Student {student_line_user_id} rejected for class {class_id} by teacher {teacher_line_user_id}")
         return jsonify({"status": "success", "message": "Student rejected successfully"}), 200
@@ -1612,21 +4137,19 @@ def remove_student(teacher_line_user_id):
         if len(memberships) == len(updated_memberships):
              return jsonify({"status": "error", "message": "No approved membership found for this student in this class"}), 404
 
-        # Firestoreドキュメントを更新
-        student_doc_ref.update({
+        # Firestoreドキュメントの更新と LINE 通知 (outbox) を1回のバッチで書き込む
+        batch = db.batch()
+        batch.update(student_doc_ref, {
             'class_memberships': updated_memberships,
-            'approved_class_ids': firestore.ArrayRemove([class_id])
+            'approved_class_ids': firestore.ArrayRemove([class_id]),
+            'notify_class_ids': notify_class_ids_update(student_data, remove=class_id)
         })
-
-        # LINEで通知を送信
-        try:
-            line_bot_api.push_message(
-                student_line_user_id,
-                TextSendMessage(text=f"「{class_name}」から退会させられました。")
-            )
-        except Exception as e:
-            logger.error(f"Failed to send removal notification to {student_line_user_id}: {e}")
-            # 通知が失敗しても、削除処理自体は成功として返す
+        enqueue_notification(
+            batch, f"「{class_name}」から退会させられました。",
+            to=[student_line_user_id], kind='class_removed', context={'class_id': class_id}
+        )
+        batch.commit()
+        wake_outbox_sender()
 
         logger.info(f"Student {student_line_user_id} removed from class {class_id} by teacher {teacher_line_user_id}")
         return jsonify({"status": "success", "message": "Student removed successfully"}), 200
@@ -1674,23 +4197,25 @@ def create_assignment(teacher_line_user_id, class_id):
             'due_date': due_date,
             'created_at': datetime.now().isoformat()
         }
-        new_assignment_ref.set(new_assignment_data)
-
-        # Notify students in the class
+        class_name = class_doc.to_dict().get('class_name', '')
         try:
-            student_docs = db.collection('users').where(filter=FieldFilter('approved_class_ids', 'array_contains', class_id)).stream()
-            student_line_ids = [doc.to_dict()['line_user_id'] for doc in student_docs]
-            
-            if student_line_ids:
-                class_name = class_doc.to_dict().get('class_name', '')
-                due_date_formatted = datetime.fromisoformat(due_date).strftime('%m月%d日 %H:%M')
-                notification_text = f"【新しい課題のお知らせ】\nクラス「{class_name}」に新しい課題が追加されました。\n\n■ {title}\n期限: {due_date_formatted}\n\n「課題一覧」と送って確認してください。"
-                line_bot_api.multicast(student_line_ids, TextSendMessage(text=notification_text))
-                logger.info(f"Sent assignment notification to {len(student_line_ids)} students in class {class_id}.")
+            due_date_formatted = datetime.fromisoformat(due_date).strftime('%m月%d日 %H:%M')
+        except ValueError:
+            due_date_formatted = due_date
+        notification_text = f"【新しい課題のお知らせ】\nクラス「{class_name}」に新しい課題が追加されました。\n\n■ {title}\n期限: {due_date_formatted}\n\n「課題一覧」と送って確認してください。"
 
-        except Exception as e:
-            logger.error(f"Failed to send notification for new assignment {new_assignment_ref.id}: {e}")
-            # Continue even if notification fails
+        # 課題の作成とクラスへの通知 (outbox) を1回のバッチで書き込む。宛先は送信時に解決する
+        batch = db.batch()
+        batch.set(new_assignment_ref, new_assignment_data)
+        enqueue_notification(
+            batch, notification_text, class_id=class_id, kind='new_assignment',
+            context={'class_id': class_id, 'assignment_id': new_assignment_ref.id}
+        )
+        reminders = schedule_assignment_reminders(batch, new_assignment_ref.id, new_assignment_data)
+        batch.commit()
+        wake_outbox_sender()
+        for fire_at, reminder_id in reminders:
+            reminder_scheduler.schedule(fire_at, reminder_id)
 
         return jsonify({"status": "success", "message": "Assignment created successfully", "data": new_assignment_data}), 201
 
@@ -1752,13 +4277,39 @@ def get_assignment_detail(teacher_line_user_id, assignment_id):
         return jsonify({"status": "error", "message": "Failed to fetch assignment details"}), 500
 
 
+# 提出物一覧のページサイズと、fields= で指定できるフィールド
+SUBMISSION_PAGE_SIZE = 50
+SUBMISSION_PAGE_SIZE_MAX = 200
+SUBMISSION_LIST_FIELDS = {
+    'id', 'assignment_id', 'student_line_user_id', 'submission_type', 'submitted_at', 'file_name', 'content', 'storage_path'
+}
+
 @app.route('/api/teacher/assignment/<assignment_id>/submissions', methods=['GET'])
 @token_required
 def get_submissions_for_assignment(teacher_line_user_id, assignment_id):
-    """特定の課題のすべての提出物を取得する"""
+    """
+    特定の課題の提出物を新しい順にページ単位で取得する
+    クエリパラメータ:
+      limit: 1ページの件数 (既定 50, 最大 200)
+      cursor: 前のページの next_cursor
+      fields: 返すフィールドをカンマ区切りで指定 (例: student_line_user_id,submitted_at,submission_type)
+    全文は /api/teacher/submission/<submission_id> で取得する。
+    """
     if not db:
         return jsonify({"status": "error", "message": "Database connection failed"}), 500
 
+    try:
+        limit = min(max(int(request.args.get('limit', SUBMISSION_PAGE_SIZE)), 1), SUBMISSION_PAGE_SIZE_MAX)
+    except ValueError:
+        return jsonify({"status": "error", "message": "limit must be an integer"}), 400
+
+    fields = None
+    if request.args.get('fields'):
+        fields = [f.strip() for f in request.args['fields'].split(',') if f.strip()]
+        unknown = set(fields) - SUBMISSION_LIST_FIELDS
+        if unknown:
+            return jsonify({"status": "error", "message": f"Unknown fields: {', '.join(sorted(unknown))}"}), 400
+
     try:
         # 権限チェックのために課題情報を取得
         assignment_ref = db.collection('assignments').document(assignment_id)
@@ -1774,33 +4325,221 @@ def get_submissions_for_assignment(teacher_line_user_id, assignment_id):
         if not class_doc.exists or class_doc.to_dict().get('teacher_line_user_id') != teacher_line_user_id:
             return jsonify({"status": "error", "message": "Unauthorized"}), 403
 
-        # 提出物を取得
+        # 提出物を取得 (limit + 1 件読んで次のページの有無を判定する)
         submissions_ref = db.collection('submissions').where(filter=FieldFilter('assignment_id', '==', assignment_id)).order_by('submitted_at', direction=firestore.Query.DESCENDING)
-        docs = submissions_ref.stream()
-        
+        if fields is not None:
+            # 生徒名の解決と署名付きURLの発行に必要なフィールドは常に読む
+            projection = set(fields) | {'student_line_user_id', 'submitted_at'}
+            if 'content' in projection:
+                projection.add('storage_path')
+            submissions_ref = submissions_ref.select(sorted(projection))
+
+        cursor = request.args.get('cursor')
+        if cursor:
+            cursor_doc = db.collection('submissions').document(cursor).get(field_paths=['submitted_at', 'assignment_id'])
+            if not cursor_doc.exists or cursor_doc.to_dict().get('assignment_id') != assignment_id:
+                return jsonify({"status": "error", "message": "Invalid cursor"}), 400
+            submissions_ref = submissions_ref.start_after(cursor_doc)
+
+        docs = list(submissions_ref.limit(limit + 1).stream())
+        next_cursor = docs[limit - 1].id if len(docs) > limit else None
+        docs = docs[:limit]
+
+        # 生徒名はページ内の生徒だけをまとめて取得する
+        student_ids = {doc.to_dict().get('student_line_user_id') for doc in docs}
+        student_docs = fetch_in_chunks(
+            lambda batch_ids: db.collection('users').where(filter=FieldFilter('line_user_id', 'in', batch_ids)).select(['line_user_id', 'name']),
+            [sid for sid in student_ids if sid], 10, ordered=False, label='get_submissions_for_assignment'
+        )
+        student_names = {doc.to_dict().get('line_user_id'): doc.to_dict().get('name') for doc in student_docs}
+
         submission_list = []
-        user_cache = {}
         for doc in docs:
             submission_data = doc.to_dict()
-            student_id = submission_data.get('student_line_user_id')
-
-            # ユーザー情報をキャッシュから取得またはFirestoreから取得
-            if student_id not in user_cache:
-                user_query = db.collection('users').where(filter=FieldFilter('line_user_id', '==', student_id)).limit(1)
-                user_docs = list(user_query.stream())
-                if user_docs:
-                    user_cache[student_id] = user_docs[0].to_dict()
-                else:
-                    user_cache[student_id] = {'name': '不明な生徒'} # 見つからない場合
-
-            submission_data['student_name'] = user_cache[student_id].get('name', '不明な生徒')
+            submission_data.setdefault('id', doc.id)
+            submission_data['student_name'] = student_names.get(submission_data.get('student_line_user_id')) or '不明な生徒' # 見つからない場合
             submission_list.append(submission_data)
 
-        return jsonify({"status": "success", "data": submission_list}), 200
+        if fields is None or 'content' in fields:
+            with_signed_file_urls(submission_list)
+        if fields is not None:
+            keep = set(fields) | {'id', 'student_name'}
+            submission_list = [{k: v for k, v in submission.items() if k in keep} for submission in submission_list]
+
+        return jsonify({"status": "success", "data": submission_list, "next_cursor": next_cursor}), 200
     except Exception as e:
         logger.error(f"Error fetching submissions for assignment {assignment_id}: {e}")
         return jsonify({"status": "error", "message": "Failed to fetch submissions"}), 500
 
+@app.route('/api/teacher/submission/<submission_id>', methods=['GET'])
+@token_required
+def get_submission_detail(teacher_line_user_id, submission_id):
+    """提出物1件の全文 (ファイルは署名付きURL) を取得する"""
+    if not db:
+        return jsonify({"status": "error", "message": "Database connection failed"}), 500
+
+    try:
+        submission_doc = db.collection('submissions').document(submission_id).get()
+        if not submission_doc.exists:
+            return jsonify({"status": "error", "message": "Submission not found"}), 404
+        submission_data = submission_doc.to_dict()
+        submission_data.setdefault('id', submission_doc.id)
+
+        assignment_doc = db.collection('assignments').document(submission_data.get('assignment_id')).get()
+        class_id = assignment_doc.to_dict().get('class_id') if assignment_doc.exists else None
+        class_doc = db.collection('classes').document(class_id).get() if class_id else None
+        if not class_doc or not class_doc.exists or class_doc.to_dict().get('teacher_line_user_id') != teacher_line_user_id:
+            return jsonify({"status": "error", "message": "Unauthorized"}), 403
+
+        user_docs = db.collection('users').where(
+            filter=FieldFilter('line_user_id', '==', submission_data.get('student_line_user_id'))
+        ).select(['name']).limit(1).get()
+        submission_data['student_name'] = (user_docs[0].to_dict().get('name') if user_docs else None) or '不明な生徒'
+
+        return jsonify({"status": "success", "data": with_signed_file_urls([submission_data])[0]}), 200
+    except Exception as e:
+        logger.error(f"Error fetching submission {submission_id}: {e}")
+        return jsonify({"status": "error", "message": "Failed to fetch submission"}), 500
+
+@app.route('/api/teacher/assignment/<assignment_id>/submissions.zip', methods=['GET'])
+@token_required
+def download_submissions_zip(teacher_line_user_id, assignment_id):
+    """課題の提出ファイルとテキスト提出の一覧 (manifest.csv) を ZIP でストリーミングする"""
+    if not db or not bucket:
+        return jsonify({"status": "error", "message": "Database or Storage connection failed"}), 500
+
+    try:
+        assignment_doc = db.collection('assignments').document(assignment_id).get()
+        if not assignment_doc.exists:
+            return jsonify({"status": "error", "message": "Assignment not found"}), 404
+        assignment_data = assignment_doc.to_dict()
+
+        class_doc = db.collection('classes').document(assignment_data.get('class_id')).get()
+        if not class_doc.exists or class_doc.to_dict().get('teacher_line_user_id') != teacher_line_user_id:
+            return jsonify({"status": "error", "message": "Unauthorized"}), 403
+
+        submissions = [doc.to_dict() for doc in db.collection('submissions').where(
+            filter=FieldFilter('assignment_id', '==', assignment_id)
+        ).order_by('submitted_at').stream()]
+
+        student_ids = {s.get('student_line_user_id') for s in submissions if s.get('student_line_user_id')}
+        student_docs = fetch_in_chunks(
+            lambda batch_ids: db.collection('users').where(filter=FieldFilter('line_user_id', 'in', batch_ids)).select(['line_user_id', 'name']),
+            student_ids, 10, ordered=False, label='download_submissions_zip'
+        )
+        student_names = {doc.to_dict().get('line_user_id'): doc.to_dict().get('name') or '不明な生徒' for doc in student_docs}
+
+        file_entries = []
+        manifest_rows = []
+        used_names = set()
+        for submission in submissions:
+            student_id = submission.get('student_line_user_id')
+            student_name = student_names.get(student_id) or '不明な生徒'
+            submitted_at = submission.get('submitted_at', '')
+            arcname = ''
+            content = submission.get('content', '')
+            if submission.get('submission_type') == 'file':
+                storage_path = submission.get('storage_path') or storage_path_from_url(content)
+                if storage_path:
+                    file_name = submission.get('file_name') or os.path.basename(storage_path)
+                    arcname = zip_entry_name(used_names, student_name, submitted_at[:19].replace(':', '').replace('-', ''), file_name)
+                    file_entries.append((f"files/{arcname}", storage_path))
+                    arcname = f"files/{arcname}"
+                    content = ''
+            manifest_rows.append([student_name, student_id, submission.get('submission_type'), submitted_at, arcname, content])
+
+        download_name = f"{assignment_data.get('title', assignment_id)}_submissions.zip"
+        return Response(
+            stream_with_context(generate_submissions_zip(file_entries, manifest_rows)),
+            mimetype='application/zip',
+            headers={
+                'Content-Disposition': f"attachment; filename=\"submissions.zip\"; filename*=UTF-8''{quote(download_name)}",
+                'X-Accel-Buffering': 'no'
+            }
+        )
+
+    except Exception as e:
+        logger.error(f"Error exporting submissions for assignment {assignment_id}: {e}", exc_info=True)
+        return jsonify({"status": "error", "message": "Failed to export submissions"}), 500
+
+# 提出状況マトリクスのステータスコード (1課題につき1文字)
+SUBMISSION_STATUS_CODES = {
+    'S': 'submitted',
+    'L': 'late',
+    'M': 'missing',
+    'P': 'pending',
+}
+
+@app.route('/api/teacher/class/<class_id>/submission_matrix', methods=['GET'])
+@token_required
+def get_submission_matrix(teacher_line_user_id, class_id):
+    """
+    クラスの 生徒 × 課題 の提出状況を返す。
+    各生徒の行は課題の並び順に1文字ずつのステータスコードを並べた文字列 (例: "SSLMP")。
+    """
+    if not db:
+        return jsonify({"status": "error", "message": "Database connection failed"}), 500
+
+    try:
+        class_doc = db.collection('classes').document(class_id).get()
+        if not class_doc.exists or class_doc.to_dict().get('teacher_line_user_id') != teacher_line_user_id:
+            return jsonify({"status": "error", "message": "Unauthorized"}), 403
+
+        # 名簿・課題・提出状況インデックスをそれぞれ1回のクエリで取得する
+        student_docs = db.collection('users').where(
+            filter=FieldFilter('approved_class_ids', 'array_contains', class_id)
+        ).select(['line_user_id', 'name']).stream()
+        students = sorted(
+            ({'line_user_id': d.get('line_user_id'), 'name': d.get('name') or '未登録'} for d in (doc.to_dict() for doc in student_docs)),
+            key=lambda student: student['name']
+        )
+
+        assignment_docs = db.collection('assignments').where(
+            filter=FieldFilter('class_id', '==', class_id)
+        ).order_by('due_date', direction=firestore.Query.ASCENDING).select(['title', 'due_date']).stream()
+        assignments = [dict(doc.to_dict(), id=doc.id) for doc in assignment_docs]
+
+        status_docs = db.collection('submission_status').where(
+            filter=FieldFilter('class_id', '==', class_id)
+        ).select(['assignment_id', 'student_line_user_id', 'first_submitted_at', 'last_submitted_at']).stream()
+        # 遅延かどうかは最初の提出で判定する (期限内に提出してから期限後に再提出しても S のまま)
+        submitted_at = {}
+        for doc in status_docs:
+            status = doc.to_dict()
+            submitted_at[(status.get('student_line_user_id'), status.get('assignment_id'))] = status.get('first_submitted_at') or status.get('last_submitted_at', '')
+
+        now = datetime.now().isoformat()
+        rows = []
+        for student in students:
+            codes = []
+            for assignment in assignments:
+                due_date = assignment.get('due_date', '')
+                first_submitted_at = submitted_at.get((student['line_user_id'], assignment['id']))
+                if first_submitted_at is not None:
+                    codes.append('L' if due_date and first_submitted_at > due_date else 'S')
+                else:
+                    codes.append('M' if due_date < now else 'P')
+            rows.append(''.join(codes))
+
+        submitted_counts = [
+            sum(1 for row in rows if row[i] in ('S', 'L')) for i in range(len(assignments))
+        ]
+
+        return jsonify({
+            "status": "success",
+            "data": {
+                "assignments": assignments,
+                "students": students,
+                "rows": rows,
+                "submitted_counts": submitted_counts,
+                "codes": SUBMISSION_STATUS_CODES
+            }
+        }), 200
+
+    except Exception as e:
+        logger.error(f"Error building submission matrix for class {class_id}: {e}", exc_info=True)
+        return jsonify({"status": "error", "message": "Failed to fetch submission matrix"}), 500
+
 
 @app.route('/api/teacher/class_analysis', methods=['GET'])
 @token_required
@@ -1834,13 +4573,14 @@ def class_analysis(teacher_line_user_id):
 
         # 3. 生徒全員の日記データを取得
         all_diaries_content = ""
-        # Firestoreの'in'クエリは最大10個の要素しか受け付けないため、分割して処理
-        for i in range(0, len(student_line_ids), 10):
-            batch_ids = student_line_ids[i:i+10]
-            diaries_query = db.collection('diaries').where(filter=FieldFilter('user_id', 'in', batch_ids)).order_by('created_at').stream()
-            for doc in diaries_query:
-                data = doc.to_dict()
-                all_diaries_content += f"ユーザーID: {data.get('user_id')}\n日付: {data.get('created_at')}\n内容: {data.get('content')}\n\n"
+        # Firestoreの'in'クエリは最大10個の要素しか受け付けないため、分割して並列に処理
+        diaries_docs = fetch_in_chunks(
+            lambda batch_ids: db.collection('diaries').where(filter=FieldFilter('user_id', 'in', batch_ids)).order_by('created_at'),
+            student_line_ids, 10, ordered=True, label='class_analysis diaries'
+        )
+        for doc in diaries_docs:
+            data = doc.to_dict()
+            all_diaries_content += f"ユーザーID: {data.get('user_id')}\n日付: {data.get('created_at')}\n内容: {data.get('content')}\n\n"
 
         if not all_diaries_content:
             return jsonify({"status": "success", "analysis": "このクラスの生徒はまだ日記を投稿していません。"}), 200
@@ -1863,11 +4603,12 @@ def class_analysis(teacher_line_user_id):
         {all_diaries_content}
         """
 
-        model = genai.GenerativeModel('gemini-pro')
-        response = model.generate_content(prompt)
+        analysis_text = generate_gemini_content(prompt)
 
-        return jsonify({"status": "success", "analysis": response.text}), 200
+        return jsonify({"status": "success", "analysis": analysis_text}), 200
 
+    except LLMQueueFull as e:
+        return llm_busy_response(e)
     except Exception as e:
         logger.error(f"Error during class analysis: {e}", exc_info=True)
         return jsonify({"status": "error", "message": f"Failed to perform class analysis: {str(e)}"}), 500
@@ -1906,24 +4647,19 @@ def student_report(teacher_line_user_id):
 
         student_name = student_data.get('display_name', '不明な生徒')
 
-        # 3. 生徒の日記データを取得
-        diaries_query = db.collection('diaries').where(filter=FieldFilter('user_id', '==', student_line_user_id)).order_by('created_at').stream()
-        diaries = []
-        total_word_count = 0
-        latest_post_date = None
-
-        for doc in diaries_query:
-            diary_data = doc.to_dict()
-            diaries.append(diary_data)
-            if 'content' in diary_data:
-                total_word_count += len(diary_data['content'])
-            if 'created_at' in diary_data:
-                if latest_post_date is None or diary_data['created_at'] > latest_post_date:
-                    latest_post_date = diary_data['created_at']
-
-        total_posts = len(diaries)
+        # 3. 生徒の統計を取得 (user_stats の1ドキュメント読み取り)
+        stats = get_user_stats(student_line_user_id)
+        total_posts = stats.get('total_posts', 0)
+        total_word_count = stats.get('total_word_count', 0)
+        latest_post_date = stats.get('latest_post_date')
         average_word_count = total_word_count / total_posts if total_posts > 0 else 0
 
+        # 要約用の日記本文は投稿がある場合のみ取得する
+        diaries = []
+        if total_posts > 0:
+            diaries_query = db.collection('diaries').where(filter=FieldFilter('user_id', '==', student_line_user_id)).order_by('created_at').select(['content', 'created_at'])
+            diaries = [doc.to_dict() for doc in diaries_query.stream()]
+
         report_data = {
             "student_name": student_name,
             "class_name": class_name,
@@ -1944,14 +4680,14 @@ def student_report(teacher_line_user_id):
             # 日記データ
             {report_data["diaries_content"]}
             """
-            model = genai.GenerativeModel('gemini-pro')
-            response = model.generate_content(prompt)
-            gemini_summary = response.text
+            gemini_summary = generate_gemini_content(prompt)
 
         report_data["gemini_summary"] = gemini_summary
 
         return jsonify({"status": "success", "report": report_data}), 200
 
+    except LLMQueueFull as e:
+        return llm_busy_response(e)
     except Exception as e:
         logger.error(f"Error generating student report: {e}", exc_info=True)
         return jsonify({"status": "error", "message": f"Failed to generate student report: {str(e)}"}), 500
@@ -1991,11 +4727,12 @@ def home_analysis_summary(line_user_id):
 {diaries_content}
 """
         # 3. Call Gemini API
-        model = genai.GenerativeModel('gemini-pro')
-        response = model.generate_content(prompt)
+        summary_text = generate_gemini_content(prompt)
 
-        return jsonify({"summary": response.text}), 200
+        return jsonify({"summary": summary_text}), 200
 
+    except LLMQueueFull as e:
+        return llm_busy_response(e)
     except Exception as e:
         logger.error(f"Error during home analysis summary: {e}", exc_info=True)
         return jsonify({"status": "error", "message": f"Failed to perform analysis: {str(e)}"}), 500
@@ -2097,11 +4834,12 @@ def gemini_analysis(line_user_id):
             return jsonify({"status": "error", "message": "Invalid analysis type."}), 400
 
         # 3. Call Gemini API
-        model = genai.GenerativeModel('gemini-pro')
-        response = model.generate_content(prompt)
+        analysis_text = generate_gemini_content(prompt)
 
-        return jsonify({"analysis": response.text}), 200
+        return jsonify({"analysis": analysis_text}), 200
 
+    except LLMQueueFull as e:
+        return llm_busy_response(e)
     except Exception as e:
         logger.error(f"Error during Gemini analysis: {e}", exc_info=True)
         return jsonify({"status": "error", "message": f"Failed to perform analysis: {str(e)}"}), 500
@@ -2156,14 +4894,20 @@ def add_comment(commenting_user_id, diary_id):
         if openai.api_key:
             prompt = f"""次の文章からポジティブなタグのみを3つまで抽出してください（複数ある場合はカンマ区切り）:
 {comment_content}"""
-            response = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo",
-                messages=[{"role": "user", "content": prompt}],
-                max_tokens=60,
-                temperature=0
-            )
-            tags_text = response.choices[0].message.content.strip()
-            tags = [tag.strip() for tag in tags_text.split(",") if tag.strip()]
+            try:
+                # タグ付けは補助的な処理なのでバッチ優先度で呼び出し、混雑時はタグなしで投稿する
+                with llm_gate.slot(LLM_PRIORITY_BATCH):
+                    response = openai.ChatCompletion.create(
+                        model="gpt-3.5-turbo",
+                        messages=[{"role": "user", "content": prompt}],
+                        max_tokens=60,
+                        temperature=0
+                    )
+                tags_text = response.choices[0].message.content.strip()
+                tags = [tag.strip() for tag in tags_text.split(",") if tag.strip()]
+            except LLMQueueFull:
+                tags = []
+                logger.warning(f"LLM queue is full. Skipping tag generation for diary {diary_id}.")
         else:
             tags = []
             logger.warning("OpenAI API key not set. Skipping tag generation.")
@@ -2207,11 +4951,10 @@ def diary_tags(line_user_id):
         user_diary_ids = [doc.id for doc in user_diary_docs]
 
         if user_diary_ids:
-            all_personal_comments = []
-            for i in range(0, len(user_diary_ids), 30):
-                chunk_ids = user_diary_ids[i:i+30]
-                comments_query = db.collection('comments').where(filter=FieldFilter('diary_id', 'in', chunk_ids))
-                all_personal_comments.extend(comments_query.stream())
+            all_personal_comments = fetch_in_chunks(
+                lambda chunk_ids: db.collection('comments').where(filter=FieldFilter('diary_id', 'in', chunk_ids)),
+                user_diary_ids, 30, ordered=False, label='diary_tags personal comments'
+            )
 
             for comment in all_personal_comments:
                 for tag in comment.to_dict().get('tags', []):
@@ -2239,11 +4982,10 @@ def diary_tags(line_user_id):
                 class_diary_ids = [doc.id for doc in class_diary_docs]
 
                 if class_diary_ids:
-                    all_class_comments = []
-                    for i in range(0, len(class_diary_ids), 30):
-                        chunk_ids = class_diary_ids[i:i+30]
-                        comments_query = db.collection('comments').where(filter=FieldFilter('diary_id', 'in', chunk_ids))
-                        all_class_comments.extend(comments_query.stream())
+                    all_class_comments = fetch_in_chunks(
+                        lambda chunk_ids: db.collection('comments').where(filter=FieldFilter('diary_id', 'in', chunk_ids)),
+                        class_diary_ids, 30, ordered=False, label='diary_tags class comments'
+                    )
 
                     for comment in all_class_comments:
                         for tag in comment.to_dict().get('tags', []):
@@ -2316,104 +5058,103 @@ def get_comments(requesting_line_user_id, diary_id):
         print(f"Error fetching comments for diary {diary_id}: {e}", file=sys.stderr)
         return jsonify({"status": "error", "message": "Failed to fetch comments"}), 500
 from openpyxl import load_workbook
+from rendering import fill_resume, get_resume_template, init_resume_worker, render_resume_bytes
+
+RESUME_TEMPLATE_PATH = os.path.join(BASE_DIR, "A4_format.xlsx")
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+# ------------------------------------------------------------------------------
+# Bulk resume generation
+# ------------------------------------------------------------------------------
+# 履歴書の作成 (openpyxl での書き込みと保存) は CPU 処理なので、プロセスプールで並列に行う。
+# 各ワーカープロセスは起動時にテンプレートを読み込み、以降はキャッシュから deepcopy する。
+RESUME_PROCESS_WORKERS = int(os.getenv("RESUME_PROCESS_WORKERS", str(min(4, os.cpu_count() or 1))))
+RESUME_BULK_MAX = int(os.getenv("RESUME_BULK_MAX", "200"))
+RESUME_RENDER_TIMEOUT = float(os.getenv("RESUME_RENDER_TIMEOUT", "60"))
+
+resume_process_pool = None
+resume_process_pool_lock = threading.Lock()
+
+def get_resume_process_pool():
+    global resume_process_pool
+    with resume_process_pool_lock:
+        if resume_process_pool is None:
+            resume_process_pool = ProcessPoolExecutor(
+                max_workers=RESUME_PROCESS_WORKERS,
+                mp_context=get_process_pool_context(),
+                initializer=init_resume_worker,
+                initargs=(RESUME_TEMPLATE_PATH,)
+            )
+        return resume_process_pool
 
-def fill_resume(data, template_path="A4_format.xlsx", output_path="output.xlsx"):
-    """
-    data(dict) に以下が含まれる想定：
-    {
-        "furigana": "...",
-        "name": "...",
-        "birthday": "...",
-        "address_kana1": "...",
-        "zip1": "...",
-        "address1": "...",
-        "tel1": "...",
-        "email1": "...",
-        "address_kana2": "...",
-        "zip2": "...",
-        "address2": "...",
-        "tel2": "...",
-        "email2": "...",
-        "education": [ {"year": "", "month": "", "text": "" }, ... ],
-        "licenses": [ {"year": "", "month": "", "text": "" }, ... ],
-        "motivation": "...",
-        "notes": "..."
-    }
+def generate_resumes_zip(payloads):
+    """
+    履歴書をプロセスプールで並列に作成し、payloads の順に ZIP へ書き込んで yield する。
+    作成に失敗した履歴書はエラー内容のテキストファイルになる。
+    """
+    futures = [get_resume_process_pool().submit(render_resume_bytes, payload) for payload in payloads]
+    writer = ZipStreamWriter()
+    used_names = set()
+    try:
+        with zipfile.ZipFile(writer, mode='w') as archive:
+            for index, (payload, future) in enumerate(zip(payloads, futures), start=1):
+                base_name = zip_entry_name(used_names, f"{index:03d}", payload.get('name') or 'resume', 'resume.xlsx')
+                try:
+                    # xlsx は圧縮済みの ZIP なので、そのまま格納する
+                    archive.writestr(base_name, future.result(timeout=RESUME_RENDER_TIMEOUT), compress_type=zipfile.ZIP_STORED)
+                except Exception as e:
+                    logger.error(f"Failed to render resume {index}: {e}")
+                    archive.writestr(f"{os.path.splitext(base_name)[0]}_error.txt", f"履歴書を作成できませんでした: {e}\n")
+                yield writer.drain()
+        yield writer.drain()
+    finally:
+        for future in futures:
+            future.cancel()
+
+@app.route('/api/teacher/resumes/bulk', methods=['POST'])
+@token_required
+def bulk_create_resumes(teacher_line_user_id):
     """
+    複数の履歴書をまとめて作成し、ZIP でストリーミングする
+    リクエスト: {"resumes": [fill_resume と同じ形式, ...]} または {"class_id": "..."} (クラスの生徒のプロフィールから作成)
+    """
+    if not db:
+        return jsonify({"status": "error", "message": "Database connection failed"}), 500
+
+    teacher_user_doc = db.collection('users').where(filter=FieldFilter('line_user_id', '==', teacher_line_user_id)).limit(1).get()
+    if not teacher_user_doc or teacher_user_doc[0].to_dict().get('role') != 'teacher':
+        return jsonify({"status": "error", "message": "Unauthorized: Only teachers can create resumes in bulk"}), 403
+
+    data = request.get_json() or {}
+    try:
+        payloads = data.get('resumes')
+        if payloads is None and data.get('class_id'):
+            class_doc = db.collection('classes').document(data['class_id']).get()
+            if not class_doc.exists or class_doc.to_dict().get('teacher_line_user_id') != teacher_line_user_id:
+                return jsonify({"status": "error", "message": "Unauthorized or class not found"}), 403
+            student_docs = db.collection('users').where(
+                filter=FieldFilter('approved_class_ids', 'array_contains', data['class_id'])
+            ).select(['name']).stream()
+            payloads = sorted(({'name': doc.to_dict().get('name', '')} for doc in student_docs), key=lambda p: p['name'])
+
+        if not isinstance(payloads, list) or not payloads or not all(isinstance(p, dict) for p in payloads):
+            return jsonify({"status": "error", "message": "resumes (list) or class_id is required"}), 400
+        if len(payloads) > RESUME_BULK_MAX:
+            return jsonify({"status": "error", "message": f"Too many resumes (max {RESUME_BULK_MAX})"}), 400
+
+        get_resume_template()  # テンプレートが無い場合はストリーミング開始前にエラーにする
+        return Response(
+            stream_with_context(generate_resumes_zip(payloads)),
+            mimetype='application/zip',
+            headers={
+                'Content-Disposition': 'attachment; filename="resumes.zip"',
+                'X-Accel-Buffering': 'no'
+            }
+        )
 
-    wb = load_workbook(template_path)
-    ws = wb.active
-
-    # ----------------------------
-    # 基本情報
-    # ----------------------------
-    ws["C6"] = data.get("furigana", "")
-    ws["C9"] = data.get("name", "")
-    ws["B14"] = data.get("birthday", "")
-
-    ws["C16"] = data.get("address_kana1", "")
-    ws["C19"] = data.get("zip1", "")
-    ws["C21"] = data.get("address1", "")
-    ws["I16"] = data.get("tel1", "")
-    ws["H21"] = data.get("email1", "")
-
-    ws["C25"] = data.get("address_kana2", "")
-    ws["C28"] = data.get("zip2", "")
-    ws["C30"] = data.get("address2", "")
-    ws["I25"] = data.get("tel2", "")
-    ws["H30"] = data.get("email2", "")
-
-    # ----------------------------
-    # 学歴・職歴
-    # ----------------------------
-    year_cells = ["B38","B41","B44","B47","B50","B53","B56","B59","B62","B65","B68","B71","B74","B77","B80","B83",
-                  "L5","L8","L11","L14","L16","L19"]
-    month_cells = ["C38","C41","C44","C47","C50","C53","C56","C59","C62","C65","C68","C71","C74","C77","C80","C83",
-                   "M5","M8","M11","M14","M16","M19"]
-    text_cells = ["D38","D41","D44","D47","D50","D53","D56","D59","D62","D65","D68","D71","D74","D77","D80","D83",
-                  "N5","N8","N11","N14","N16","N19"]
-
-    education = data.get("education", [])
-    for i, item in enumerate(education):
-        if i >= len(year_cells): break
-        ws[year_cells[i]] = item.get("year", "")
-        ws[month_cells[i]] = item.get("month", "")
-        ws[text_cells[i]] = item.get("text", "")
-
-    # ----------------------------
-    # 資格・免許
-    # ----------------------------
-    lic_year = ["L25","L28","L31","L34","L37","L40"]
-    lic_month = ["M25","M28","M31","M34","M37","M40"]
-    lic_text = ["N25","N28","N31","N34","N37","N40"]
-
-    licenses = data.get("licenses", [])
-    for i, item in enumerate(licenses):
-        if i >= len(lic_year): break
-        ws[lic_year[i]] = item.get("year", "")
-        ws[lic_month[i]] = item.get("month", "")
-        ws[lic_text[i]] = item.get("text", "")
-
-    # ----------------------------
-    # 志望動機（1セル）
-    # ----------------------------
-    ws["L47"] = data.get("motivation", "")
-
-    # ----------------------------
-    # 本人希望記入欄（複数行 OK）
-    # 行ごとに割り当てる
-    # ----------------------------
-    notes_lines = data.get("notes", "").split("\n")
-    notes_cells = ["L71","L74","L77","L80","L83"]
-
-    for i, line in enumerate(notes_lines):
-        if i >= len(notes_cells): break
-        ws[notes_cells[i]] = line
-
-    # ----------------------------
-    # 保存
-    # ----------------------------
-    wb.save(output_path)
+    except Exception as e:
+        logger.error(f"Error creating resumes in bulk for teacher {teacher_line_user_id}: {e}", exc_info=True)
+        return jsonify({"status": "error", "message": "Failed to create resumes"}), 500
 
 @app.route('/resume')
 def resume_form():
@@ -2427,27 +5168,200 @@ def resume_create():
         # 必要ならここで認可チェック（ログインしているユーザーだけ許可、など）
         # 例: if not current_user: abort(401)
 
-        # fill_resume() は先に渡した関数を想定
-        # テンプレ名は "A4_format.xlsx" と仮定（同ディレクトリ or フルパスで）
-        tmp_out = tempfile.NamedTemporaryFile(delete=False, suffix='.xlsx')
-        tmp_out.close()
-        output_path = tmp_out.name
-
-        # fill_resume 関数を使って Excel を書き出す
-        template_path = os.path.join(BASE_DIR, "A4_format.xlsx")
-        fill_resume(payload, template_path=template_path, output_path=output_path)
+        # fill_resume 関数を使って Excel をメモリ上に書き出す (一時ファイルは作らない)
+        output = fill_resume(payload)
 
         # 返却（ダウンロード）
         filename = f"{payload.get('name','resume')}_resume.xlsx"
-        return send_file(output_path, as_attachment=True, download_name=filename)
+        return send_file(output, as_attachment=True, download_name=filename, mimetype=XLSX_MIMETYPE)
 
     except Exception as e:
         app.logger.exception("resume_create error")
         return ("Server error: " + str(e)), 500
-    finally:
-        # send_file が終わったら temp を消すのは send_file 実行後に行う必要あり。
-        # ここでは残しておき、定期クリーンなどで消すのを推奨。
-        pass
+
+@app.route('/api/internal/metrics', methods=['GET'])
+def internal_metrics():
+    """プロセス内のキュー・ゲートの状態を返す (METRICS_TOKEN で保護)"""
+    metrics_token = os.getenv("METRICS_TOKEN")
+    if not metrics_token or request.headers.get('Authorization') != f"Bearer {metrics_token}":
+        abort(404)
+    return jsonify({name: provider() for name, provider in METRICS_PROVIDERS.items()}), 200
+
+# ==============================================================================
+# CLI Commands
+# ==============================================================================
+@app.cli.command('rebuild-user-stats')
+@click.option('--user', 'line_user_id', default=None, help='対象ユーザーのLINE User ID (省略時は全ユーザー)')
+def rebuild_user_stats_command(line_user_id):
+    """日記コレクションから user_stats を再構築する"""
+    if line_user_id:
+        user_ids = [line_user_id]
+    else:
+        user_ids = [doc.to_dict().get('line_user_id') for doc in db.collection('users').select(['line_user_id']).stream()]
+
+    rebuilt = 0
+    for user_id in user_ids:
+        if not user_id:
+            continue
+        stats = rebuild_user_stats(user_id)
+        rebuilt += 1
+        click.echo(f"{user_id}: {stats['total_posts']} posts, {stats['total_word_count']} chars")
+    click.echo(f"Rebuilt stats for {rebuilt} users.")
+
+@app.cli.command('resume-deletions')
+def resume_deletions_command():
+    """中断または失敗したアカウント削除ジョブを再開する"""
+    jobs = db.collection('deletion_jobs').where(filter=FieldFilter('status', 'in', ['pending', 'running', 'failed'])).stream()
+    resumed = 0
+    for job_doc in jobs:
+        click.echo(f"Resuming deletion for {job_doc.id} (phase: {job_doc.to_dict().get('phase', '-')})")
+        run_deletion_job(job_doc.id)
+        resumed += 1
+    click.echo(f"Resumed {resumed} deletion jobs.")
+
+    # 解放の途中でプロセスが落ち、deleting のまま残ったファイルを削除する
+    stale_before = (datetime.now() - timedelta(seconds=CAS_DELETE_STALE_SECONDS)).isoformat()
+    finished = 0
+    for file_doc in db.collection('file_objects').where(filter=FieldFilter('status', '==', 'deleting')).stream():
+        file_data = file_doc.to_dict()
+        if file_data.get('deleting_at', '') < stale_before:
+            _finish_file_object_delete(file_doc.reference, file_data['storage_path'])
+            finished += 1
+    click.echo(f"Finished {finished} stale file object deletions.")
+
+@app.cli.command('make-objects-private')
+@click.option('--prefix', default='', help='対象にするオブジェクトのプレフィックス (省略時はバケット全体)')
+def make_objects_private_command(prefix):
+    """
+    以前 make_public() で公開したオブジェクトの allUsers への読み取り権限を取り消す。
+    (均一なバケットレベルのアクセスが有効なバケットでは、オブジェクトの ACL は使われない)
+    """
+    updated = 0
+    for blob in bucket.list_blobs(prefix=prefix or None):
+        blob.acl.reload()
+        if 'READER' not in blob.acl.all().get_roles():
+            continue
+        blob.acl.all().revoke_read()
+        blob.acl.save()
+        updated += 1
+        if updated % 100 == 0:
+            click.echo(f"{updated} objects made private...")
+    click.echo(f"Revoked public read access on {updated} objects.")
+
+@app.cli.command('cleanup-uploads')
+def cleanup_uploads_command():
+    """期限切れで finalize されなかったアップロードを削除する"""
+    click.echo(f"Removed {cleanup_expired_uploads()} expired pending uploads.")
+
+@app.cli.command('backfill-notify-class-ids')
+def backfill_notify_class_ids_command():
+    """
+    既存ユーザーの notify_class_ids を承認済みクラスと通知設定から作成する (デプロイ時に1回だけ必要な移行)。
+    完了すると移行済みのフラグを立て、クラス通知は notify_class_ids の1クエリだけで宛先を解決するようになる。
+    """
+    users = db.collection('users').select(['approved_class_ids', 'settings', 'notify_class_ids']).stream()
+    batch = db.batch()
+    pending = 0
+    updated = 0
+    for user_doc in users:
+        user_data = user_doc.to_dict()
+        notify_class_ids = notify_class_ids_for(user_data)
+        if sorted(user_data.get('notify_class_ids') or []) == sorted(notify_class_ids) and 'notify_class_ids' in user_data:
+            continue
+        batch.update(user_doc.reference, {'notify_class_ids': notify_class_ids})
+        pending += 1
+        updated += 1
+        if pending == FIRESTORE_BATCH_LIMIT:
+            batch.commit()
+            batch = db.batch()
+            pending = 0
+    if pending:
+        batch.commit()
+    db.collection('app_config').document('migrations').set({
+        'notify_class_ids_backfilled': True,
+        'notify_class_ids_backfilled_at': datetime.now().isoformat()
+    }, merge=True)
+    click.echo(f"Updated notify_class_ids for {updated} users. Class notifications no longer scan the roster.")
+
+@app.cli.command('backfill-submission-status')
+def backfill_submission_status_command():
+    """既存の提出物から submission_status インデックスを作り直す"""
+    assignment_class_ids = {}
+    statuses = {}
+    submissions = db.collection('submissions').select(
+        ['id', 'assignment_id', 'student_line_user_id', 'submission_type', 'submitted_at']
+    ).stream()
+    for submission_doc in submissions:
+        submission = submission_doc.to_dict()
+        assignment_id = submission.get('assignment_id')
+        student_id = submission.get('student_line_user_id')
+        if not assignment_id or not student_id:
+            continue
+        if assignment_id not in assignment_class_ids:
+            assignment_doc = db.collection('assignments').document(assignment_id).get()
+            assignment_class_ids[assignment_id] = assignment_doc.to_dict().get('class_id') if assignment_doc.exists else None
+
+        key = submission_status_id(assignment_id, student_id)
+        status = statuses.setdefault(key, {
+            'assignment_id': assignment_id,
+            'class_id': assignment_class_ids[assignment_id],
+            'student_line_user_id': student_id,
+            'status': 'submitted',
+            'submission_count': 0,
+            'first_submitted_at': submission.get('submitted_at', ''),
+            'last_submitted_at': ''
+        })
+        status['submission_count'] += 1
+        status['first_submitted_at'] = min(status['first_submitted_at'], submission.get('submitted_at', ''))
+        if submission.get('submitted_at', '') >= status['last_submitted_at']:
+            status['last_submitted_at'] = submission.get('submitted_at', '')
+            status['last_submission_id'] = submission.get('id', submission_doc.id)
+            status['last_submission_type'] = submission.get('submission_type')
+
+    items = list(statuses.items())
+    for i in range(0, len(items), FIRESTORE_BATCH_LIMIT):
+        batch = db.batch()
+        for key, status in items[i:i + FIRESTORE_BATCH_LIMIT]:
+            batch.set(db.collection('submission_status').document(key), status)
+        batch.commit()
+    click.echo(f"Wrote {len(statuses)} submission_status entries.")
+
+@app.cli.command('bench-resume')
+@click.option('--count', default=40, show_default=True, help='作成する履歴書の数')
+def bench_resume_command(count):
+    """履歴書の一括作成を、逐次処理とプロセスプールで比較する"""
+    payloads = [{
+        'furigana': f'やまだ たろう {i}',
+        'name': f'山田 太郎 {i}',
+        'birthday': '2008年4月1日',
+        'address1': '東京都千代田区1-1-1',
+        'education': [{'year': '2021', 'month': '4', 'text': '○○中学校 入学'}, {'year': '2024', 'month': '4', 'text': '○○高等学校 入学'}],
+        'licenses': [{'year': '2023', 'month': '6', 'text': '英語検定 2級'}],
+        'motivation': '志望動機の例です。' * 10,
+        'notes': '特になし'
+    } for i in range(count)]
+
+    started_at = time.perf_counter()
+    parse_each = [load_workbook(RESUME_TEMPLATE_PATH) for _ in range(min(count, 5))]
+    parse_seconds = (time.perf_counter() - started_at) / len(parse_each)
+    click.echo(f"load_workbook per request (old): {parse_seconds * 1000:.1f} ms")
+
+    started_at = time.perf_counter()
+    serial_bytes = sum(len(render_resume_bytes(payload)) for payload in payloads)
+    serial_seconds = time.perf_counter() - started_at
+    click.echo(f"serial (cached template): {count} resumes in {serial_seconds:.2f}s ({serial_seconds / count * 1000:.1f} ms each, {serial_bytes / 1024:.0f} KB)")
+
+    get_resume_process_pool().submit(render_resume_bytes, payloads[0]).result()  # ワーカーを起動しておく
+    started_at = time.perf_counter()
+    zip_bytes = sum(len(chunk) for chunk in generate_resumes_zip(payloads))
+    pool_seconds = time.perf_counter() - started_at
+    click.echo(f"process pool ({RESUME_PROCESS_WORKERS} workers) + ZIP: {count} resumes in {pool_seconds:.2f}s ({zip_bytes / 1024:.0f} KB zip)")
+
+@app.cli.command('drain-outbox')
+def drain_outbox_command():
+    """送信期限の来た outbox の通知を今すぐ配信する"""
+    click.echo(f"Delivered {drain_outbox()} outbox entries.")
+
 # ==============================================================================
 # Page Rendering
 # ==============================================================================
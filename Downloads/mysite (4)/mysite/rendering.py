@@ -0,0 +1,191 @@
+"""
+アイコンの縮小と履歴書 (xlsx) の作成。
+
+プロセスプールのワーカーは、投入された関数を unpickle するためにその関数のモジュールを import する。
+app.py を import すると Firebase や LINE のクライアント、Flask アプリまで初期化されてしまうので、
+ワーカーで実行する処理は副作用の無いこのモジュールにまとめ、Pillow と openpyxl 以外には依存しない。
+"""
+import copy
+import io
+import logging
+import os
+import threading
+
+from openpyxl import load_workbook
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow が無い環境ではアイコンの縮小版を作らず、元画像だけを保存する
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RESUME_TEMPLATE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "A4_format.xlsx")
+
+PILLOW_AVAILABLE = Image is not None
+
+def render_icon_variants(data, sizes, image_format):
+    """
+    (プロセスプールで実行) 画像の向きを補正し、中央を正方形に切り抜いた各サイズの画像を返します。
+    保存時に exif を渡さないため、位置情報などのメタデータは含まれません。
+    """
+    with Image.open(io.BytesIO(data)) as img:
+        img = ImageOps.exif_transpose(img)
+        has_alpha = img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info)
+        img = img.convert('RGBA' if has_alpha and image_format == 'webp' else 'RGB')
+
+        variants = {}
+        for size in sizes:
+            thumbnail = ImageOps.fit(img, (size, size), Image.LANCZOS)
+            output = io.BytesIO()
+            if image_format == 'webp':
+                thumbnail.save(output, 'WEBP', quality=80, method=4)
+            else:
+                thumbnail.save(output, 'JPEG', quality=85, optimize=True, progressive=True)
+            variants[size] = output.getvalue()
+    return variants
+
+# テンプレートはプロセスごとに1回だけ読み込んで解析し、リクエストごとに deepcopy して使う
+# (ファイルが更新された場合は読み込み直す)
+resume_template_cache = {}
+resume_template_lock = threading.Lock()
+
+def get_resume_template(template_path=DEFAULT_RESUME_TEMPLATE_PATH):
+    """(解析済みのワークブック, 元のバイト列) を返す"""
+    mtime = os.path.getmtime(template_path)
+    with resume_template_lock:
+        cached = resume_template_cache.get(template_path)
+        if cached and cached['mtime'] == mtime:
+            return cached['workbook'], cached['data']
+        with open(template_path, 'rb') as f:
+            data = f.read()
+        workbook = load_workbook(io.BytesIO(data))
+        resume_template_cache[template_path] = {'mtime': mtime, 'data': data, 'workbook': workbook}
+        return workbook, data
+
+def new_resume_workbook(template_path=DEFAULT_RESUME_TEMPLATE_PATH):
+    """キャッシュしたテンプレートから、書き込み用のワークブックを作る"""
+    workbook, data = get_resume_template(template_path)
+    try:
+        return copy.deepcopy(workbook)
+    except Exception as e:
+        # deepcopy できない要素を含むテンプレートでは、キャッシュしたバイト列から解析し直す (ディスクは読まない)
+        logger.warning(f"Falling back to re-parsing the resume template: {e}")
+        return load_workbook(io.BytesIO(data))
+
+def fill_resume(data, template_path=DEFAULT_RESUME_TEMPLATE_PATH, output_path=None):
+    """
+    data(dict) に以下が含まれる想定：
+    {
+        "furigana": "...",
+        "name": "...",
+        "birthday": "...",
+        "address_kana1": "...",
+        "zip1": "...",
+        "address1": "...",
+        "tel1": "...",
+        "email1": "...",
+        "address_kana2": "...",
+        "zip2": "...",
+        "address2": "...",
+        "tel2": "...",
+        "email2": "...",
+        "education": [ {"year": "", "month": "", "text": "" }, ... ],
+        "licenses": [ {"year": "", "month": "", "text": "" }, ... ],
+        "motivation": "...",
+        "notes": "..."
+    }
+    output_path を省略した場合は、書き出した内容を BytesIO で返す。
+    """
+
+    wb = new_resume_workbook(template_path)
+    ws = wb.active
+
+    # ----------------------------
+    # 基本情報
+    # ----------------------------
+    ws["C6"] = data.get("furigana", "")
+    ws["C9"] = data.get("name", "")
+    ws["B14"] = data.get("birthday", "")
+
+    ws["C16"] = data.get("address_kana1", "")
+    ws["C19"] = data.get("zip1", "")
+    ws["C21"] = data.get("address1", "")
+    ws["I16"] = data.get("tel1", "")
+    ws["H21"] = data.get("email1", "")
+
+    ws["C25"] = data.get("address_kana2", "")
+    ws["C28"] = data.get("zip2", "")
+    ws["C30"] = data.get("address2", "")
+    ws["I25"] = data.get("tel2", "")
+    ws["H30"] = data.get("email2", "")
+
+    # ----------------------------
+    # 学歴・職歴
+    # ----------------------------
+    year_cells = ["B38","B41","B44","B47","B50","B53","B56","B59","B62","B65","B68","B71","B74","B77","B80","B83",
+                  "L5","L8","L11","L14","L16","L19"]
+    month_cells = ["C38","C41","C44","C47","C50","C53","C56","C59","C62","C65","C68","C71","C74","C77","C80","C83",
+                   "M5","M8","M11","M14","M16","M19"]
+    text_cells = ["D38","D41","D44","D47","D50","D53","D56","D59","D62","D65","D68","D71","D74","D77","D80","D83",
+                  "N5","N8","N11","N14","N16","N19"]
+
+    education = data.get("education", [])
+    for i, item in enumerate(education):
+        if i >= len(year_cells): break
+        ws[year_cells[i]] = item.get("year", "")
+        ws[month_cells[i]] = item.get("month", "")
+        ws[text_cells[i]] = item.get("text", "")
+
+    # ----------------------------
+    # 資格・免許
+    # ----------------------------
+    lic_year = ["L25","L28","L31","L34","L37","L40"]
+    lic_month = ["M25","M28","M31","M34","M37","M40"]
+    lic_text = ["N25","N28","N31","N34","N37","N40"]
+
+    licenses = data.get("licenses", [])
+    for i, item in enumerate(licenses):
+        if i >= len(lic_year): break
+        ws[lic_year[i]] = item.get("year", "")
+        ws[lic_month[i]] = item.get("month", "")
+        ws[lic_text[i]] = item.get("text", "")
+
+    # ----------------------------
+    # 志望動機（1セル）
+    # ----------------------------
+    ws["L47"] = data.get("motivation", "")
+
+    # ----------------------------
+    # 本人希望記入欄（複数行 OK）
+    # 行ごとに割り当てる
+    # ----------------------------
+    notes_lines = data.get("notes", "").split("\n")
+    notes_cells = ["L71","L74","L77","L80","L83"]
+
+    for i, line in enumerate(notes_lines):
+        if i >= len(notes_cells): break
+        ws[notes_cells[i]] = line
+
+    # ----------------------------
+    # 保存
+    # ----------------------------
+    if output_path:
+        wb.save(output_path)
+        return output_path
+    output = io.BytesIO()
+    wb.save(output)
+    output.seek(0)
+    return output
+
+# ワーカープロセスで使うテンプレートのパス (init_resume_worker で設定する)
+worker_template_path = DEFAULT_RESUME_TEMPLATE_PATH
+
+def init_resume_worker(template_path):
+    """(ワーカープロセスの初期化) テンプレートを読み込んでキャッシュしておく"""
+    global worker_template_path
+    worker_template_path = template_path
+    get_resume_template(template_path)
+
+def render_resume_bytes(payload):
+    """(プロセスプールで実行) 履歴書の xlsx のバイト列を返す"""
+    return fill_resume(payload, worker_template_path).getvalue()